@@ -4,8 +4,11 @@ import argparse
 import json
 import os
 import time
-from typing import Any, Dict, List, TypedDict, cast
+from typing import Any, Dict, List, NamedTuple, Tuple, TypedDict, Union, cast
 from spikeforest._common.calling_framework import add_standard_args, call_cleanup, extract_hither_config, parse_shared_configuration, print_per_verbose
+from spikeforest.ground_truth_comparison import GROUND_TRUTH_COMPARISON_VERSION, compare_with_ground_truth as compare_sorting_with_ground_truth
+from spikeforest.sorting_utilities.metric_cache import DEFAULT_METRIC_CACHE_PATH, MetricCache, get_data_hash, get_firings_hash
+import numpy as np
 import spikeextractors as se
 import hither2 as hi
 import kachery_cloud as kc
@@ -14,11 +17,24 @@ import sortingview as sv
 thisdir = os.path.dirname(os.path.realpath(__file__))
 spiketoolkit_image = hi.DockerImageFromScript(name='magland/spiketoolkit', dockerfile=f'{thisdir}/docker/Dockerfile')
 expected_spiketoolkit_version = '0.7.4'
-expected_spikecomparison_version = '0.3.2'
 
 class ArgsDict(TypedDict):
     sortingsfile: str
     recordingset: str
+    batch_by_recording: bool
+    metric_cache_path: Union[str, None]
+
+class MetricIntermediates(NamedTuple):
+    # What the quality metrics of all sortings of a recording have in common, computed once
+    filtered_recording: se.RecordingExtractor  # filtered as spiketoolkit's metrics filter it
+    noise_levels: Any                          # per channel, as spiketoolkit's SNR metric computes them
+
+class RecordingContext(NamedTuple):
+    # What the evaluations of all sortings of a recording have in common, loaded once
+    recording: se.RecordingExtractor
+    sample_rate: float
+    gt_sorting: se.SortingExtractor
+    intermediates: Union[MetricIntermediates, None] = None # if quality metrics are to be computed
 
 RECORDING_URI_KEY = 'recordingUri'
 GROUND_TRUTH_URI_KEY = 'sortingTrueUri'
@@ -39,6 +55,18 @@ QUALITY_METRICS = [
     "nn_miss_rate",
     "d_prime"
 ]
+GROUND_TRUTH_COMPARISON = 'ground_truth_comparison'
+
+# Versions of the metrics, keying the metric cache: bump one to recompute it (only it) for every sorting.
+QUALITY_METRIC_VERSIONS = {name: f'spiketoolkit-{expected_spiketoolkit_version}' for name in QUALITY_METRICS}
+GROUND_TRUTH_COMPARISON_VERSIONS = {GROUND_TRUTH_COMPARISON: GROUND_TRUTH_COMPARISON_VERSION}
+
+class MetricPlan(NamedTuple):
+    data_hash: str             # see get_data_hash; for the quality metrics
+    gt_data_hash: str          # for the ground truth comparison
+    firings_hash: str
+    cached: Dict[str, Any]     # metric name (or GROUND_TRUTH_COMPARISON): cached value
+    to_compute: List[str]
 
 def init_args():
     parser = argparse.ArgumentParser(description="Compute ground-truth comparisons and quality metrics for SpikeForest records.")
@@ -48,6 +76,15 @@ def init_args():
             "should be equivalent to the output of an API call to SpikeForest.")
     parser.add_argument('--recordingset', '-r', action='store', default='',
         help='If set, will limit processing to the set of recordings named in the variable (e.g. "paired_kampff").')
+    parser.add_argument('--batch-by-recording', action='store_true', default=False,
+        help='If set, all sortings of a recording are evaluated by one job, which loads the recording (caching its ' +
+            'filtered traces locally) and the ground truth, and computes the noise levels, once for all of them.')
+    parser.add_argument('--metric-cache', action='store', default=DEFAULT_METRIC_CACHE_PATH,
+        help="SQLite file caching each metric of each sorting, by recording data, firings and metric version, so that " +
+            "only the metrics not yet computed for a sorting are computed. Default: $SPIKEFOREST_METRIC_CACHE or " +
+            "~/.spikeforest/metric-cache.sqlite.")
+    parser.add_argument('--no-metric-cache', action='store_true', default=False,
+        help="If set, the metric cache is neither consulted nor updated.")
     parser = add_standard_args(parser)
     parsed = parser.parse_args()
     return parsed
@@ -56,10 +93,14 @@ def init_configuration():
     args: ArgsDict = {
         'sortingsfile': '',
         'recordingset': '',
+        'batch_by_recording': False,
+        'metric_cache_path': None
     }
     parsed = init_args()
     args['sortingsfile'] = parsed.sortingsfile
     args['recordingset'] = parsed.recordingset
+    args['batch_by_recording'] = parsed.batch_by_recording
+    args['metric_cache_path'] = None if parsed.no_metric_cache else parsed.metric_cache
     std_args = parse_shared_configuration(parsed)
     if (parsed.check_config):
         print(f"""Received the following environment vars:
@@ -76,140 +117,252 @@ def load_sortings(sortingsfile: str) -> List[Dict[str, Any]]:
     assert hydrated_sortings is not None
     return cast(List[Dict[str, Any]], hydrated_sortings)
 
-def compute_quality_metrics(recording: se.RecordingExtractor, sorting: se.SortingExtractor) -> str:
+def compute_metric_intermediates(recording: se.RecordingExtractor, cache_traces: bool = False) -> MetricIntermediates:
     # import within function in case we don't have spiketoolkit installed outside the container
+    import spiketoolkit as st
+    from spiketoolkit.postprocessing.utils import get_common_params
+    from spiketoolkit.validation.quality_metric_classes.parameter_dictionaries import get_recording_params
+    from spiketoolkit.validation.quality_metric_classes.snr import SNR, _compute_channel_noise_levels
+    params = get_recording_params()
+    filtered = recording
+    if params['apply_filter'] and not recording.is_filtered:
+        filtered = st.preprocessing.bandpass_filter(recording=recording, freq_min=params['freq_min'], freq_max=params['freq_max'])
+    if cache_traces:
+        # The metrics of every sorting then read the filtered traces from local disk, rather than fetching
+        # and filtering them again.
+        filtered = se.CacheRecordingExtractor(filtered)
+    noise_levels = _compute_channel_noise_levels(recording=filtered, mode=SNR.params['snr_mode'],
+        noise_duration=SNR.params['snr_noise_duration'], seed=get_common_params()['seed'])
+    return MetricIntermediates(filtered, noise_levels)
+
+def compute_snrs(intermediates: MetricIntermediates, sorting: se.SortingExtractor) -> Dict[Any, float]:
+    # As spiketoolkit's SNR metric, with the noise levels computed once per recording
+    import spiketoolkit as st
+    from spiketoolkit.validation.quality_metric_classes.snr import SNR, _compute_template_SNR
+    recording = intermediates.filtered_recording
+    unit_ids = sorting.get_unit_ids()
+    templates = st.postprocessing.get_unit_templates(recording, sorting, unit_ids=unit_ids,
+        max_spikes_per_unit=SNR.params['max_spikes_per_unit_for_snr'], mode=SNR.params['template_mode'])
+    max_channels = st.postprocessing.get_unit_max_channels(recording, sorting, unit_ids=unit_ids,
+        max_spikes_per_unit=SNR.params['max_spikes_per_unit_for_snr'], peak=SNR.params['max_channel_peak'],
+        mode=SNR.params['template_mode'])
+    channel_ids = recording.get_channel_ids()
+    return {unit_id: float(_compute_template_SNR(template, intermediates.noise_levels, channel_ids.index(max_channel)))
+                for (unit_id, template, max_channel) in zip(unit_ids, templates, max_channels)}
+
+def compute_quality_metrics(
+    intermediates: MetricIntermediates,
+    sorting: se.SortingExtractor,
+    metric_names: List[str] = QUALITY_METRICS
+) -> Dict[str, Any]:
     import spiketoolkit as st
     assert st.__version__ == expected_spiketoolkit_version, f'Unexpected spiketoolkit version: {st.__version__} <> {expected_spiketoolkit_version}'
-    return st.validation.compute_quality_metrics(
-        sorting, recording,
-        metric_names=QUALITY_METRICS, as_dataframe=True).to_dict()
+    result: Dict[str, Any] = {}
+    # spiketoolkit does not filter the recording again, as it is marked filtered
+    other_metrics = [m for m in metric_names if m != 'snr']
+    if len(other_metrics) > 0:
+        result = st.validation.compute_quality_metrics(
+            sorting, intermediates.filtered_recording,
+            metric_names=other_metrics, as_dataframe=True).to_dict()
+    if 'snr' in metric_names:
+        result['snr'] = compute_snrs(intermediates, sorting)
+    return result
 
 def compare_with_ground_truth(sorting: se.SortingExtractor, gt_sorting: se.SortingExtractor):
-    # import within function in case we don't have spikecomparison installed outside the container
-    import spikecomparison as sc
-    assert sc.__version__ == expected_spikecomparison_version, f'Unexpected spiketoolkit version: {sc.__version__} <> {expected_spikecomparison_version}'
-    ground_truth_comparison = sc.GroundTruthComparison(gt_sorting, sorting)
+    # Same best_match_12/21 and agreement_scores as spikecomparison 0.3.2's GroundTruthComparison,
+    # plus the per-unit performance; no container needed.
+    return compare_sorting_with_ground_truth(gt_sorting, sorting).to_dict()
 
-    return {"best_match_21": ground_truth_comparison.best_match_21.to_list(),
-            "best_match_12": ground_truth_comparison.best_match_12.to_list(),
-            "agreement_scores": ground_truth_comparison.agreement_scores.to_dict()}
+def load_spike_trains(sorting: se.SortingExtractor, sample_rate: float) -> se.SortingExtractor:
+    # Parse the firings once; the metrics and the comparison then both read the trains from memory.
+    unit_ids = sorting.get_unit_ids()
+    trains = [sorting.get_unit_spike_train(unit_id=u) for u in unit_ids]
+    in_memory = se.NumpySortingExtractor()
+    in_memory.set_times_labels(
+        times=np.concatenate(trains) if len(trains) > 0 else np.zeros(0),
+        labels=np.concatenate([np.full(len(t), u) for (u, t) in zip(unit_ids, trains)]) if len(trains) > 0 else np.zeros(0)
+    )
+    in_memory.set_sampling_frequency(sample_rate)
+    return in_memory
 
-@hi.function(
-    'compute_quality_metrics_hi', '0.1.1',
-    image=spiketoolkit_image,
-    kachery_support=True,
-    modules=['sortingview', 'spikeforest']
-)
-def compute_quality_metrics_hi(recording_uri, gt_uri, firings_uri):
-    # gt_uri is not needed, but including it lets this method and the ground truth comparison use the same consistent kwargs parameters.
-    print_per_verbose(1, f"Computing quality metrics for recording {recording_uri} and sorting {firings_uri}. Fetching Extractors...")
-    print_per_verbose(2, f"Execting sv.LabboxEphysRecordingExtractor({recording_uri})")
-    recording = sv.LabboxEphysRecordingExtractor(recording_uri)
-    sample_rate = recording.get_sampling_frequency()
-    print_per_verbose(2, f"Found sample rate {sample_rate}.")
-    sorting_object = {
+def load_firings(firings_uri: str, sample_rate: float) -> se.SortingExtractor:
+    return load_spike_trains(sv.LabboxEphysSortingExtractor({
         'sorting_format': 'mda',
         'data': {
             'firings': firings_uri,
             'samplerate': sample_rate
         }
-    }
-    print_per_verbose(2, f"(Comparison evaluation) Executing sv.LabboxEphysSortingExtractor({json.dumps(sorting_object)})")
-    sorting = sv.LabboxEphysSortingExtractor(sorting_object)
-    print_per_verbose(2, f"Executing quality metrics")
+    }), sample_rate)
+
+def load_recording_context(recording_uri: str, gt_uri: str) -> RecordingContext:
+    recording = sv.LabboxEphysRecordingExtractor(recording_uri)
+    sample_rate = recording.get_sampling_frequency()
+    print_per_verbose(2, f"Found sample rate {sample_rate}.")
+    gt_sorting = load_firings(kc.load_json(gt_uri)['firings'], sample_rate)
+    return RecordingContext(recording, sample_rate, gt_sorting)
+
+def evaluate_sorting(context: RecordingContext, firings_uri: str, metric_names: List[str]) -> Dict[str, Any]:
+    # metric_names: the quality metrics to compute, and GROUND_TRUTH_COMPARISON if the comparison is wanted
+    result: Dict[str, Any] = {}
+    quality_metrics = [m for m in QUALITY_METRICS if m in metric_names]
     try:
-        qm = compute_quality_metrics(recording, sorting)
+        sorting = load_firings(firings_uri, context.sample_rate)
     except Exception as e:
-        print(f"WARNING: Problem in compute_quality_metrics:\n{e}")
-        qm = f"Quality metric computation for recording {recording_uri} sorting {firings_uri} returned error:\n{e}"
-    return qm
+        # Only this sorting fails, not the others evaluated in the same (batched) job
+        print(f"WARNING: Problem loading sorting {firings_uri}:\n{e}")
+        if len(quality_metrics) > 0:
+            result['quality_metric'] = f"Loading sorting {firings_uri} returned error:\n{e}"
+        if GROUND_TRUTH_COMPARISON in metric_names:
+            result['ground_truth_comparison'] = f"Loading sorting {firings_uri} returned error:\n{e}"
+        return result
+    if len(quality_metrics) > 0:
+        print_per_verbose(2, f"Executing quality metrics {quality_metrics}")
+        try:
+            result['quality_metric'] = compute_quality_metrics(context.intermediates, sorting, quality_metrics)
+        except Exception as e:
+            print(f"WARNING: Problem in compute_quality_metrics:\n{e}")
+            result['quality_metric'] = f"Quality metric computation for sorting {firings_uri} returned error:\n{e}"
+    if GROUND_TRUTH_COMPARISON in metric_names:
+        print_per_verbose(2, f"Executing ground-truth comparison")
+        try:
+            result['ground_truth_comparison'] = compare_with_ground_truth(sorting, context.gt_sorting)
+        except Exception as e:
+            print(f"WARNING: Problem in compute_ground_truth_comparison:\n{e}")
+            result['ground_truth_comparison'] = f"Ground truth comparison for sorting {firings_uri} returned error:\n{e}"
+    return result
+
+def evaluate_recording_sortings(recording_uri: str, gt_uri: str, firings_uris: List[str], metric_names: List[List[str]]) -> List[Dict[str, Any]]:
+    context = load_recording_context(recording_uri, gt_uri)
+    if any(m in QUALITY_METRICS for names in metric_names for m in names):
+        context = context._replace(intermediates=compute_metric_intermediates(context.recording, cache_traces=len(firings_uris) > 1))
+    return [evaluate_sorting(context, firings_uri, names) for (firings_uri, names) in zip(firings_uris, metric_names)]
 
 @hi.function(
-    'compute_ground_truth_comparison_hi', '0.1.1',
+    'evaluate_sorting_hi', '0.2.1',
     image=spiketoolkit_image,
     kachery_support=True,
     modules=['sortingview', 'spikeforest']
 )
-def compute_ground_truth_comparison_hi(recording_uri, gt_uri, firings_uri):
-    print_per_verbose(1, f"Computing ground truth comparison for ground truth {gt_uri} and sorting {firings_uri} (recording {recording_uri})")
-    print_per_verbose(3, f'Fetching sample rate from {recording_uri}')
-    recording = sv.LabboxEphysRecordingExtractor(recording_uri)
-    sample_rate = recording.get_sampling_frequency()
-    print_per_verbose(3, f'Got sample rate {sample_rate}')
-    print_per_verbose(2, f"Building sorting object for ground truth {gt_uri}")
-    gt_firings = kc.load_json(gt_uri)['firings']
-    print_per_verbose(2, f"Got ground truth firings {gt_firings}")
-    gt_sorting_obj = {
-        'sorting_format': 'mda',
-        'data': {
-            'firings': gt_firings,
-            'samplerate': sample_rate
-        }
-    }
-    gt_sorting = sv.LabboxEphysSortingExtractor(gt_sorting_obj)
-    print_per_verbose(2, f"Building sorting object for sorting with firings {firings_uri}")
-    sorting_obj = {
-        'sorting_format': 'mda',
-        'data': {
-            'firings': firings_uri,
-            'samplerate': sample_rate
-        }
+def evaluate_sorting_hi(recording_uri, gt_uri, firings_uri, metric_names):
+    """Computes the quality metrics of a sorting and compares it with the ground truth, loading the
+    recording, the ground truth and the sorting once for both. Only the metrics named are computed."""
+    print_per_verbose(1, f"Evaluating sorting {firings_uri} against ground truth {gt_uri} (recording {recording_uri})")
+    return evaluate_recording_sortings(recording_uri, gt_uri, [firings_uri], [metric_names])[0]
+
+@hi.function(
+    'evaluate_recording_sortings_hi', '0.2.1',
+    image=spiketoolkit_image,
+    kachery_support=True,
+    modules=['sortingview', 'spikeforest']
+)
+def evaluate_recording_sortings_hi(recording_uri, gt_uri, firings_uris, metric_names):
+    """As evaluate_sorting_hi, for all the sortings (firings_uris, with the metrics of each in metric_names)
+    of one recording at once; returns their results in the same order. The filtered traces and the noise
+    levels used by the quality metrics are computed once for all of them."""
+    print_per_verbose(1, f"Evaluating {len(firings_uris)} sorting(s) of recording {recording_uri} against ground truth {gt_uri}")
+    return evaluate_recording_sortings(recording_uri, gt_uri, firings_uris, metric_names)
+
+def get_evaluation_params(sorting_record) -> Dict[str, str]:
+    return {
+        'recording_uri': sorting_record[RECORDING_URI_KEY],
+        'gt_uri': sorting_record[GROUND_TRUTH_URI_KEY],
+        'firings_uri': sorting_record[SORTING_FIRINGS_URI_KEY]
     }
-    sorting = sv.LabboxEphysSortingExtractor(sorting_obj)
-    print_per_verbose(2, f"Executing ground-truth comparison")
-    try:
-        gt = compare_with_ground_truth(sorting, gt_sorting)
-    except Exception as e:
-        print(f"WARNING: Problem in compute_ground_truth_comparison:\n{e}")
-        gt = f"Ground truth comparison for gt {gt_uri} and sorting {firings_uri} returned error:\n{e}"
-    return gt
 
-def process_sorting_record(sorting_record, comparison_result_list):
+def plan_metrics(cache: Union[MetricCache, None], params: Dict[str, str]) -> MetricPlan:
+    all_metrics = QUALITY_METRICS + [GROUND_TRUTH_COMPARISON]
+    if cache is None: return MetricPlan('', '', '', {}, all_metrics)
+    data_hash = get_data_hash(params['recording_uri'])
+    gt_data_hash = get_data_hash(params['recording_uri'], params['gt_uri'])
+    firings_hash = get_firings_hash(params['firings_uri'])
+    (cached, to_compute) = cache.missing(data_hash, firings_hash, QUALITY_METRIC_VERSIONS)
+    (gt_cached, gt_to_compute) = cache.missing(gt_data_hash, firings_hash, GROUND_TRUTH_COMPARISON_VERSIONS)
+    return MetricPlan(data_hash, gt_data_hash, firings_hash, {**cached, **gt_cached}, to_compute + gt_to_compute)
+
+def process_sorting_record(sorting_record, comparison_result_list, cache=None):
     try:
-        params = {
-            'recording_uri': sorting_record[RECORDING_URI_KEY],
-            'gt_uri': sorting_record[GROUND_TRUTH_URI_KEY],
-            'firings_uri': sorting_record[SORTING_FIRINGS_URI_KEY]
-        }
-        quality_metric_job = hi.Job(compute_quality_metrics_hi, params)
-        ground_truth_comparison_job = hi.Job(compute_ground_truth_comparison_hi, params)
-        comparison = make_comparison_entry(sorting_record, quality_metric_job, ground_truth_comparison_job)
-        comparison_result_list.append(comparison)
+        params = get_evaluation_params(sorting_record)
     except KeyError:
         print(f"One of sorting/recording/gt-sorting keys missing from {json.dumps(sorting_record)}. Skipping...")
+        return
+    plan = plan_metrics(cache, params)
+    evaluation_job = None
+    if len(plan.to_compute) > 0:
+        evaluation_job = hi.Job(evaluate_sorting_hi, {**params, 'metric_names': plan.to_compute})
+    comparison_result_list.append(make_comparison_entry(sorting_record, evaluation_job, plan))
+
+def process_recording_batch(sorting_records, comparison_result_list, cache=None):
+    # sorting_records all share their recording and ground truth
+    params = [get_evaluation_params(r) for r in sorting_records]
+    plans = [plan_metrics(cache, p) for p in params]
+    to_evaluate = [i for (i, plan) in enumerate(plans) if len(plan.to_compute) > 0]
+    evaluation_job = None
+    if len(to_evaluate) > 0:
+        evaluation_job = hi.Job(evaluate_recording_sortings_hi, {
+            'recording_uri': params[0]['recording_uri'],
+            'gt_uri': params[0]['gt_uri'],
+            'firings_uris': [params[i]['firings_uri'] for i in to_evaluate],
+            'metric_names': [plans[i].to_compute for i in to_evaluate]
+        })
+    for (i, sorting_record) in enumerate(sorting_records):
+        if i in to_evaluate:
+            comparison_result_list.append(make_comparison_entry(sorting_record, evaluation_job, plans[i], to_evaluate.index(i)))
+        else:
+            comparison_result_list.append(make_comparison_entry(sorting_record, None, plans[i]))
+
+def group_by_recording(sortings) -> List[List[Dict[str, Any]]]:
+    # In the order each recording first appears; records missing a key are skipped
+    groups: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for sorting_record in sortings:
+        try:
+            get_evaluation_params(sorting_record)
+        except KeyError:
+            print(f"One of sorting/recording/gt-sorting keys missing from {json.dumps(sorting_record)}. Skipping...")
+            continue
+        groups.setdefault((sorting_record[RECORDING_URI_KEY], sorting_record[GROUND_TRUTH_URI_KEY]), []).append(sorting_record)
+    return list(groups.values())
 
-def make_comparison_entry(sorting_record, quality_metric_job, gt_comparison_job):
+def make_comparison_entry(sorting_record, evaluation_job, plan, batch_index=None):
+    # evaluation_job is None if all metrics were cached; batch_index is the position of the sorting among
+    # those evaluated by a batched (per-recording) job
     return {
         'studyName': sorting_record['studyName'],
         'recordingName': sorting_record['recordingName'],
         'sorterName': sorting_record['sorterName'],
-        'quality_metric': quality_metric_job,
-        'ground_truth_comparison': gt_comparison_job
+        'evaluation': (evaluation_job, batch_index, plan)
     }
 
+def merge_cached_metrics(plan: MetricPlan, result: Dict[str, Any], cache: Union[MetricCache, None]) -> Dict[str, Any]:
+    """Combines the metrics just computed with the cached ones, storing the former in the cache. Errors
+    (reported as strings) are not cached."""
+    quality = result.get('quality_metric', {})
+    if isinstance(quality, dict):
+        if cache is not None and len(quality) > 0:
+            cache.put_many(plan.data_hash, plan.firings_hash, quality, QUALITY_METRIC_VERSIONS)
+        quality = {m: quality[m] if m in quality else plan.cached.get(m, None) for m in QUALITY_METRICS}
+    comparison = result.get('ground_truth_comparison', plan.cached.get(GROUND_TRUTH_COMPARISON, None))
+    if cache is not None and isinstance(result.get('ground_truth_comparison', None), dict):
+        cache.put_many(plan.gt_data_hash, plan.firings_hash, {GROUND_TRUTH_COMPARISON: comparison}, GROUND_TRUTH_COMPARISON_VERSIONS)
+    return {'quality_metric': quality, 'ground_truth_comparison': comparison}
+
 def extract_sorting_reference_name(comparison_object) -> str:
     return f"({comparison_object['studyName']} {comparison_object['recordingName']} {comparison_object['sorterName']})"
 
-def output_results(comparison_list, outfile):
+def output_results(comparison_list, outfile, cache=None):
     for comparison_object in comparison_list:
-        quality_job = comparison_object['quality_metric']
-        ground_truth_comparison_job = comparison_object['ground_truth_comparison']
-        if quality_job.status == 'finished' and ground_truth_comparison_job.status == 'finished':
-            comparison_object['quality_metric'] = quality_job.result.return_value
-            comparison_object['ground_truth_comparison'] = ground_truth_comparison_job.result.return_value
+        (evaluation_job, batch_index, plan) = comparison_object.pop('evaluation')
+        if evaluation_job is None or evaluation_job.status == 'finished':
+            result = {} if evaluation_job is None else evaluation_job.result.return_value
+            comparison_object.update(merge_cached_metrics(plan, result if batch_index is None else result[batch_index], cache))
             continue
-        if quality_job.status == 'error':
-            print(f"WARNING: quality job for {extract_sorting_reference_name(comparison_object)} had an error.")
-        elif quality_job.status != 'finished':
-            print(f"WARNING: unfinished non-errored quality job in {extract_sorting_reference_name(comparison_object)}--possible hither error")
-        if ground_truth_comparison_job.status == 'error':
-            print(f"WARNING: comparison job for {extract_sorting_reference_name(comparison_object)} had an error.")
-        elif ground_truth_comparison_job.status != 'finished':
-            print(f"WARNING: unfinished non-errored comparison job in {extract_sorting_reference_name(comparison_object)}--possible hither error")
-            
+        if evaluation_job.status == 'error':
+            print(f"WARNING: evaluation job for {extract_sorting_reference_name(comparison_object)} had an error.")
+        else:
+            print(f"WARNING: unfinished non-errored evaluation job in {extract_sorting_reference_name(comparison_object)}--possible hither error")
+
         # Replace problematic jobs with an error message (since we can't serialize the job itself)
-        comparison_object['quality_metric'] = f"Job status: {quality_job.status}"
-        comparison_object['ground_truth_comparison'] = f"Job status: {ground_truth_comparison_job.status}"
+        comparison_object['quality_metric'] = f"Job status: {evaluation_job.status}"
+        comparison_object['ground_truth_comparison'] = f"Job status: {evaluation_job.status}"
 
     if outfile is not None and outfile != '':
         with open(outfile, 'x') as f:
@@ -217,14 +370,22 @@ def output_results(comparison_list, outfile):
     else:
         print(f"Results:\n{json.dumps(comparison_list, indent=4)}")
 
-def extraction_loop(sortings, comparison_list, max_iterations = 0):
+def batched_extraction_loop(sortings, comparison_list, max_iterations = 0, cache=None):
+    if max_iterations > 0: sortings = sortings[:max_iterations]
+    batches = group_by_recording(sortings)
+    for (count, batch) in enumerate(batches):
+        print_per_verbose(2, f"Creating evaluation job {count + 1} ({len(batch)} sorting(s) of {batch[0]['studyName']} {batch[0]['recordingName']})")
+        process_recording_batch(batch, comparison_list, cache)
+    print_per_verbose(1, f'{len(batches)} jobs have been queued. Now waiting for them to complete.')
+
+def extraction_loop(sortings, comparison_list, max_iterations = 0, cache=None):
     count = 0
     for sorting_record in sortings:
-        print_per_verbose(2, f"Creating job-pair {count + 1} ({extract_sorting_reference_name(sorting_record)})")
-        process_sorting_record(sorting_record, comparison_list)
+        print_per_verbose(2, f"Creating evaluation job {count + 1} ({extract_sorting_reference_name(sorting_record)})")
+        process_sorting_record(sorting_record, comparison_list, cache)
         count += 1
         if max_iterations > 0 and count >= max_iterations: break
-    print_per_verbose(1, f'{count*2} jobs have been queued. Now waiting for them to complete.')
+    print_per_verbose(1, f'{count} jobs have been queued. Now waiting for them to complete.')
 
 def main():
     (args, std_args) = init_configuration()
@@ -232,17 +393,24 @@ def main():
     if args['recordingset'] is not None and args['recordingset'] != '':
         sortings = [s for s in sortings if s['studyName'] == args['recordingset']]
     hither_config = extract_hither_config(std_args)
+    cache = None if args['metric_cache_path'] is None else MetricCache(args['metric_cache_path'])
     comparison_list = []
     try:
         print(f"\t\tScript execution beginning at {time.ctime()}")
         start_time = time.time()
         with hi.Config(**hither_config):
-            extraction_loop(sortings, comparison_list, std_args['test'])
+            if args['batch_by_recording']:
+                batched_extraction_loop(sortings, comparison_list, std_args['test'], cache)
+            else:
+                extraction_loop(sortings, comparison_list, std_args['test'], cache)
         hi.wait(None)
     finally:
         call_cleanup(hither_config)
 
-    output_results(comparison_list, std_args['outfile'])
+    try:
+        output_results(comparison_list, std_args['outfile'], cache)
+    finally:
+        if cache is not None: cache.close()
     print(f"\n\n\t\tElapsed time: {time.time() - start_time:.3f} sec")
     print(f"\t\tScript execution complete at {time.ctime()}")
 
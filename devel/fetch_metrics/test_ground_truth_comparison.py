@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Checks spikeforest.ground_truth_comparison against spikecomparison 0.3.2, whose results it reproduces.
+# Requires spikecomparison==0.3.2 (and its dependencies) to be installed.
+
+import numpy as np
+import pandas as pd
+import spikeextractors as se
+from spikecomparison import compare_sorter_to_ground_truth
+from spikecomparison.comparisontools import count_matching_events, make_best_match as sc_make_best_match, make_hungarian_match as sc_make_hungarian_match
+from spikeforest.ground_truth_comparison import compare_with_ground_truth
+from spikeforest.ground_truth_comparison.ground_truth_comparison import make_best_match, make_hungarian_match, make_match_count_matrix
+
+def random_trains(rng: np.random.Generator, num_units: int, num_frames: int, max_spikes: int):
+    # Distinct times across all units: on equal times, the order of spikecomparison's merge is unspecified
+    counts = rng.integers(0, max_spikes, size=num_units)
+    times = rng.choice(num_frames, size=int(counts.sum()), replace=False)
+    return np.split(times, np.cumsum(counts)[:-1])
+
+def test_match_counts():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        delta = int(rng.integers(0, 15))
+        num_frames = int(rng.integers(600, 3000))
+        trains = random_trains(rng, int(rng.integers(2, 10)), num_frames, 60)
+        split = int(rng.integers(1, len(trains)))
+        (gt_trains, sorted_trains) = (trains[:split], trains[split:])
+        counts = make_match_count_matrix(gt_trains, sorted_trains, delta)
+        expected = [[count_matching_events(np.sort(t1), np.sort(t2), delta=delta) for t2 in sorted_trains] for t1 in gt_trains]
+        assert counts.tolist() == expected, (counts.tolist(), expected)
+
+def check_matches(scores: np.ndarray, chance_score: float = 0.1, match_score: float = 0.5):
+    unit1_ids = list(range(1, scores.shape[0] + 1))
+    unit2_ids = list(range(10, 10 + scores.shape[1]))
+    df = pd.DataFrame(scores, index=unit1_ids, columns=unit2_ids)
+    (best_12, best_21) = make_best_match(scores, unit1_ids, unit2_ids, chance_score)
+    (sc_best_12, sc_best_21) = sc_make_best_match(df, chance_score)
+    assert (best_12, best_21) == (sc_best_12.to_list(), sc_best_21.to_list()), (scores, best_12, best_21)
+    (hungarian_12, hungarian_21) = make_hungarian_match(scores, unit1_ids, unit2_ids, match_score)
+    (sc_hungarian_12, sc_hungarian_21) = sc_make_hungarian_match(df, match_score)
+    assert (hungarian_12, hungarian_21) == (sc_hungarian_12.to_list(), sc_hungarian_21.to_list()), (scores, hungarian_12, hungarian_21)
+
+def test_best_and_hungarian_match():
+    # best matches use chance_score, not match_score
+    check_matches(np.array([[0.3, 0.05]]))
+    # the assignment is made on the scores thresholded at match_score
+    check_matches(np.array([[0.6, 0.45], [0.45, 0]]))
+    rng = np.random.default_rng(1)
+    for _ in range(500):
+        shape = (int(rng.integers(1, 7)), int(rng.integers(1, 7)))
+        check_matches(np.round(rng.random(shape), 2))
+
+def make_sorting(unit_trains, sample_rate: float) -> se.NumpySortingExtractor:
+    sorting = se.NumpySortingExtractor()
+    sorting.set_times_labels(
+        np.concatenate(unit_trains).astype(np.int64),
+        np.repeat(np.arange(1, len(unit_trains) + 1), [len(t) for t in unit_trains])
+    )
+    sorting.set_sampling_frequency(sample_rate)
+    return sorting
+
+def test_compare_with_ground_truth():
+    rng = np.random.default_rng(2)
+    (sample_rate, num_frames) = (30000, 300000)
+    for _ in range(30):
+        # Ground truth spikes on even frames and sorted spikes on odd ones, so that no two are simultaneous.
+        # Sorted units are jittered subsets of ground truth units (some sharing one) with added spikes.
+        gt_trains = [2 * t for t in random_trains(rng, int(rng.integers(1, 10)), num_frames // 2, 500)]
+        sorted_trains = []
+        for _ in range(int(rng.integers(1, 10))):
+            source = gt_trains[int(rng.integers(0, len(gt_trains)))]
+            kept = source[rng.random(len(source)) < rng.random()]
+            jittered = kept + 2 * rng.integers(-8, 8, size=len(kept)) + 1
+            added = 2 * rng.integers(0, num_frames // 2, size=int(rng.integers(0, 300))) + 1
+            sorted_trains.append(np.unique(np.concatenate([jittered, added]).clip(1, num_frames - 1)))
+        (gt_sorting, sorting) = (make_sorting(gt_trains, sample_rate), make_sorting(sorted_trains, sample_rate))
+        comparison = compare_with_ground_truth(gt_sorting, sorting)
+        expected = compare_sorter_to_ground_truth(gt_sorting, sorting, n_jobs=1)
+        assert comparison.match_counts.tolist() == expected.match_event_count.values.tolist()
+        assert np.allclose(comparison.agreement_scores, expected.agreement_scores.values)
+        assert comparison.best_match_12 == expected.best_match_12.to_list()
+        assert comparison.best_match_21 == expected.best_match_21.to_list()
+        assert comparison.hungarian_match_12 == expected.hungarian_match_12.to_list()
+        assert comparison.hungarian_match_21 == expected.hungarian_match_21.to_list()
+
+def main():
+    test_match_counts()
+    test_best_and_hungarian_match()
+    test_compare_with_ground_truth()
+    print('All ground truth comparison checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+# Checks that the batched evaluation of the sortings of a recording computes the filtered traces and
+# noise levels once, and that its quality metrics match spiketoolkit's own. Uses a synthetic recording
+# (the loaders of fetch_metrics are replaced, so nothing is fetched). Requires spiketoolkit==0.7.4.
+
+import numpy as np
+import spikeextractors as se
+import spiketoolkit as st
+import fetch_metrics
+
+def make_recording(rng: np.random.Generator, num_channels: int = 4, sample_rate: float = 30000.0, duration_sec: float = 20.0) -> se.NumpyRecordingExtractor:
+    traces = rng.normal(0, 10, size=(num_channels, int(sample_rate * duration_sec))).astype(np.float32)
+    return se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=sample_rate,
+                                      geom=np.array([[0, 20 * c] for c in range(num_channels)]))
+
+def make_sorting(rng: np.random.Generator, num_units: int, num_frames: int, sample_rate: float) -> se.NumpySortingExtractor:
+    times = np.sort(rng.choice(np.arange(200, num_frames - 200), size=100 * num_units, replace=False))
+    sorting = se.NumpySortingExtractor()
+    sorting.set_times_labels(times, np.tile(np.arange(1, num_units + 1), 100))
+    sorting.set_sampling_frequency(sample_rate)
+    return sorting
+
+def test_intermediates_computed_once():
+    rng = np.random.default_rng(0)
+    recording = make_recording(rng)
+    sample_rate = recording.get_sampling_frequency()
+    sortings = {f'firings-{i}': make_sorting(rng, 2 + i, recording.get_num_frames(), sample_rate) for i in range(3)}
+    calls = []
+    compute_metric_intermediates = fetch_metrics.compute_metric_intermediates
+    def counting_intermediates(recording, cache_traces=False):
+        calls.append(recording)
+        return compute_metric_intermediates(recording, cache_traces)
+    fetch_metrics.compute_metric_intermediates = counting_intermediates
+    fetch_metrics.load_recording_context = lambda recording_uri, gt_uri: \
+        fetch_metrics.RecordingContext(recording, sample_rate, sortings['firings-0'])
+    fetch_metrics.load_firings = lambda firings_uri, sample_rate: fetch_metrics.load_spike_trains(sortings[firings_uri], sample_rate)
+    metric_names = ['num_spikes', 'snr', 'isolation_distance']
+    results = fetch_metrics.evaluate_recording_sortings('recording', 'gt', list(sortings.keys()), [metric_names] * len(sortings))
+    assert len(calls) == 1
+    for (firings_uri, result) in zip(sortings.keys(), results):
+        expected = st.validation.compute_quality_metrics(
+            fetch_metrics.load_spike_trains(sortings[firings_uri], sample_rate), recording,
+            metric_names=metric_names, as_dataframe=True).to_dict()
+        for m in metric_names:
+            assert np.allclose([result['quality_metric'][m][u] for u in expected[m]], list(expected[m].values())), (m, result, expected)
+
+def main():
+    test_intermediates_computed_once()
+    print('All metric intermediates checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Checks the allocation sizing of --slurm-adaptive (AdaptiveAllocationPolicy), and the handler which
+# follows it (AdaptiveSlurmJobHandler), without slurm: allocations and jobs are stand-ins.
+
+from types import SimpleNamespace
+from spikeforest._common.adaptive_slurm import AdaptiveAllocationPolicy, AdaptiveSlurmJobHandler, AllocationState
+
+def test_full_allocations_early():
+    policy = AdaptiveAllocationPolicy(max_allocations=3, max_jobs_per_allocation=4)
+    decision = policy.decide([100.0] * 10, [], [])
+    assert decision.new_allocation_sizes == [4, 4, 4]
+    assert decision.release == []
+
+def test_small_allocations_for_long_tail():
+    # A few long jobs left: as many slots as still finish them in about the same time
+    policy = AdaptiveAllocationPolicy(max_allocations=3, max_jobs_per_allocation=4)
+    decision = policy.decide([1000.0, 1000.0], [50.0, 50.0], [])
+    assert decision.new_allocation_sizes == [1, 1]
+
+def test_no_allocation_while_slots_are_free():
+    policy = AdaptiveAllocationPolicy(max_allocations=3, max_jobs_per_allocation=4)
+    decision = policy.decide([100.0, 100.0], [100.0], [AllocationState(active_jobs=1, capacity=4, idle_sec=0)])
+    assert decision.new_allocation_sizes == []
+
+def test_at_most_max_allocations():
+    policy = AdaptiveAllocationPolicy(max_allocations=3, max_jobs_per_allocation=4)
+    full = AllocationState(active_jobs=4, capacity=4, idle_sec=0)
+    assert policy.decide([100.0] * 5, [100.0] * 8, [full, full]).new_allocation_sizes == [4]
+    assert policy.decide([100.0] * 5, [100.0] * 12, [full, full, full]).new_allocation_sizes == []
+
+def test_release_idle_allocations():
+    policy = AdaptiveAllocationPolicy(max_allocations=3, max_jobs_per_allocation=4, idle_release_sec=120)
+    allocations = [
+        AllocationState(active_jobs=0, capacity=4, idle_sec=200),
+        AllocationState(active_jobs=0, capacity=4, idle_sec=10),
+        AllocationState(active_jobs=1, capacity=4, idle_sec=0)
+    ]
+    assert policy.decide([], [100.0], allocations).release == [0]
+    # Nothing is released while jobs are waiting
+    assert policy.decide([100.0], [100.0], allocations).release == []
+
+class FakeAllocation:
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.released = False
+
+    def cleanup(self) -> None:
+        self.released = True
+
+class FakeJob:
+    def __init__(self, allocation: FakeAllocation) -> None:
+        self.allocation = allocation
+        self.status = 'running'
+        self.result = None
+        self._console_lines = []
+
+    def finish(self) -> None:
+        self.status = 'finished'
+        self.result = SimpleNamespace(return_value=None, error=None)
+
+    def fail(self, message: str) -> None:
+        self.status = 'error'
+        self.result = SimpleNamespace(return_value=None, error=Exception(message))
+
+def test_handler_allocations():
+    allocations = []
+    started = []
+    def make_allocation(capacity):
+        allocations.append(FakeAllocation(capacity))
+        return allocations[-1]
+    def start_job(allocation, fn, kwargs):
+        started.append(FakeJob(allocation))
+        return started[-1]
+    policy = AdaptiveAllocationPolicy(max_allocations=2, max_jobs_per_allocation=2, idle_release_sec=0)
+    handler = AdaptiveSlurmJobHandler(policy, make_allocation, start_job=start_job)
+    jobs = [handler.submit(print, {}, estimate_sec=100.0) for _ in range(4)]
+    assert handler.num_allocations == 0 and all(j.status == 'queued' for j in jobs)
+    handler.poll()
+    assert [a.capacity for a in allocations] == [2, 2]
+    assert all(j.status == 'running' for j in jobs)
+    (first, second) = allocations
+    # A job loses its node: its allocation gets no new jobs, and the retry waits for a slot elsewhere
+    [j for j in started if j.allocation is first][0].fail('srun: error: node17: task 0: Job step aborted due to node failure')
+    retry = handler.submit(print, {}, estimate_sec=100.0)
+    handler.poll()
+    assert retry.status == 'queued' and handler.num_allocations == 2
+    [j for j in started if j.allocation is second][0].finish()
+    handler.poll()
+    assert retry.status == 'running' and started[-1].allocation is second
+    # Once drained, the allocation which lost the node is released
+    [j for j in started if j.allocation is first and j.status == 'running'][0].finish()
+    handler.poll()
+    assert first.released and not second.released and handler.num_allocations == 1
+    # With nothing left to run, the idle allocation goes too
+    for j in started:
+        if j.status == 'running': j.finish()
+    handler.poll()
+    assert second.released and handler.num_allocations == 0
+    assert len(allocations) == 2
+
+def main():
+    test_full_allocations_early()
+    test_small_allocations_for_long_tail()
+    test_no_allocation_while_slots_are_free()
+    test_at_most_max_allocations()
+    test_release_idle_allocations()
+    test_handler_allocations()
+    print('All adaptive slurm checks passed.')
+
+if __name__ == '__main__':
+    main()
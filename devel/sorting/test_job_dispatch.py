@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Checks the routing of jobs to job handler pools by resource class, with local stand-in pools
+# (no hither job handlers are created and no jobs are run).
+
+from argparse import ArgumentParser
+from spikeforest._common.calling_framework import add_standard_args, parse_shared_configuration
+from spikeforest._common.job_dispatch import JobDispatcher, ResourceClass, parse_resource_class
+
+def make_args(argv=[]):
+    return parse_shared_configuration(add_standard_args(ArgumentParser()).parse_args(argv))
+
+def test_parse_resource_class():
+    assert parse_resource_class(None) is None
+    assert parse_resource_class({}) == ResourceClass()
+    assert parse_resource_class({'cpus': 4, 'gpus': 1, 'memory_gb': 32, 'max_concurrent': 2, 'partition': 'gpu'}) == \
+        ResourceClass(cpus=4, gpus=1, memory_gb=32, max_concurrent=2, partition='gpu')
+    # The same resources, however written, are the same class (and so share a pool)
+    assert parse_resource_class({'gpus': 1, 'cpus': 4}) == parse_resource_class({'cpus': 4, 'gpus': 1})
+    try:
+        parse_resource_class({'cpus': 4, 'gpu': 1})
+    except Exception as e:
+        assert 'gpu' in str(e)
+    else:
+        raise AssertionError('An unknown resource field was accepted')
+
+def test_handler_routing():
+    created = []
+    def make_pool(args, resources):
+        created.append(resources)
+        return f'pool-{len(created)}'
+    dispatcher = JobDispatcher(make_args(), 'default', make_handler=make_pool)
+    gpu = parse_resource_class({'cpus': 4, 'gpus': 1})
+    cpu = parse_resource_class({'cpus': 1})
+    assert dispatcher.handler_for(None) == 'default'
+    assert dispatcher.handler_for(gpu) == 'pool-1'
+    assert dispatcher.handler_for(cpu) == 'pool-2'
+    # Pools are created once per resource class, then reused
+    assert dispatcher.handler_for(parse_resource_class({'gpus': 1, 'cpus': 4})) == 'pool-1'
+    assert dispatcher.handler_for(cpu) == 'pool-2'
+    assert created == [gpu, cpu]
+    assert dispatcher.pools == {gpu: 'pool-1', cpu: 'pool-2'}
+
+def main():
+    test_parse_resource_class()
+    test_handler_routing()
+    print('All job dispatch checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# Checks the submission order of the sorting jobs (order_sorting_requests) with the default options,
+# given a runtime model (the SpikeForest catalog is not loaded and no jobs are run).
+
+from argparse import ArgumentParser
+from spikeforest._common.calling_framework import add_standard_args, parse_shared_configuration
+from spikeforest.sorting_utilities.job_ordering import fit_runtime_model
+from spikeforest.sorting_utilities.run_sortings import RecordingRecord, SorterRecord, SortingMatrixEntry, expand_sorting_matrix, init_sorting_args, order_sorting_requests
+
+def make_recording(name: str, num_channels: int) -> RecordingRecord:
+    return RecordingRecord(study_name='study', recording_name=name, recording_uri=f'uri-{name}', ground_truth_uri='',
+                           num_channels=num_channels, duration_sec=600.0)
+
+def test_recordings_stay_together():
+    parser = add_standard_args(init_sorting_args(ArgumentParser()))
+    parsed = parser.parse_args([])
+    (args, std_args) = ({'job_order': parsed.job_order, 'runtime_history_uri': None}, parse_shared_configuration(parsed))
+    recordings = [make_recording('small', 4), make_recording('large', 64), make_recording('medium', 16)]
+    sorting_matrix = {
+        name: SortingMatrixEntry(sorter_record=SorterRecord(sorter_name=name, sorting_parameters={}), requested_recordings=recordings)
+        for name in ['MountainSort4', 'SpykingCircus', 'Kilosort2']
+    }
+    # The sorters' runtimes differ enough for plain longest-first to interleave the recordings
+    model = fit_runtime_model(
+        [('study', 'small', 'MountainSort4', 10.0), ('study', 'large', 'SpykingCircus', 5000.0), ('study', 'medium', 'Kilosort2', 3000.0)],
+        {('study', 'small'): 4 * 600.0, ('study', 'large'): 64 * 600.0, ('study', 'medium'): 16 * 600.0}
+    )
+    ordered = order_sorting_requests(expand_sorting_matrix(sorting_matrix), args, std_args, model)
+    names = [r.recording.recording_name for r in ordered]
+    assert len(names) == 9
+    # Each recording's jobs are adjacent: the recording changes exactly twice
+    assert sum(1 for (a, b) in zip(names, names[1:]) if a != b) == 2, names
+    assert names[0] == 'large', names
+
+def main():
+    test_recordings_stay_together()
+    print('All job ordering checks passed.')
+
+if __name__ == '__main__':
+    main()
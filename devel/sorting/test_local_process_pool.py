@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Checks that a job runs to completion in a worker process of the local process pool
+# (LocalProcessJobHandler, as used for --local-processes), with a trivial job function.
+
+import functools
+import os
+from spikeforest._common.local_process_pool import LocalProcessJobHandler
+
+def job_only(f):
+    # Stands in for @hi.function: the decorated object is not meant to be called directly.
+    @functools.wraps(f)
+    def decorated(**kwargs):
+        raise Exception(f'{f.__name__} can only be run as a job')
+    return decorated
+
+@job_only
+def add_numbers(a: int, b: int, num_threads: int = 0) -> dict:
+    return {'sum': a + b, 'num_threads': num_threads, 'omp_num_threads': os.environ.get('OMP_NUM_THREADS')}
+
+def test_trivial_job():
+    handler = LocalProcessJobHandler(num_workers=1, timeout_sec=60, threads_per_job=2)
+    job = handler.submit(add_numbers, {'a': 1, 'b': 2, 'num_threads': 0})
+    assert job.wait(timeout=60).return_value == {'sum': 3, 'num_threads': 2, 'omp_num_threads': '2'}, job.result.error
+    assert job.status == 'finished' and job.timestamp_completed >= job.timestamp_started
+    handler.cleanup()
+
+def main():
+    test_trivial_job()
+    print('All local process pool checks passed.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Checks the eviction of the preprocessing cache (PreprocessingCache), with small files standing in
+# for the preprocessed recordings (no preprocessing jobs are run).
+
+import os
+import tempfile
+from spikeforest.sorting_utilities.preprocessing_cache import PreprocessingCache
+
+def add_entry(cache: PreprocessingCache, key: str, num_bytes: int) -> str:
+    path = cache.make_output_path(key)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * num_bytes)
+    cache.put(key, f'hash-{key}', {}, {'recording_format': 'mda', 'data': {'raw': path}})
+    return path
+
+def test_evict_deletes_files():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = PreprocessingCache(os.path.join(tmpdir, 'cache.sqlite'), max_bytes=250)
+        paths = {key: add_entry(cache, key, 100) for key in ['a', 'b', 'c']}
+        assert cache.get('a') is not None # now the most recently used
+        # Over the bound: the least recently used entry not in use goes, file and all
+        assert cache.evict(in_use={'b'}) == ['c']
+        assert not os.path.exists(paths['c']) and cache.get('c') is None
+        assert os.path.exists(paths['a']) and os.path.exists(paths['b'])
+        assert cache.evict() == []
+        cache.close()
+
+def test_missing_file_is_a_miss():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = PreprocessingCache(os.path.join(tmpdir, 'cache.sqlite'), max_bytes=1000)
+        os.remove(add_entry(cache, 'a', 100))
+        assert cache.get('a') is None
+        cache.close()
+
+def main():
+    test_evict_deletes_files()
+    test_missing_file_is_a_miss()
+    print('All preprocessing cache checks passed.')
+
+if __name__ == '__main__':
+    main()
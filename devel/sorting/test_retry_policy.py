@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Checks which failed jobs are retried (RetryScheduler driven by iterate_completed_jobs), and the
+# failure causes recorded for each attempt, with stand-ins for the jobs (nothing is run).
+
+from types import SimpleNamespace
+from typing import Any, List, NamedTuple
+from spikeforest._common.calling_framework import iterate_completed_jobs
+from spikeforest._common.retry_policy import DEPENDENCY_ERROR, FailureCause, RetryPolicy, RetryScheduler, get_failure_causes
+
+class FakeJob:
+    def __init__(self, error: Any = None, kwargs: Any = {}) -> None:
+        self.status = 'finished' if error is None else 'error'
+        self.result = SimpleNamespace(return_value=None, error=error)
+        self.kwargs = kwargs
+        self._console_lines = []
+
+class Entry(NamedTuple):
+    name: str
+    job: FakeJob
+    attempt: int = 1
+    failure_causes: List[str] = []
+
+def run(entries: List[Entry], retry_errors: dict, max_attempts: int = 3) -> dict:
+    # Each retry of an entry fails with the next of its retry_errors (None: it succeeds)
+    def resubmit(entry: Entry, cause: FailureCause) -> Entry:
+        error = retry_errors[entry.name].pop(0)
+        return entry._replace(job=FakeJob(error), attempt=entry.attempt + 1, failure_causes=entry.failure_causes + [str(cause)])
+    retries = RetryScheduler(RetryPolicy(max_attempts=max_attempts, backoff_sec=0), lambda e: e.attempt, resubmit)
+    completed = list(iterate_completed_jobs(entries, lambda e: e.job, poll_interval_sec=0, retries=retries))
+    return {e.name: (e.attempt, get_failure_causes(e.failure_causes, e.job)) for e in completed}
+
+def test_retry_causes():
+    node_failure = Exception('srun: error: node17: task 0: Job step aborted due to node failure')
+    timeout = TimeoutError('kachery load_file timed out')
+    shard = FakeJob(node_failure)
+    results = run([
+        Entry('lost-node', FakeJob(node_failure)),
+        Entry('sorter-crash', FakeJob(Exception('Error running sorter: index out of range'))),
+        Entry('slow-download', FakeJob(timeout)),
+        Entry('lost-shard', FakeJob(Exception(DEPENDENCY_ERROR), kwargs={'shards': [shard]}))
+    ], {'lost-node': [None], 'slow-download': [timeout, timeout], 'lost-shard': [None]})
+    assert results['lost-node'] == (2, ['transient:node-failure']), results
+    # The sorter's own failures fail fast
+    assert results['sorter-crash'] == (1, ['deterministic:sorter-error']), results
+    assert results['slow-download'] == (3, ['transient:TimeoutError'] * 3), results
+    # A sharded sorting takes the cause of the shard which failed
+    assert results['lost-shard'] == (2, ['transient:node-failure']), results
+
+def test_retries_disabled():
+    node_failure = Exception('slurmstepd: error: *** STEP 12.0 ON node17 CANCELLED DUE TO NODE FAILURE ***')
+    results = run([Entry('lost-node', FakeJob(node_failure))], {}, max_attempts=1)
+    assert results['lost-node'] == (1, ['transient:node-failure']), results
+
+def main():
+    test_retry_causes()
+    test_retries_disabled()
+    print('All retry policy checks passed.')
+
+if __name__ == '__main__':
+    main()
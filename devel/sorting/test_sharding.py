@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Checks the sharding of a recording whose channel ids are not 0, 1, ... (make_shards), and the stitching
+# of the shard sortings (stitch_sortings) on such a recording, with a synthetic recording (no sorter is run).
+
+import numpy as np
+import spikeextractors as se
+from spikeforest.sorters._stitching import stitch_sortings
+from spikeforest.sorting_utilities.sharding import SHARD_MODE_GROUPS, SHARD_MODE_SPATIAL, ShardingSpec, make_shards
+
+CHANNEL_IDS = [10, 11, 12, 13, 20, 21, 22, 23]
+LOCATIONS = [[0.0, 20.0 * i] for i in range(len(CHANNEL_IDS))]
+
+def test_group_shards():
+    sharding = ShardingSpec(mode=SHARD_MODE_GROUPS, groups=[[10, 11, 12, 13], [20, 21, 22, 23]], guard_um=20.0)
+    shards = make_shards(LOCATIONS, sharding, CHANNEL_IDS)
+    assert [s.core_channel_ids for s in shards] == [[10, 11, 12, 13], [20, 21, 22, 23]], shards
+    # The guard channels are the neighbouring channel of the other group, by location
+    assert [s.channel_ids for s in shards] == [[10, 11, 12, 13, 20], [13, 20, 21, 22, 23]], shards
+
+def test_spatial_shards():
+    shards = make_shards(LOCATIONS, ShardingSpec(mode=SHARD_MODE_SPATIAL, max_channels=4, guard_um=0.0), CHANNEL_IDS)
+    assert [s.core_channel_ids for s in shards] == [[10, 11, 12, 13], [20, 21, 22, 23]], shards
+
+def make_recording(rng: np.random.Generator, spikes: dict, sample_rate: float = 30000.0, num_frames: int = 300000) -> se.RecordingExtractor:
+    # spikes: channel id -> spike frames of a unit with its peak there
+    traces = rng.normal(0, 5, size=(len(CHANNEL_IDS), num_frames)).astype(np.float32)
+    for (channel_id, frames) in spikes.items():
+        for frame in frames:
+            traces[CHANNEL_IDS.index(channel_id), frame - 5:frame + 5] -= 200
+    recording = se.NumpyRecordingExtractor(timeseries=traces, sampling_frequency=sample_rate, geom=np.array(LOCATIONS))
+    return se.SubRecordingExtractor(recording, renamed_channel_ids=CHANNEL_IDS)
+
+def make_sorting(units: list, sample_rate: float = 30000.0) -> se.NumpySortingExtractor:
+    sorting = se.NumpySortingExtractor()
+    for (unit_id, frames) in enumerate(units):
+        sorting.add_unit(unit_id + 1, np.array(frames))
+    sorting.set_sampling_frequency(sample_rate)
+    return sorting
+
+def test_stitch_shards():
+    rng = np.random.default_rng(0)
+    spikes = {11: np.arange(1000, 290000, 3001), 22: np.arange(2000, 290000, 2999), 13: np.arange(1500, 290000, 4001)}
+    recording = make_recording(rng, spikes)
+    sharding = ShardingSpec(mode=SHARD_MODE_GROUPS, groups=[[10, 11, 12, 13], [20, 21, 22, 23]], guard_um=20.0)
+    shards = [(s.channel_ids, s.core_channel_ids) for s in make_shards(LOCATIONS, sharding, CHANNEL_IDS)]
+    # Both shards find the unit on channel 13, which is a core channel of the first shard and a guard of the second
+    sortings = [make_sorting([spikes[11], spikes[13]]), make_sorting([spikes[22], spikes[13]])]
+    merged = stitch_sortings(recording, sortings, shards, agreement_threshold=0.5, window=12, max_spikes_per_unit=50)
+    trains = sorted([list(merged.get_unit_spike_train(unit_id=u)) for u in merged.get_unit_ids()], key=lambda t: t[0])
+    assert trains == [list(spikes[11]), list(spikes[13]), list(spikes[22])], [t[:2] for t in trains]
+
+def main():
+    test_group_shards()
+    test_spatial_shards()
+    test_stitch_shards()
+    print('All sharding checks passed.')
+
+if __name__ == '__main__':
+    main()
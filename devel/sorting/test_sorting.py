@@ -1,4 +1,5 @@
 import hither2 as hi
+from spikeforest.sorters._telemetry import unpack_sorter_result
 
 def test_sorting(sorter_func):
     import sortingview as sv
@@ -24,10 +25,10 @@ def test_sorting(sorter_func):
     # jh = hi.SlurmJobHandler(num_jobs_per_allocation=4, max_simultaneous_allocations=4, srun_command='')
     log = hi.Log()
     with hi.Config(use_container=True, job_handler=jh, log=log, show_console=True):
-        sorting_object = hi.Job(sorter_func, {
+        result = hi.Job(sorter_func, {
             'recording_object': recording.object()
         }).wait().return_value
-        sorting = sv.LabboxEphysSortingExtractor(sorting_object)
+        sorting = sv.LabboxEphysSortingExtractor(unpack_sorter_result(result)[0])
 
     unit_ids = sorting.get_unit_ids()
     spike_train = sorting.get_unit_spike_train(unit_id=unit_ids[0])
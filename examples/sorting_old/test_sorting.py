@@ -1,5 +1,6 @@
 from typing import Union
 import hither2 as hi
+from spikeforest.sorters._telemetry import unpack_sorter_result
 
 def test_sorting(sorter_func, *, show_console=True, job_handler: Union[None, hi.JobHandler]=None):
     import sortingview as sv
@@ -22,10 +23,10 @@ def test_sorting(sorter_func, *, show_console=True, job_handler: Union[None, hi.
     print(f'Unit {unit_ids[0]} has {len(spike_train)} events')
 
     with hi.Config(use_container=True, show_console=show_console, job_handler=job_handler):
-        sorting_object = hi.Job(sorter_func, {
+        result = hi.Job(sorter_func, {
             'recording_object': recording.object()
         }).wait().return_value
-        sorting = sv.LabboxEphysSortingExtractor(sorting_object)
+        sorting = sv.LabboxEphysSortingExtractor(unpack_sorter_result(result)[0])
 
     unit_ids = sorting.get_unit_ids()
     spike_train = sorting.get_unit_spike_train(unit_id=unit_ids[0])
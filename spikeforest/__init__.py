@@ -5,5 +5,6 @@ from .load_spikeforest_recordings.load_spikeforest_recording import load_spikefo
 from .load_spikeforest_sorting_outputs.load_spikeforest_sorting_outputs import load_spikeforest_sorting_outputs
 from .load_spikeforest_sorting_outputs.load_spikeforest_sorting_output import load_spikeforest_sorting_output
 from .load_extractors import load_recording_extractor, load_sorting_extractor
+from .ground_truth_comparison import compare_with_ground_truth
 
 from .version import __version__
\ No newline at end of file
@@ -0,0 +1,248 @@
+import math
+import time
+from statistics import median
+from typing import Any, Callable, Dict, List, NamedTuple, Union
+import hither2 as hi
+
+from spikeforest._common.calling_framework import print_per_verbose
+from spikeforest._common.retry_policy import is_node_failure
+
+# Used for jobs with no estimate, until some jobs of the same function have completed.
+DEFAULT_JOB_ESTIMATE_SEC = 3600.0
+
+
+class AllocationState(NamedTuple):
+    active_jobs: int
+    capacity: int     # jobs_per_allocation of this allocation
+    idle_sec: float   # how long the allocation has had no jobs (0 if it has some)
+
+class AllocationDecision(NamedTuple):
+    new_allocation_sizes: List[int]  # jobs_per_allocation of each allocation to request
+    release: List[int]               # indices of the allocations to release
+
+class AdaptiveAllocationPolicy:
+    """Decides when to request and release slurm allocations, and how large to make them.
+
+    The configured jobs per allocation and number of allocations are upper bounds. New allocations
+    are requested while queued jobs exceed the free job slots, sized so that the remaining work
+    (from the job duration estimates) is spread over as few allocations as still finish it in about
+    the same time: early in a run that means full-size allocations; at the end, when only a few long
+    jobs remain, small ones. Allocations which have been idle for idle_release_sec while nothing is
+    waiting are released.
+    """
+    def __init__(self, max_allocations: int, max_jobs_per_allocation: int, idle_release_sec: float = 120.0) -> None:
+        self.max_allocations = max(1, max_allocations)
+        self.max_jobs_per_allocation = max(1, max_jobs_per_allocation)
+        self.idle_release_sec = idle_release_sec
+
+    def jobs_per_allocation(self, waiting_estimates: List[float], running_remaining: List[float]) -> int:
+        durations = [d for d in waiting_estimates + running_remaining if d > 0]
+        if len(durations) == 0: return self.max_jobs_per_allocation
+        total_slots = self.max_allocations * self.max_jobs_per_allocation
+        total_work = sum(durations)
+        # No schedule can finish before the longest job, nor before the work spread over every slot.
+        makespan = max(max(durations), total_work / total_slots)
+        slots_needed = min(total_slots, math.ceil(total_work / makespan))
+        return min(self.max_jobs_per_allocation, max(1, math.ceil(slots_needed / self.max_allocations)))
+
+    def decide(
+        self,
+        waiting_estimates: List[float],
+        running_remaining: List[float],
+        allocations: List[AllocationState]
+    ) -> AllocationDecision:
+        num_waiting = len(waiting_estimates)
+        release = [i for (i, a) in enumerate(allocations)
+                    if num_waiting == 0 and a.active_jobs == 0 and a.idle_sec >= self.idle_release_sec]
+        free_slots = sum(a.capacity - a.active_jobs for a in allocations)
+        num_allowed = self.max_allocations - len(allocations)
+        new_sizes: List[int] = []
+        if num_waiting > free_slots and num_allowed > 0:
+            size = self.jobs_per_allocation(waiting_estimates, running_remaining)
+            new_sizes = [size] * min(num_allowed, math.ceil((num_waiting - free_slots) / size))
+        return AllocationDecision(new_allocation_sizes=new_sizes, release=release)
+
+
+class DeferredJob:
+    """Stands in for a hither Job until the adaptive handler places it in an allocation; from then on,
+    attributes (status, result, _console_lines, timestamps...) are those of the real job.
+    """
+    def __init__(self, fn: Any, kwargs: Dict[str, Any], estimate_sec: float) -> None:
+        self.fn = fn
+        self.kwargs = kwargs
+        self.estimate_sec = estimate_sec
+        self._job: Any = None
+        self._error: Union[Exception, None] = None
+
+    @property
+    def status(self) -> str:
+        if self._error is not None: return 'error'
+        return 'queued' if self._job is None else self._job.status
+
+    @property
+    def result(self) -> Any:
+        if self._error is not None:
+            return _DeferredJobResult(self._error)
+        return None if self._job is None else self._job.result
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes not found on the DeferredJob itself
+        job = self.__dict__.get('_job', None)
+        if job is None:
+            if name == '_console_lines': return []
+            if name.startswith('timestamp_'): return None
+            raise AttributeError(name)
+        return getattr(job, name)
+
+class _DeferredJobResult:
+    def __init__(self, error: Exception) -> None:
+        self.return_value = None
+        self.error = error
+
+def _find_deferred(obj: Any) -> List[DeferredJob]:
+    if isinstance(obj, DeferredJob): return [obj]
+    if isinstance(obj, dict): return [j for v in obj.values() for j in _find_deferred(v)]
+    if isinstance(obj, (list, tuple)): return [j for v in obj for j in _find_deferred(v)]
+    return []
+
+def _resolve_deferred(obj: Any) -> Any:
+    # Deferred jobs passed as arguments are replaced by the real (hither) jobs, which hither resolves in turn.
+    if isinstance(obj, DeferredJob): return obj._job
+    if isinstance(obj, dict): return {k: _resolve_deferred(v) for (k, v) in obj.items()}
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'): return type(obj)(*[_resolve_deferred(v) for v in obj])
+    if isinstance(obj, (list, tuple)): return type(obj)(_resolve_deferred(v) for v in obj)
+    return obj
+
+
+class _Allocation:
+    def __init__(self, handler: Any, capacity: int) -> None:
+        self.handler = handler
+        self.capacity = capacity
+        self.jobs: List[DeferredJob] = []
+        self.idle_since: Union[float, None] = time.time()
+        # Set when a job lost its node; the allocation then gets no new jobs and is released once drained.
+        self.retired = False
+
+    def state(self, now: float) -> AllocationState:
+        return AllocationState(
+            active_jobs=len(self.jobs),
+            capacity=len(self.jobs) if self.retired else self.capacity,
+            idle_sec=0.0 if self.idle_since is None else now - self.idle_since
+        )
+
+
+class AdaptiveSlurmJobHandler:
+    """Runs jobs on slurm allocations which are requested and released as the queue changes.
+
+    Each allocation is a SlurmJobHandler with a single allocation (made by make_allocation), on which
+    start_job starts a job: a hither Job by default. Both can be replaced by stand-ins to exercise the
+    handler without slurm. Jobs are held here until an allocation has a free slot, so that the queue
+    stays visible to the AdaptiveAllocationPolicy. Like LocalProcessJobHandler, this is driven by poll()
+    (see JobDispatcher.poll).
+    """
+    def __init__(
+        self,
+        policy: AdaptiveAllocationPolicy,
+        make_allocation: Callable[[int], Any],
+        hither_config: Union[Dict[str, Any], None] = None,
+        start_job: Union[Callable[[Any, Any, Dict[str, Any]], Any], None] = None
+    ) -> None:
+        self._policy = policy
+        self._make_allocation = make_allocation
+        self._start_job = start_job or self._start_hither_job
+        self._hither_config = {**(hither_config or {}), 'job_handler': None}
+        self._queued: List[DeferredJob] = []
+        self._allocations: List[_Allocation] = []
+        self._observed: Dict[str, List[float]] = {}
+
+    def submit(self, fn: Any, kwargs: Dict[str, Any], estimate_sec: float = 0.0) -> DeferredJob:
+        job = DeferredJob(fn, kwargs, estimate_sec)
+        self._queued.append(job)
+        return job
+
+    def _estimate(self, job: DeferredJob) -> float:
+        if job.estimate_sec > 0: return job.estimate_sec
+        observed = self._observed.get(getattr(job.fn, '__name__', ''), [])
+        return median(observed) if len(observed) > 0 else DEFAULT_JOB_ESTIMATE_SEC
+
+    def _reap(self, now: float) -> None:
+        for allocation in self._allocations:
+            still_active = []
+            for job in allocation.jobs:
+                if job.status in ['finished', 'error']:
+                    started = getattr(job, 'timestamp_started', None)
+                    completed = getattr(job, 'timestamp_completed', None)
+                    if job.status == 'finished' and started and completed:
+                        self._observed.setdefault(getattr(job.fn, '__name__', ''), []).append(completed - started)
+                    if is_node_failure(job) and not allocation.retired:
+                        print_per_verbose(1, "A job lost its slurm node; retiring its allocation")
+                        allocation.retired = True
+                else:
+                    still_active.append(job)
+            allocation.jobs = still_active
+            if len(still_active) == 0 and allocation.idle_since is None:
+                allocation.idle_since = now
+
+    def _running_remaining(self, now: float) -> List[float]:
+        remaining = []
+        for allocation in self._allocations:
+            for job in allocation.jobs:
+                started = getattr(job, 'timestamp_started', None) or now
+                remaining.append(max(0.0, self._estimate(job) - (now - started)))
+        return remaining
+
+    def _start_hither_job(self, handler: Any, fn: Any, kwargs: Dict[str, Any]) -> Any:
+        with hi.Config(**self._hither_config):
+            with hi.Config(job_handler=handler):
+                return hi.Job(fn, kwargs)
+
+    def _place(self, job: DeferredJob, allocation: _Allocation) -> None:
+        job._job = self._start_job(allocation.handler, job.fn, _resolve_deferred(job.kwargs))
+        allocation.jobs.append(job)
+        allocation.idle_since = None
+
+    def poll(self) -> None:
+        now = time.time()
+        self._reap(now)
+        for i in reversed(range(len(self._allocations))):
+            if self._allocations[i].retired and len(self._allocations[i].jobs) == 0:
+                self._allocations[i].handler.cleanup()
+                del self._allocations[i]
+        decision = self._policy.decide(
+            [self._estimate(j) for j in self._queued],
+            self._running_remaining(now),
+            [a.state(now) for a in self._allocations]
+        )
+        for i in sorted(decision.release, reverse=True):
+            print_per_verbose(2, f"Releasing idle slurm allocation ({self._allocations[i].capacity} job slots)")
+            self._allocations[i].handler.cleanup()
+            del self._allocations[i]
+        for size in decision.new_allocation_sizes:
+            print_per_verbose(2, f"Requesting slurm allocation with {size} job slots ({len(self._queued)} jobs waiting)")
+            self._allocations.append(_Allocation(self._make_allocation(size), size))
+        still_queued = []
+        for job in self._queued:
+            dependencies = _find_deferred(job.kwargs)
+            if any(d.status == 'error' and d._job is None for d in dependencies):
+                job._error = Exception('A job this job depends on errored')
+                continue
+            # Allocations which lost a node get no new jobs, so retried jobs run elsewhere
+            free = [a for a in self._allocations if len(a.jobs) < a.capacity and not a.retired]
+            if len(free) == 0 or any(d._job is None for d in dependencies):
+                still_queued.append(job)
+                continue
+            # Fill the fullest allocation first, so that the others can become idle and be released.
+            self._place(job, max(free, key=lambda a: len(a.jobs)))
+        self._queued = still_queued
+
+    @property
+    def num_allocations(self) -> int:
+        return len(self._allocations)
+
+    def cleanup(self) -> None:
+        for job in self._queued:
+            job._error = Exception('Job cancelled')
+        self._queued = []
+        for allocation in self._allocations:
+            allocation.handler.cleanup()
+        self._allocations = []
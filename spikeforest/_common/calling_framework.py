@@ -3,9 +3,14 @@ from argparse import ArgumentParser, Namespace
 
 import datetime
 import os
-from typing import Any, TypedDict, NamedTuple, Union
+import time
+from typing import Any, Callable, Generator, Iterable, TypedDict, NamedTuple, TypeVar, Union
 import hither2 as hi
 
+from spikeforest._common.pipeline_metrics import PipelineMetrics
+from spikeforest._common.retry_policy import RetryPolicy, RetryScheduler
+from spikeforest._common.trace import TraceRecorder
+
 
 # NamedTuple is probably cleaner, but keeping a dict is more convenient for screen output.
 class StandardArgs(TypedDict):
@@ -13,12 +18,25 @@ class StandardArgs(TypedDict):
     timeout_min: int
     outfile: str
     workercount: int
+    local_processes: int
+    thread_policy: str
+    cores: int
+    staging_gb: float
+    max_attempts: int
+    retry_backoff_sec: float
     job_cache: Union[str, None]
     use_container: bool
     use_slurm: bool
     slurm_max_jobs_per_alloc: int
     slurm_max_simultaneous_allocs: int
     slurm_command: str
+    slurm_partition: str
+    slurm_exclusive: bool
+    slurm_adaptive: bool
+    metrics_file: Union[str, None]
+    metrics_port: int
+    metrics_interval_sec: float
+    trace_file: Union[str, None]
 
 class HitherConfiguration(TypedDict):
     job_handler: Any
@@ -27,6 +45,8 @@ class HitherConfiguration(TypedDict):
     log: Any
 
 
+T = TypeVar('T')
+
 RECORDING_URI_KEY = 'recordingUri'
 GROUND_TRUTH_URI_KEY = 'sortingTrueUri'
 SORTING_FIRINGS_URI_KEY = 'firings'
@@ -34,9 +54,10 @@ SORTING_FIRINGS_URI_KEY = 'firings'
 def add_standard_args(parser: ArgumentParser) -> ArgumentParser:
     """Adds standard command-line arguments for interacting with hither/slurm calling conventions.
     Included arguments are --verbose (-v|vv|vvv...), --test (-t), --outfile (-o), --workercount (-w),
-    --job-cache, --no-job-cache, --use-container, --no-container, --use-slurm, --slurm-partition,
+    --local-processes, --thread-policy, --cores, --staging-gb, --job-cache, --no-job-cache, --use-container, --no-container, --use-slurm, --slurm-partition,
     --slurm-accept-shared-nodes, --slurm-jobs-per-allocation, --slurm-max-simultaneous-allocations,
-    --slurm-gpus-per-node, --timeout-min, and --check-config.
+    --slurm-adaptive, --slurm-gpus-per-node, --timeout-min, --max-attempts, --retry-backoff-sec, --metrics-file, --metrics-port, --metrics-interval-sec,
+    --trace-file, and --check-config.
 
     Args:
         parser (argparse.ArgumentParser): An initialized argparse ArgumentParser to extend.
@@ -52,11 +73,35 @@ def add_standard_args(parser: ArgumentParser) -> ArgumentParser:
         "to give a usable sample without processing the entire data set.")
     parser.add_argument('--timeout-min', '-T', action='store', type=int, default=0,
         help="If non-zero, this will set a maximum duration for any job before it is cancelled.")
+    parser.add_argument('--max-attempts', action='store', type=int, default=3,
+        help="Jobs which fail for a transient reason (download timeouts, network errors, lost slurm nodes, container " +
+        "pull errors) are retried until they have been attempted this many times. Sorter crashes are not retried. " +
+        "Set to 1 to disable retries. Default 3. Only with --slurm-adaptive does the retry of a job which lost its " +
+        "node avoid that node (its allocation is retired); otherwise slurm may place the retry on the same node.")
+    parser.add_argument('--retry-backoff-sec', action='store', type=float, default=60.0,
+        help="How long to wait before retrying a job; doubled for each further retry. Default 60.")
     parser.add_argument('--outfile', '-o', action='store', default=None,
         help='If set, output (but not warnings/messages) will be written to this file (instead of to STDOUT). ' +
-             'Any existing file will NOT be overwritten; the program will abort instead.')
+             'Any existing file will NOT be overwritten; the program will abort instead. Scripts which stream ' +
+             'their results write them as JSON Lines to <outfile>.jsonl as they become available (or directly ' +
+             'to the outfile, if it ends in .jsonl).')
     parser.add_argument('--workercount', '-w', action='store', type=int, default=4,
         help="If set, determines the number of worker threads for a parallel job handler. Ignored if using slurm.")
+    parser.add_argument('--local-processes', action='store', type=int, default=0,
+        help="If non-zero, jobs will be run without containers in a pool of this many local worker processes " +
+        "(one process per job, with thread-count environment variables pinned; see --thread-policy), instead of through a hither " +
+        "job handler. Overrides --workercount, --use-container and --use-slurm.")
+    parser.add_argument('--thread-policy', action='store', choices=['benchmark', 'throughput'], default='benchmark',
+        help="'benchmark' (default) runs every sorter single-threaded, so that runtimes are comparable across sorters. " +
+        "'throughput' gives the jobs the available cores instead: with --local-processes, each job gets a share of the " +
+        "free cores (more for longer jobs) and is pinned to them; otherwise the cores are split evenly over the job slots.")
+    parser.add_argument('--cores', action='store', type=int, default=0,
+        help="If non-zero, the number of cores available to the jobs on this machine. Default: all cores this process may use.")
+    parser.add_argument('--staging-gb', action='store', type=float, default=0,
+        help="If non-zero, sorters which support it first copy (or hardlink) the raw data of their recording to node-local " +
+        "scratch ($SPIKEFOREST_STAGING_DIR, or $TMPDIR/spikeforest-staging), keeping at most this many GB of staged " +
+        "recordings per node (least recently used first out). Jobs on the same node share the staged copy; with " +
+        "--use-container, the node's staging directory is mounted into the containers for this.")
     parser.add_argument('--job-cache', action='store', type=str, default='default-job-cache',
         help="If set, indicates the feed name for the job cache feed.")
     parser.add_argument('--no-job-cache', action='store_true', default=False,
@@ -79,8 +124,23 @@ def add_standard_args(parser: ArgumentParser) -> ArgumentParser:
         help='Controls the max length of job processing queues for slurm nodes. Default 6.')
     parser.add_argument('--slurm-max-simultaneous-allocations', action='store', type=int, default=5,
         help='The maximum number of job processing queues/slurm nodes to be requested. Default 5.')
+    parser.add_argument('--slurm-adaptive', action='store_true', default=False,
+        help='If set, slurm allocations are requested while jobs are waiting and released once idle, and sized from ' +
+        'the estimated durations of the remaining jobs; --slurm-jobs-per-allocation and ' +
+        '--slurm-max-simultaneous-allocations then become upper bounds.')
     parser.add_argument('--slurm-gpus-per-node', action='store', type=int, default=0,
         help='If set, slurm commands will require this many GPUs per allocated node.')
+    parser.add_argument('--metrics-file', action='store', default=None,
+        help='If set, progress metrics (jobs per sorter and state, throughput, ETA, cache hit rate, estimated input size) ' +
+        'are periodically written to this file in the Prometheus text format, e.g. for the node exporter textfile collector.')
+    parser.add_argument('--metrics-port', action='store', type=int, default=0,
+        help='If non-zero, the same metrics are also served at http://127.0.0.1:<port>/metrics.')
+    parser.add_argument('--metrics-interval-sec', action='store', type=float, default=15.0,
+        help='How often the metrics file is rewritten. Default 15.')
+    parser.add_argument('--trace-file', action='store', default=None,
+        help='If set, a timeline of the run (stages of the pipeline process; queue wait, setup and sorter phases of each ' +
+        'job, one track per worker slot of each host) is written to this file in the Chrome trace-event format, ' +
+        'for chrome://tracing or https://ui.perfetto.dev.')
     parser.add_argument('--check-config', action='store_true', default=False,
         help='Debugging tool. If set, program will simply quit with a description of the parsed configuration.')
     return parser
@@ -98,10 +158,7 @@ def parse_shared_configuration(parsed: Namespace) -> StandardArgs:
         StandardArgs: A dictionary of compiled run values, to be passed to future calls from this file.
     """    
 
-    # example srun_command: srun --exclusive -n 1 -p <partition>
-    slurm_command = f"srun -n 1 -p {parsed.slurm_partition} {'--exclusive' if not parsed.slurm_accept_shared_nodes else ''}"
-    if parsed.slurm_gpus_per_node > 0:
-        slurm_command += f" --gpus-per-node={parsed.slurm_gpus_per_node}"
+    slurm_command = make_slurm_command(parsed.slurm_partition, not parsed.slurm_accept_shared_nodes, parsed.slurm_gpus_per_node)
     if parsed.outfile is not None and parsed.outfile != '' and os.path.exists(parsed.outfile) and parsed.outfile != "/dev/null":
         raise Exception('Error: Requested to write to an existing output file. Aborting to avoid overwriting file.')
     # configure verbosity for the run
@@ -114,6 +171,12 @@ def parse_shared_configuration(parsed: Namespace) -> StandardArgs:
         timeout_min                   = parsed.timeout_min,
         outfile                       = parsed.outfile,
         workercount                   = max(parsed.workercount, 1),
+        local_processes               = max(parsed.local_processes, 0),
+        thread_policy                 = parsed.thread_policy,
+        cores                         = max(parsed.cores, 0),
+        staging_gb                    = max(parsed.staging_gb, 0),
+        max_attempts                  = max(parsed.max_attempts, 1),
+        retry_backoff_sec             = max(parsed.retry_backoff_sec, 0),
         # As a reminder, argparse converts internal -es to _s to keep the identifiers valid
         job_cache                     = None if parsed.no_job_cache else parsed.job_cache,
         use_container                 = parsed.use_container or \
@@ -122,9 +185,27 @@ def parse_shared_configuration(parsed: Namespace) -> StandardArgs:
         use_slurm                     = parsed.use_slurm,
         slurm_max_jobs_per_alloc      = parsed.slurm_jobs_per_allocation,
         slurm_max_simultaneous_allocs = parsed.slurm_max_simultaneous_allocations,
-        slurm_command                 = slurm_command
+        slurm_command                 = slurm_command,
+        slurm_partition               = parsed.slurm_partition,
+        slurm_exclusive               = not parsed.slurm_accept_shared_nodes,
+        slurm_adaptive                = parsed.slurm_adaptive,
+        metrics_file                  = parsed.metrics_file,
+        metrics_port                  = max(parsed.metrics_port, 0),
+        metrics_interval_sec          = parsed.metrics_interval_sec,
+        trace_file                    = parsed.trace_file
     )
 
+def make_slurm_command(partition: str, exclusive: bool, gpus_per_node: int = 0, cpus_per_task: int = 0, memory_gb: float = 0) -> str:
+    # example srun_command: srun --exclusive -n 1 -p <partition>
+    slurm_command = f"srun -n 1 -p {partition} {'--exclusive' if exclusive else ''}"
+    if gpus_per_node > 0:
+        slurm_command += f" --gpus-per-node={gpus_per_node}"
+    if cpus_per_task > 0:
+        slurm_command += f" --cpus-per-task={cpus_per_task}"
+    if memory_gb > 0:
+        slurm_command += f" --mem={int(memory_gb * 1024)}M"
+    return slurm_command
+
 # TODO: print_per_verbose, _fmt_time belong in a different file?
 def print_per_verbose(lvl: int, msg: str) -> None:
     # verbosity_level is a static value, initialized from command-line argument at setup time in init_configuration().
@@ -140,16 +221,24 @@ def _fmt_time(t: Union[float, None]) -> str:
     return datetime.datetime.fromtimestamp(t).isoformat()
 
 def extract_hither_config(args: StandardArgs) -> HitherConfiguration:
-    use_container = args['use_container']
+    use_container = args['use_container'] and args['local_processes'] == 0
     if args['test'] != 0: print(f"\tRunning in TEST MODE--Execution will stop after processing {args['test']} sortings!\n")
 
-    if use_container:
+    if args['local_processes'] > 0:
+        print_per_verbose(1, f"Running jobs without containers in {args['local_processes']} local worker processes.")
+    elif use_container:
         print_per_verbose(1, f"Using {'Singularity' if os.getenv('HITHER_USE_SINGULARITY') else 'Docker'} containers.")
     else:
         print_per_verbose(1, "Running without containers.")
     # Define job cache and job handler
     jc = None if args['job_cache'] == None else hi.JobCache(feed_name=args['job_cache'])
-    if args['use_slurm']:
+    if args['local_processes'] > 0:
+        # Jobs are run by a LocalProcessJobHandler (see JobDispatcher); anything else run through hither runs inline.
+        jh = None
+    elif args['use_slurm'] and args['slurm_adaptive']:
+        # Likewise, jobs are run by an AdaptiveSlurmJobHandler (see JobDispatcher).
+        jh = None
+    elif args['use_slurm']:
         jh = hi.SlurmJobHandler(
             num_jobs_per_allocation=args['slurm_max_jobs_per_alloc'],
             max_simultaneous_allocations=args['slurm_max_simultaneous_allocs'],
@@ -168,6 +257,62 @@ def extract_hither_config(args: StandardArgs) -> HitherConfiguration:
         log=log
     )
     
-def call_cleanup(config: HitherConfiguration) -> None:
+def start_pipeline_metrics(args: StandardArgs) -> Union[PipelineMetrics, None]:
+    if args['metrics_file'] is None and args['metrics_port'] == 0: return None
+    if args['metrics_port'] > 0:
+        print_per_verbose(1, f"Serving pipeline metrics at http://127.0.0.1:{args['metrics_port']}/metrics")
+    return PipelineMetrics(args['metrics_file'], args['metrics_port'], args['metrics_interval_sec'])
+
+def start_trace(args: StandardArgs) -> Union[TraceRecorder, None]:
+    if args['trace_file'] is None: return None
+    return TraceRecorder(args['trace_file'])
+
+def make_retry_policy(args: StandardArgs) -> RetryPolicy:
+    return RetryPolicy(max_attempts=args['max_attempts'], backoff_sec=args['retry_backoff_sec'])
+
+def iterate_completed_jobs(
+    entries: Iterable[T],
+    get_job: Callable[[T], Any],
+    poll_interval_sec: float = 2.0,
+    poll: Union[Callable[[], None], None] = None,
+    retries: Union[RetryScheduler, None] = None
+) -> Generator[T, None, None]:
+    """Drives the hither job queues and yields each entry as soon as its job has finished or errored,
+    so that callers can process results while the remaining jobs are still running.
+
+    Args:
+        entries (Iterable[T]): Objects which each hold one job (e.g. SortingJob records).
+        get_job (Callable[[T], Any]): Returns the job belonging to an entry.
+        poll_interval_sec (float): How long to drive the job queues between checks for completed jobs.
+        poll (Callable[[], None], optional): Drives any non-hither job handlers (e.g. JobDispatcher.poll).
+        retries (RetryScheduler, optional): Retries the jobs which fail transiently; only the entry of
+            the last attempt of a job is yielded.
+
+    Yields:
+        T: Entries whose job is complete, in order of completion.
+    """
+    pending = list(entries)
+    while len(pending) > 0 or (retries is not None and retries.num_waiting > 0):
+        timer = time.time()
+        if retries is not None: pending += retries.due()
+        if poll is not None: poll()
+        hi.wait(poll_interval_sec)
+        still_pending = []
+        for entry in pending:
+            job = get_job(entry)
+            if job.status == 'error' and retries is not None and retries.schedule(entry, job):
+                continue
+            if job.status in ['finished', 'error']:
+                yield entry
+            else:
+                still_pending.append(entry)
+        if len(still_pending) == len(pending):
+            # hi.wait() can return immediately (e.g. when all jobs are running remotely); don't spin.
+            time.sleep(max(0, poll_interval_sec - (time.time() - timer)))
+        pending = still_pending
+
+def call_cleanup(config: HitherConfiguration, dispatcher: Any = None) -> None:
+    if dispatcher is not None:
+        dispatcher.cleanup()
     if config['job_handler'] is not None:
         config['job_handler'].cleanup()
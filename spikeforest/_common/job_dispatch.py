@@ -0,0 +1,213 @@
+from typing import Any, Callable, Dict, List, NamedTuple, Union
+import hither2 as hi
+
+from spikeforest._common.adaptive_slurm import AdaptiveAllocationPolicy, AdaptiveSlurmJobHandler
+from spikeforest._common.calling_framework import StandardArgs, make_slurm_command, print_per_verbose
+from spikeforest._common.local_process_pool import LocalProcessJobHandler
+from spikeforest.sorters._staging import STAGING_GB_PARAM
+from spikeforest._common.thread_budget import NUM_THREADS_PARAM, CorePool, available_cores, static_num_threads
+from spikeforest._common.trace import TraceRecorder
+
+
+class ResourceClass(NamedTuple):
+    cpus: int = 1
+    gpus: int = 0
+    memory_gb: float = 0
+    # Maximum number of jobs of this class running at once (for slurm: simultaneous allocations).
+    # 0 means use the command-line defaults.
+    max_concurrent: int = 0
+    # Slurm partition for this class; None means use the --slurm-partition value.
+    partition: Union[str, None] = None
+
+def parse_resource_class(spec: Union[Dict[str, Any], None]) -> Union[ResourceClass, None]:
+    """Parses the 'resources' entry of a sorter in the sorter spec file, e.g.
+
+        resources:
+            cpus: 4
+            gpus: 1
+            memory_gb: 32
+            max_concurrent: 2
+            partition: gpu
+
+    Returns None if no resources were declared.
+    """
+    if spec is None: return None
+    unknown = [k for k in spec.keys() if k not in ResourceClass._fields]
+    if len(unknown) > 0:
+        raise Exception(f"Unrecognized resource field(s) {unknown}; known fields are {list(ResourceClass._fields)}.")
+    return ResourceClass(**spec)
+
+def describe_resource_class(resources: ResourceClass) -> str:
+    kind = 'gpu' if resources.gpus > 0 else 'cpu'
+    return f"{kind}-pool(cpus={resources.cpus}, gpus={resources.gpus}, memory_gb={resources.memory_gb})"
+
+def get_timeout_sec(args: StandardArgs) -> Union[float, None]:
+    return None if args['timeout_min'] == 0 else 60 * args['timeout_min']
+
+def make_adaptive_slurm_handler(
+    args: StandardArgs,
+    srun_command: str,
+    max_allocations: int,
+    hither_config: Union[Dict[str, Any], None] = None
+) -> AdaptiveSlurmJobHandler:
+    policy = AdaptiveAllocationPolicy(max_allocations=max_allocations, max_jobs_per_allocation=args['slurm_max_jobs_per_alloc'])
+    make_allocation = lambda jobs_per_allocation: hi.SlurmJobHandler(
+        num_jobs_per_allocation=jobs_per_allocation,
+        max_simultaneous_allocations=1,
+        srun_command=srun_command
+    )
+    return AdaptiveSlurmJobHandler(policy, make_allocation, hither_config)
+
+def make_pool_handler(
+    args: StandardArgs,
+    resources: ResourceClass,
+    hither_config: Union[Dict[str, Any], None] = None,
+    core_pool: Union[CorePool, None] = None
+) -> Any:
+    if args['local_processes'] > 0:
+        return LocalProcessJobHandler(
+            num_workers=resources.max_concurrent or args['local_processes'],
+            timeout_sec=get_timeout_sec(args),
+            threads_per_job=resources.cpus,
+            thread_policy=args['thread_policy'],
+            core_pool=core_pool
+        )
+    if args['use_slurm']:
+        srun_command = make_slurm_command(
+            resources.partition or args['slurm_partition'],
+            args['slurm_exclusive'],
+            gpus_per_node=resources.gpus,
+            cpus_per_task=resources.cpus,
+            memory_gb=resources.memory_gb
+        )
+        if args['slurm_adaptive']:
+            return make_adaptive_slurm_handler(args, srun_command,
+                resources.max_concurrent or args['slurm_max_simultaneous_allocs'], hither_config)
+        return hi.SlurmJobHandler(
+            num_jobs_per_allocation=args['slurm_max_jobs_per_alloc'],
+            max_simultaneous_allocations=resources.max_concurrent or args['slurm_max_simultaneous_allocs'],
+            srun_command=srun_command
+        )
+    # Locally, GPU jobs default to running one at a time rather than competing for the device.
+    default_workers = 1 if resources.gpus > 0 else args['workercount']
+    return hi.ParallelJobHandler(num_workers=resources.max_concurrent or default_workers)
+
+def count_pool_slots(args: StandardArgs, resources: Union[ResourceClass, None]) -> int:
+    """Number of jobs the handler from make_pool_handler (or the default handler, for None) runs at once."""
+    if resources is not None and resources.max_concurrent > 0:
+        if args['use_slurm'] and args['local_processes'] == 0:
+            return resources.max_concurrent * args['slurm_max_jobs_per_alloc']
+        return resources.max_concurrent
+    if args['local_processes'] > 0:
+        return args['local_processes']
+    if args['use_slurm']:
+        return args['slurm_max_jobs_per_alloc'] * args['slurm_max_simultaneous_allocs']
+    if resources is not None and resources.gpus > 0:
+        return 1
+    return args['workercount']
+
+def count_job_threads(args: StandardArgs, resources: Union[ResourceClass, None]) -> int:
+    """Threads per job for the hither handlers, which start jobs on their own: under the throughput
+    policy, the cores of a slurm task (or of this machine) split evenly over the jobs sharing them."""
+    if args['use_slurm']:
+        return static_num_threads(args['thread_policy'], resources.cpus if resources is not None else 1, 1)
+    return static_num_threads(args['thread_policy'], len(available_cores(args['cores'])), count_pool_slots(args, resources))
+
+
+class JobDispatcher:
+    """Routes each job to a job handler pool matching its declared resource class.
+
+    Each distinct ResourceClass gets its own handler (and thus its own concurrency limit), so
+    e.g. GPU sorters and single-threaded CPU sorters no longer compete for the same job slots.
+    Jobs without a declared resource class go to the default handler from extract_hither_config(),
+    or to a LocalProcessJobHandler if --local-processes was set, or to an AdaptiveSlurmJobHandler
+    if --slurm-adaptive was set. hither_config is needed for the latter, which creates its jobs later.
+
+    All local process pools share one CorePool, so that the jobs they pin to cores never overlap.
+    Jobs with a num_threads argument get their thread count from the --thread-policy, and jobs with a
+    staging_gb argument the --staging-gb budget. If a TraceRecorder is given, every job is registered with it.
+    """
+    def __init__(
+        self,
+        args: StandardArgs,
+        default_handler: Any,
+        make_handler: Union[Callable[[StandardArgs, ResourceClass], Any], None] = None,
+        hither_config: Union[Dict[str, Any], None] = None,
+        trace: Union[TraceRecorder, None] = None
+    ) -> None:
+        self._args = args
+        self._trace = trace
+        self._core_pool = CorePool(available_cores(args['cores'])) if args['local_processes'] > 0 else None
+        if args['local_processes'] > 0:
+            default_handler = LocalProcessJobHandler(
+                num_workers=args['local_processes'],
+                timeout_sec=get_timeout_sec(args),
+                thread_policy=args['thread_policy'],
+                core_pool=self._core_pool
+            )
+            self._polled_default_handler = default_handler
+        elif args['use_slurm'] and args['slurm_adaptive']:
+            default_handler = make_adaptive_slurm_handler(args, args['slurm_command'], args['slurm_max_simultaneous_allocs'], hither_config)
+            self._polled_default_handler = default_handler
+        else:
+            self._polled_default_handler = None
+        self._default_handler = default_handler
+        # make_handler can be replaced (e.g. by local stand-in pools) to exercise the routing on its own.
+        self._make_handler = make_handler or (lambda args, resources: make_pool_handler(args, resources, hither_config, self._core_pool))
+        self._pools: Dict[ResourceClass, Any] = {}
+
+    @property
+    def pools(self) -> Dict[ResourceClass, Any]:
+        return dict(self._pools)
+
+    def handler_for(self, resources: Union[ResourceClass, None]) -> Any:
+        if resources is None:
+            return self._default_handler
+        if resources not in self._pools:
+            print_per_verbose(1, f"Creating job handler for {describe_resource_class(resources)}")
+            self._pools[resources] = self._make_handler(self._args, resources)
+        return self._pools[resources]
+
+    def submit(
+        self,
+        fn: Any,
+        kwargs: Dict[str, Any],
+        resources: Union[ResourceClass, None] = None,
+        estimate_sec: float = 0.0
+    ) -> Any:
+        handler = self.handler_for(resources)
+        if STAGING_GB_PARAM in kwargs:
+            kwargs = {**kwargs, STAGING_GB_PARAM: self._args['staging_gb']}
+        if isinstance(handler, LocalProcessJobHandler):
+            # The pool picks the thread count when the job starts
+            job = handler.submit(fn, kwargs, estimate_sec)
+        else:
+            if NUM_THREADS_PARAM in kwargs:
+                kwargs = {**kwargs, NUM_THREADS_PARAM: count_job_threads(self._args, resources)}
+            if isinstance(handler, AdaptiveSlurmJobHandler):
+                job = handler.submit(fn, kwargs, estimate_sec)
+            else:
+                with hi.Config(job_handler=handler):
+                    job = hi.Job(fn, kwargs)
+        if self._trace is not None:
+            self._trace.track_job(getattr(fn, '__name__', 'job'), job)
+        return job
+
+    def _polled_handlers(self) -> List[Any]:
+        handlers = [h for h in self._pools.values() if isinstance(h, (LocalProcessJobHandler, AdaptiveSlurmJobHandler))]
+        if self._polled_default_handler is not None:
+            handlers.append(self._polled_default_handler)
+        return handlers
+
+    def poll(self) -> None:
+        # hither job handlers are driven by hi.wait(); local process pools and adaptive slurm
+        # handlers need to be driven here.
+        for handler in self._polled_handlers():
+            handler.poll()
+
+    def cleanup(self) -> None:
+        # A hither default handler belongs to the caller's hither configuration and is cleaned up with it.
+        for handler in self._pools.values():
+            handler.cleanup()
+        if self._polled_default_handler is not None:
+            self._polled_default_handler.cleanup()
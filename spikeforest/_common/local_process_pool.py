@@ -0,0 +1,253 @@
+import importlib
+import inspect
+import multiprocessing
+import os
+import tempfile
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Union
+
+from spikeforest._common.thread_budget import NUM_THREADS_PARAM, THREAD_POLICY_BENCHMARK, THREAD_POLICY_THROUGHPUT, CorePool, choose_num_threads
+
+# Environment variables which control the size of the thread pools of numerical libraries.
+# (Same set as the num_workers_hook of the sorter wrappers, plus OpenBLAS.)
+THREAD_ENV_VARS = ['NUM_WORKERS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+class LocalJobResult:
+    def __init__(self, return_value: Any = None, error: Union[Exception, None] = None) -> None:
+        self.return_value = return_value
+        self.error = error
+
+
+class LocalJob:
+    """A job run in a local worker process. Exposes the same attributes as a hither Job
+    (status, result, _console_lines, timestamp_started, timestamp_completed), so records can be
+    built from it with the same code (e.g. make_output_record).
+    """
+    def __init__(self, handler: 'LocalProcessJobHandler', fn: Callable, kwargs: Dict[str, Any], estimate_sec: float = 0.0) -> None:
+        self._handler = handler
+        self.fn = fn
+        self.kwargs = kwargs
+        self.estimate_sec = estimate_sec
+        self.status = 'queued'
+        self.result = LocalJobResult()
+        self._console_lines: List[Dict[str, Any]] = []
+        self.timestamp_created = time.time()
+        self.timestamp_started: Union[float, None] = None
+        self.timestamp_completed: Union[float, None] = None
+        # Set by the handler while the job runs
+        self.env: Dict[str, str] = {}
+        self.num_threads = 0
+        self.cores: List[int] = []
+        self._process: Any = None
+        self._connection: Any = None
+        self._console_path: Union[str, None] = None
+
+    @property
+    def function_name(self) -> str:
+        return getattr(self.fn, '__name__', repr(self.fn))
+
+    def is_complete(self) -> bool:
+        return self.status in ['finished', 'error']
+
+    def cancel(self) -> None:
+        self._handler.cancel_job(self)
+
+    def wait(self, timeout: Union[float, None] = None) -> LocalJobResult:
+        timer = time.time()
+        while not self.is_complete():
+            self._handler.poll()
+            if timeout is not None and time.time() - timer > timeout:
+                raise TimeoutError(f'Timed out waiting for local job {self.function_name}')
+            time.sleep(0.1)
+        if self.status == 'error':
+            raise self.result.error
+        return self.result
+
+
+def _find_dependencies(obj: Any) -> List[LocalJob]:
+    if isinstance(obj, LocalJob): return [obj]
+    if isinstance(obj, dict): return [j for v in obj.values() for j in _find_dependencies(v)]
+    if isinstance(obj, (list, tuple)): return [j for v in obj for j in _find_dependencies(v)]
+    return []
+
+def _substitute_results(obj: Any) -> Any:
+    # As in hither, a job passed as an argument to another job is replaced by its return value.
+    if isinstance(obj, LocalJob): return obj.result.return_value
+    if isinstance(obj, dict): return {k: _substitute_results(v) for (k, v) in obj.items()}
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'): return type(obj)(*[_substitute_results(v) for v in obj])
+    if isinstance(obj, (list, tuple)): return type(obj)(_substitute_results(v) for v in obj)
+    return obj
+
+def _run_local_job(module_name: str, function_name: str, kwargs: Dict[str, Any], env: Dict[str, str],
+                   cores: List[int], console_path: str, connection: Any) -> None:
+    # Runs in the worker process. The environment must be set before the function's module
+    # (and thus numpy etc.) is imported for the thread limits to take effect.
+    os.environ.update(env)
+    if len(cores) > 0:
+        # Inherited by the sorter's own subprocesses too
+        os.sched_setaffinity(0, cores)
+    # Redirect at the file-descriptor level so the output of subprocesses is captured too.
+    console_fd = os.open(console_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(console_fd, 1)
+    os.dup2(console_fd, 2)
+    try:
+        module = importlib.import_module(module_name)
+        # The module attribute is the @hi.function-decorated object; run the function it wraps.
+        fn = inspect.unwrap(getattr(module, function_name))
+        return_value = fn(**kwargs)
+        connection.send(('finished', return_value))
+    except BaseException as e:
+        traceback.print_exc()
+        connection.send(('error', f'{type(e).__name__}: {e}'))
+    finally:
+        connection.close()
+
+
+class LocalProcessJobHandler:
+    """Runs jobs in a bounded pool of local worker processes, without containers.
+
+    Each job gets its own process (so it can be killed on timeout or cancellation), with the
+    thread-count environment variables pinned and its console output captured. Jobs are started
+    and reaped by poll(), which the caller drives (see iterate_completed_jobs).
+
+    If a CorePool is given, each job is pinned to cores of its own. Under the throughput thread
+    policy, the number of threads of a job is chosen when it starts, from the free cores (see
+    choose_num_threads), and passed to the job as its num_threads argument if it has one.
+    """
+    def __init__(
+        self,
+        num_workers: int,
+        timeout_sec: Union[float, None] = None,
+        threads_per_job: int = 1,
+        thread_policy: str = THREAD_POLICY_BENCHMARK,
+        core_pool: Union[CorePool, None] = None
+    ) -> None:
+        self._num_workers = max(1, num_workers)
+        self._timeout_sec = timeout_sec
+        self._threads_per_job = threads_per_job
+        self._thread_policy = thread_policy
+        self._core_pool = core_pool
+        self._queued: List[LocalJob] = []
+        self._running: List[LocalJob] = []
+        self._context = multiprocessing.get_context('spawn')
+
+    @property
+    def num_workers(self) -> int:
+        return self._num_workers
+
+    def submit(self, fn: Callable, kwargs: Dict[str, Any], estimate_sec: float = 0.0) -> LocalJob:
+        job = LocalJob(self, fn, kwargs, estimate_sec)
+        self._queued.append(job)
+        return job
+
+    def _thread_env(self, job: LocalJob) -> Dict[str, str]:
+        return {name: str(job.num_threads) for name in THREAD_ENV_VARS}
+
+    def _choose_num_threads(self, job: LocalJob, startable: List[LocalJob]) -> int:
+        # 0 means the job cannot start yet (no free cores)
+        if self._thread_policy != THREAD_POLICY_THROUGHPUT:
+            if self._core_pool is None: return self._threads_per_job
+            # A job asking for more cores than there are gets all of them
+            num_threads = min(self._threads_per_job, self._core_pool.num_cores)
+            return num_threads if self._core_pool.num_free >= num_threads else 0
+        free_cores = self._core_pool.num_free if self._core_pool is not None else (os.cpu_count() or 1)
+        num_startable = min(len(startable), self._num_workers - len(self._running))
+        return choose_num_threads(free_cores, num_startable, job.estimate_sec, [j.estimate_sec for j in startable])
+
+    def _start(self, job: LocalJob, num_threads: int) -> None:
+        job.num_threads = num_threads
+        if self._core_pool is not None:
+            job.cores = self._core_pool.acquire(num_threads)
+        job.env = self._thread_env(job)
+        kwargs = _substitute_results(job.kwargs)
+        if NUM_THREADS_PARAM in kwargs:
+            kwargs[NUM_THREADS_PARAM] = num_threads
+        (fd, job._console_path) = tempfile.mkstemp(prefix='sf_local_job_', suffix='.txt')
+        os.close(fd)
+        (parent_connection, child_connection) = self._context.Pipe(duplex=False)
+        job._connection = parent_connection
+        job._process = self._context.Process(
+            target=_run_local_job,
+            args=(job.fn.__module__, job.fn.__name__, kwargs, job.env, job.cores,
+                  job._console_path, child_connection),
+            daemon=True
+        )
+        job.timestamp_started = time.time()
+        job.status = 'running'
+        job._process.start()
+        child_connection.close()
+        self._running.append(job)
+
+    def _complete(self, job: LocalJob, status: str, return_value: Any = None, error: Union[Exception, None] = None) -> None:
+        job.timestamp_completed = time.time()
+        if self._core_pool is not None and len(job.cores) > 0:
+            self._core_pool.release(job.cores)
+        job.result = LocalJobResult(return_value=return_value, error=error)
+        if job._console_path is not None:
+            with open(job._console_path, errors='replace') as f:
+                job._console_lines = [{'timestamp': job.timestamp_completed, 'text': line.rstrip('\n')} for line in f]
+            os.unlink(job._console_path)
+            job._console_path = None
+        if job._connection is not None:
+            job._connection.close()
+        job.status = status
+
+    def _reap(self, job: LocalJob) -> bool:
+        if job._connection.poll():
+            try:
+                (status, payload) = job._connection.recv()
+            except EOFError:
+                (status, payload) = ('error', 'Worker process exited without returning a result')
+            job._process.join()
+            if status == 'finished':
+                self._complete(job, 'finished', return_value=payload)
+            else:
+                self._complete(job, 'error', error=Exception(payload))
+            return True
+        if not job._process.is_alive():
+            self._complete(job, 'error', error=Exception(f'Worker process exited with code {job._process.exitcode}'))
+            return True
+        if self._timeout_sec is not None and time.time() - job.timestamp_started > self._timeout_sec:
+            job._process.terminate()
+            job._process.join()
+            self._complete(job, 'error', error=Exception(f'Job timed out after {self._timeout_sec} sec'))
+            return True
+        return False
+
+    def poll(self) -> None:
+        self._running = [job for job in self._running if not self._reap(job)]
+        still_queued = []
+        for job in self._queued:
+            dependencies = _find_dependencies(job.kwargs)
+            if any(d.status == 'error' for d in dependencies):
+                self._complete(job, 'error', error=Exception('A job this job depends on errored'))
+            else:
+                still_queued.append(job)
+        self._queued = []
+        startable = [job for job in still_queued if all(d.status == 'finished' for d in _find_dependencies(job.kwargs))]
+        for job in still_queued:
+            num_threads = 0
+            if job in startable and len(self._running) < self._num_workers:
+                num_threads = self._choose_num_threads(job, startable)
+            if num_threads > 0:
+                startable.remove(job)
+                self._start(job, num_threads)
+            else:
+                self._queued.append(job)
+
+    def cancel_job(self, job: LocalJob) -> None:
+        if job in self._queued:
+            self._queued.remove(job)
+        elif job in self._running:
+            job._process.terminate()
+            job._process.join()
+            self._running.remove(job)
+        else:
+            return
+        self._complete(job, 'error', error=Exception('Job cancelled'))
+
+    def cleanup(self) -> None:
+        for job in list(self._queued) + list(self._running):
+            self.cancel_job(job)
@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple, Union
+
+JOB_STATES = ['queued', 'running', 'finished', 'errored']
+
+def _job_state(job: Any) -> str:
+    # hither and local jobs: 'pending'/'queued', 'running', 'finished', 'error'
+    status = job.status
+    if status == 'error': return 'errored'
+    if status in ['running', 'finished']: return status
+    return 'queued'
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _TrackedJob:
+    def __init__(self, sorter: str, job: Any, recording_sec: float) -> None:
+        self.sorter = sorter
+        self.job = job
+        self.recording_sec = recording_sec
+        self.first_seen_running: Union[float, None] = None
+        self.completed: Union[float, None] = None
+
+
+class PipelineMetrics:
+    """Collects the progress of a pipeline run and exposes it in the Prometheus text format,
+    by periodically (atomically) rewriting a file and/or serving it at http://127.0.0.1:<port>/metrics.
+
+    Job states are read from the tracked job objects whenever the metrics are rendered, so callers
+    only need to register jobs (track), cache lookups and downloads.
+    """
+    def __init__(self, path: Union[str, None] = None, port: int = 0, interval_sec: float = 15.0) -> None:
+        self._path = path
+        self._interval_sec = interval_sec
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._jobs: List[_TrackedJob] = []
+        self._cached: Dict[str, int] = {}
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._input_bytes_estimate = 0
+        self._last_completion: Union[float, None] = None
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+        self._server: Union[ThreadingHTTPServer, None] = None
+        if port > 0:
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), self._make_request_handler())
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        if path is not None:
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+
+    def track(self, sorter: str, job: Any, recording_sec: float = 0.0) -> None:
+        with self._lock:
+            self._jobs.append(_TrackedJob(sorter, job, recording_sec))
+
+    def record_cached(self, sorter: str) -> None:
+        with self._lock:
+            self._cached[sorter] = self._cached.get(sorter, 0) + 1
+
+    def record_cache_lookups(self, hits: int, misses: int) -> None:
+        with self._lock:
+            self._cache_hits += hits
+            self._cache_misses += misses
+
+    def record_input_estimate(self, num_bytes: int) -> None:
+        # The size of a recording as estimated from the study set, not bytes actually transferred
+        with self._lock:
+            self._input_bytes_estimate += num_bytes
+
+    def _update(self, now: float) -> None:
+        for t in self._jobs:
+            if t.completed is not None: continue
+            state = _job_state(t.job)
+            if state == 'running' and t.first_seen_running is None:
+                t.first_seen_running = getattr(t.job, 'timestamp_started', None) or now
+            if state in ['finished', 'errored']:
+                t.completed = getattr(t.job, 'timestamp_completed', None) or now
+                self._last_completion = max(self._last_completion or 0, t.completed)
+
+    def render(self) -> str:
+        now = time.time()
+        with self._lock:
+            self._update(now)
+            elapsed = max(now - self._start_time, 1e-9)
+            counts: Dict[Tuple[str, str], int] = {}
+            sorted_sec: Dict[str, float] = {}
+            remaining_sec = 0.0
+            oldest_running = 0.0
+            for t in self._jobs:
+                state = _job_state(t.job)
+                counts[(t.sorter, state)] = counts.get((t.sorter, state), 0) + 1
+                if state == 'finished':
+                    sorted_sec[t.sorter] = sorted_sec.get(t.sorter, 0.0) + t.recording_sec
+                elif state in ['queued', 'running']:
+                    remaining_sec += t.recording_sec
+                if state == 'running' and t.first_seen_running is not None:
+                    oldest_running = max(oldest_running, now - t.first_seen_running)
+            sorters = sorted(set(t.sorter for t in self._jobs) | set(self._cached.keys()))
+            lookups = self._cache_hits + self._cache_misses
+            total_sorted_sec = sum(sorted_sec.values())
+            lines = [
+                '# HELP spikeforest_jobs Sorting jobs of this run, by sorter and state.',
+                '# TYPE spikeforest_jobs gauge'
+            ]
+            for sorter in sorters:
+                for state in JOB_STATES:
+                    lines.append(f'spikeforest_jobs{{sorter="{_escape(sorter)}",state="{state}"}} {counts.get((sorter, state), 0)}')
+                lines.append(f'spikeforest_jobs{{sorter="{_escape(sorter)}",state="cached"}} {self._cached.get(sorter, 0)}')
+            lines += [
+                '# HELP spikeforest_sorter_throughput Recording-seconds sorted per wall-clock second since the start of the run.',
+                '# TYPE spikeforest_sorter_throughput gauge'
+            ]
+            for sorter in sorters:
+                lines.append(f'spikeforest_sorter_throughput{{sorter="{_escape(sorter)}"}} {sorted_sec.get(sorter, 0.0) / elapsed:.6g}')
+            eta = f'{remaining_sec * elapsed / total_sorted_sec:.6g}' if total_sorted_sec > 0 else 'NaN'
+            lines += [
+                '# HELP spikeforest_input_bytes_estimated_total Estimated size of the recordings loaded for the jobs of this run ' +
+                '(channels x duration x sample rate from the study sets; not bytes actually transferred, and 0 where unknown).',
+                '# TYPE spikeforest_input_bytes_estimated_total counter',
+                f'spikeforest_input_bytes_estimated_total {self._input_bytes_estimate}',
+                '# HELP spikeforest_result_cache_lookups_total Sorting result cache lookups, by outcome.',
+                '# TYPE spikeforest_result_cache_lookups_total counter',
+                f'spikeforest_result_cache_lookups_total{{result="hit"}} {self._cache_hits}',
+                f'spikeforest_result_cache_lookups_total{{result="miss"}} {self._cache_misses}',
+                '# HELP spikeforest_result_cache_hit_ratio Fraction of sorting result cache lookups which hit.',
+                '# TYPE spikeforest_result_cache_hit_ratio gauge',
+                f'spikeforest_result_cache_hit_ratio {self._cache_hits / lookups if lookups > 0 else 0:.6g}',
+                '# HELP spikeforest_eta_seconds Projected time to finish the remaining jobs at the throughput so far (NaN until a job finishes).',
+                '# TYPE spikeforest_eta_seconds gauge',
+                f'spikeforest_eta_seconds {eta}',
+                '# HELP spikeforest_oldest_running_job_seconds How long the longest-running job has been running.',
+                '# TYPE spikeforest_oldest_running_job_seconds gauge',
+                f'spikeforest_oldest_running_job_seconds {oldest_running:.6g}',
+                '# HELP spikeforest_last_completion_timestamp_seconds When a job last finished or errored (0 if none has).',
+                '# TYPE spikeforest_last_completion_timestamp_seconds gauge',
+                f'spikeforest_last_completion_timestamp_seconds {self._last_completion or 0:.6f}',
+                '# HELP spikeforest_run_start_timestamp_seconds When this run started.',
+                '# TYPE spikeforest_run_start_timestamp_seconds gauge',
+                f'spikeforest_run_start_timestamp_seconds {self._start_time:.6f}'
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self) -> None:
+        if self._path is None: return
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self._path)
+
+    def _write_loop(self) -> None:
+        while not self._stop.wait(self._interval_sec):
+            try:
+                self.write()
+            except Exception as e:
+                print(f"WARNING: Unable to write pipeline metrics to {self._path}: {e}")
+
+    def _make_request_handler(self) -> Any:
+        metrics = self
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+        return MetricsRequestHandler
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,121 @@
+import re
+import time
+from typing import Any, Callable, Generic, List, NamedTuple, Tuple, TypeVar
+
+FAILURE_TRANSIENT = 'transient'          # worth retrying: the same job may well succeed next time
+FAILURE_DETERMINISTIC = 'deterministic'  # the sorter itself failed; retrying would fail the same way
+
+# Checked in order against the error message and the job's console output.
+TRANSIENT_PATTERNS: List[Tuple[str, str]] = [
+    ('download-timeout', r'(?i)(kachery|load_file|download)[^\n]*(timed? ?out|timeout)|(timed? ?out|timeout)[^\n]*(kachery|load_file|download)'),
+    ('network', r'(?i)connection (reset|refused|aborted)|temporary failure in name resolution|name or service not known|'
+                r'max retries exceeded|remote end closed connection|50[234] (server error|bad gateway|service unavailable|gateway time-?out)'),
+    ('node-failure', r'(?i)node[ _]fail|due to node failure|srun: error: [^\n]*(node failure|lost)|slurmstepd: error: [^\n]*cancelled'),
+    ('container-pull', r'(?i)error pulling image|pull access denied|manifest (for [^\n]* )?unknown|toomanyrequests|failed to pull|'
+                       r'tls handshake timeout')
+]
+DETERMINISTIC_PATTERNS: List[Tuple[str, str]] = [
+    ('job-timeout', r'(?i)job timed out'),
+    ('out-of-memory', r'MemoryError|(?i:out of memory|oom-kill)'),
+    ('cancelled', r'(?i)job cancelled')
+]
+TRANSIENT_EXCEPTION_TYPES = ['TimeoutError', 'ConnectionError', 'ConnectionResetError', 'ConnectionRefusedError',
+                             'ConnectionAbortedError', 'BrokenPipeError', 'timeout']
+DEPENDENCY_ERROR = 'A job this job depends on errored'
+
+class FailureCause(NamedTuple):
+    kind: str    # FAILURE_TRANSIENT or FAILURE_DETERMINISTIC
+    reason: str  # e.g. 'download-timeout', 'sorter-error'
+
+    def __str__(self) -> str:
+        return f'{self.kind}:{self.reason}'
+
+def _console_text(job: Any) -> str:
+    lines = getattr(job, '_console_lines', None) or []
+    return '\n'.join(str(l.get('text', '')) if isinstance(l, dict) else str(l) for l in lines)
+
+def _failed_dependencies(obj: Any) -> List[Any]:
+    # The errored jobs among a job's arguments (local and deferred jobs keep theirs in .kwargs)
+    if hasattr(obj, 'status') and hasattr(obj, 'result'):
+        return [obj] if obj.status == 'error' else []
+    if isinstance(obj, dict): return [j for v in obj.values() for j in _failed_dependencies(v)]
+    if isinstance(obj, (list, tuple)): return [j for v in obj for j in _failed_dependencies(v)]
+    return []
+
+def classify_failure(job: Any) -> FailureCause:
+    """Classifies the failure of an errored job by exception type and by the patterns above; anything
+    unrecognized is taken to be the sorter's own (deterministic) failure. A job which failed because a job
+    it depends on (e.g. the shards of a sharded sorting) failed takes that job's cause."""
+    error = job.result.error if job.result is not None else None
+    message = '' if error is None else str(error)
+    if message == DEPENDENCY_ERROR:
+        dependencies = _failed_dependencies(getattr(job, 'kwargs', {}))
+        if len(dependencies) > 0:
+            causes = [classify_failure(d) for d in dependencies]
+            return next((c for c in causes if c.kind == FAILURE_DETERMINISTIC), causes[0])
+    if error is not None and type(error).__name__ in TRANSIENT_EXCEPTION_TYPES:
+        return FailureCause(FAILURE_TRANSIENT, type(error).__name__)
+    text = f'{type(error).__name__ if error is not None else ""}: {message}\n{_console_text(job)}'
+    for (reason, pattern) in DETERMINISTIC_PATTERNS:
+        if re.search(pattern, message): return FailureCause(FAILURE_DETERMINISTIC, reason)
+    for (reason, pattern) in TRANSIENT_PATTERNS:
+        if re.search(pattern, text): return FailureCause(FAILURE_TRANSIENT, reason)
+    return FailureCause(FAILURE_DETERMINISTIC, 'sorter-error')
+
+
+class RetryPolicy(NamedTuple):
+    max_attempts: int = 3            # including the first; 1 disables retries
+    backoff_sec: float = 60.0        # wait before the second attempt
+    backoff_factor: float = 2.0      # and this many times longer before each one after that
+    max_backoff_sec: float = 1800.0
+
+    def should_retry(self, cause: FailureCause, attempt: int) -> bool:
+        return cause.kind == FAILURE_TRANSIENT and attempt < self.max_attempts
+
+    def delay_sec(self, attempt: int) -> float:
+        return min(self.max_backoff_sec, self.backoff_sec * self.backoff_factor ** (attempt - 1))
+
+
+T = TypeVar('T')
+
+class RetryScheduler(Generic[T]):
+    """Holds the entries (e.g. SortingJobs) whose jobs failed transiently until their backoff has
+    passed, then resubmits them. Used by iterate_completed_jobs.
+
+    Args:
+        policy (RetryPolicy): When and how soon to retry.
+        get_attempt (Callable[[T], int]): The attempt (1 for the first) an entry's job is.
+        resubmit (Callable[[T, FailureCause], T]): Queues the job of an entry again; returns the new entry.
+    """
+    def __init__(self, policy: RetryPolicy, get_attempt: Callable[[T], int], resubmit: Callable[[T, FailureCause], T]) -> None:
+        self._policy = policy
+        self._get_attempt = get_attempt
+        self._resubmit = resubmit
+        self._waiting: List[Tuple[float, T, FailureCause]] = []
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    def schedule(self, entry: T, job: Any) -> bool:
+        """Returns True if the errored job will be retried (so the entry is not final)."""
+        cause = classify_failure(job)
+        attempt = self._get_attempt(entry)
+        if not self._policy.should_retry(cause, attempt): return False
+        self._waiting.append((time.time() + self._policy.delay_sec(attempt), entry, cause))
+        return True
+
+    def due(self) -> List[T]:
+        now = time.time()
+        ready = [(entry, cause) for (at, entry, cause) in self._waiting if at <= now]
+        self._waiting = [w for w in self._waiting if w[0] > now]
+        return [self._resubmit(entry, cause) for (entry, cause) in ready]
+
+
+def get_failure_causes(previous: List[str], job: Any) -> List[str]:
+    # The causes of all failed attempts of a job, including the last one if it failed too
+    if job.status != 'error': return list(previous)
+    return list(previous) + [str(classify_failure(job))]
+
+def is_node_failure(job: Any) -> bool:
+    return job.status == 'error' and classify_failure(job).reason == 'node-failure'
@@ -0,0 +1,56 @@
+import os
+from statistics import mean
+from typing import List
+
+THREAD_POLICY_BENCHMARK = 'benchmark'    # one thread per job, for comparable runtimes
+THREAD_POLICY_THROUGHPUT = 'throughput'  # spread the free cores over the jobs
+THREAD_POLICIES = [THREAD_POLICY_BENCHMARK, THREAD_POLICY_THROUGHPUT]
+
+# Name of the wrapper parameter which receives the thread count (see the MountainSort4 wrapper).
+NUM_THREADS_PARAM = 'num_threads'
+
+def available_cores(limit: int = 0) -> List[int]:
+    """Returns the ids of the cores this process may run on (at most limit of them, if non-zero)."""
+    try:
+        cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = list(range(os.cpu_count() or 1))
+    return cores[:limit] if limit > 0 else cores
+
+class CorePool:
+    """The cores available to the local worker processes, shared by all local job pools so that
+    jobs pinned by different pools do not land on the same cores."""
+    def __init__(self, cores: List[int]) -> None:
+        self._free = list(cores)
+        self.num_cores = len(cores)
+
+    @property
+    def num_free(self) -> int:
+        return len(self._free)
+
+    def acquire(self, n: int) -> List[int]:
+        (taken, self._free) = (self._free[:n], self._free[n:])
+        return taken
+
+    def release(self, cores: List[int]) -> None:
+        self._free = sorted(self._free + cores)
+
+def choose_num_threads(free_cores: int, num_startable: int, estimate_sec: float, startable_estimates: List[float]) -> int:
+    """Number of threads for a job about to start under the throughput policy.
+
+    The free cores are shared among the jobs which can start now (at most one per free worker),
+    in proportion to their estimated runtimes, so that the bigger recordings get more threads;
+    every other startable job keeps at least one core.
+    """
+    if free_cores <= 0: return 0
+    num_startable = max(1, num_startable)
+    fair_share = free_cores / num_startable
+    known = [e for e in startable_estimates if e > 0]
+    weight = estimate_sec / mean(known) if estimate_sec > 0 and len(known) > 0 else 1.0
+    most = free_cores - (num_startable - 1)
+    return max(1, min(most, int(round(fair_share * weight))))
+
+def static_num_threads(policy: str, num_cores: int, num_concurrent_jobs: int) -> int:
+    """Threads per job for job handlers which cannot decide when a job starts (hither handlers)."""
+    if policy == THREAD_POLICY_BENCHMARK: return 1
+    return max(1, num_cores // max(1, num_concurrent_jobs))
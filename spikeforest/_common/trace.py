@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, Generator, List, Tuple, Union
+
+RUNNER_PROCESS = 'runner'
+QUEUE_PROCESS = 'queue wait'
+
+class _TrackedJob:
+    def __init__(self, name: str, job: Any, cat: str) -> None:
+        self.name = name
+        self.job = job
+        self.cat = cat
+        self.submitted = time.time()
+
+def _job_telemetry(job: Any) -> Union[Dict[str, Any], None]:
+    # Sorter wrappers return {'sorting_object': ..., 'telemetry': {...}} (see sorters/_telemetry.py)
+    if job.status != 'finished' or job.result is None: return None
+    value = job.result.return_value
+    if isinstance(value, dict) and isinstance(value.get('telemetry', None), dict): return value['telemetry']
+    return None
+
+def assign_lanes(spans: List[Tuple[float, float]]) -> List[int]:
+    """Packs the (start, end) spans into as few non-overlapping lanes as possible (lane of each span),
+    which recovers one lane per worker slot from the job timestamps alone."""
+    lane_ends: List[float] = []
+    lanes = [0] * len(spans)
+    for i in sorted(range(len(spans)), key=lambda i: spans[i]):
+        (start, end) = spans[i]
+        free = [lane for (lane, lane_end) in enumerate(lane_ends) if lane_end <= start]
+        if len(free) > 0:
+            lanes[i] = free[0]
+            lane_ends[free[0]] = end
+        else:
+            lanes[i] = len(lane_ends)
+            lane_ends.append(end)
+    return lanes
+
+
+class TraceRecorder:
+    """Records a timeline of a run and writes it in the Chrome trace-event format (open it in
+    chrome://tracing or https://ui.perfetto.dev).
+
+    Stages run by the pipeline process itself are recorded as spans on the 'runner' track (see span).
+    Jobs are registered when submitted (track_job) and laid out when the trace is written, from their
+    timestamps and, for sorter jobs, the per-phase telemetry of the wrapper: the wait in the queue,
+    the setup before the first phase (container start, imports) and each phase. Jobs are grouped by
+    the host they ran on, with one track per worker slot (or slurm allocation slot) on that host.
+    """
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._spans: List[Dict[str, Any]] = []
+        self._jobs: List[_TrackedJob] = []
+
+    @contextmanager
+    def span(self, name: str, cat: str = 'runner', args: Union[Dict[str, Any], None] = None) -> Generator[None, None, None]:
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.time(), cat, args)
+
+    def add_span(self, name: str, start: float, end: float, cat: str = 'runner', args: Union[Dict[str, Any], None] = None) -> None:
+        with self._lock:
+            self._spans.append({'name': name, 'start': start, 'end': end, 'cat': cat, 'args': args or {}})
+
+    def track_job(self, name: str, job: Any, cat: str = 'job') -> None:
+        with self._lock:
+            self._jobs.append(_TrackedJob(name, job, cat))
+
+    def label_job(self, job: Any, name: str) -> None:
+        # e.g. to name a sorter job by its sorter and recording once those are known
+        with self._lock:
+            for tracked in self._jobs:
+                if tracked.job is job: tracked.name = name
+
+    def _event(self, name: str, cat: str, start: float, end: float, pid: int, tid: int, args: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+            'ts': round((start - self._start_time) * 1e6), 'dur': max(0, round((end - start) * 1e6)), 'args': args
+        }
+
+    def _job_events(self, tracked: _TrackedJob, pid: int, tid: int, started: float, completed: float) -> List[Dict[str, Any]]:
+        telemetry = _job_telemetry(tracked.job)
+        args: Dict[str, Any] = {'status': tracked.job.status}
+        if tracked.job.status == 'error':
+            args['error'] = str(tracked.job.result.error) if tracked.job.result is not None else ''
+        events = [self._event(tracked.name, tracked.cat, started, completed, pid, tid, args)]
+        phases = [] if telemetry is None else [p for p in telemetry.get('phases', []) if 'start' in p]
+        if len(phases) > 0:
+            first = min(p['start'] for p in phases)
+            if first > started:
+                events.append(self._event('setup', 'phase', started, first, pid, tid, {}))
+            for p in phases:
+                phase_args = {k: v for (k, v) in p.items() if k not in ['name', 'start', 'end']}
+                events.append(self._event(p['name'], 'phase', p['start'], p['end'], pid, tid, phase_args))
+        return events
+
+    def render(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self._spans)
+            jobs = [t for t in self._jobs if getattr(t.job, 'timestamp_started', None) and getattr(t.job, 'timestamp_completed', None)]
+        processes: Dict[str, int] = {RUNNER_PROCESS: 1, QUEUE_PROCESS: 2}
+        threads: Dict[Tuple[int, int], str] = {(1, 0): 'main'}
+        events = [self._event(s['name'], s['cat'], s['start'], s['end'], 1, 0, s['args']) for s in spans]
+
+        waits = [(t.submitted, t.job.timestamp_started) for t in jobs]
+        for (t, (start, end), lane) in zip(jobs, waits, assign_lanes(waits)):
+            events.append(self._event(t.name, 'queue', start, end, 2, lane, {}))
+            threads[(2, lane)] = f'queue slot {lane}'
+
+        hosts: Dict[str, List[_TrackedJob]] = {}
+        for t in jobs:
+            telemetry = _job_telemetry(t.job)
+            host = telemetry.get('hostname', 'unknown host') if telemetry is not None else 'unknown host'
+            hosts.setdefault(host, []).append(t)
+        for (host, host_jobs) in sorted(hosts.items()):
+            pid = processes.setdefault(host, len(processes) + 1)
+            runs = [(t.job.timestamp_started, t.job.timestamp_completed) for t in host_jobs]
+            for (t, (start, end), lane) in zip(host_jobs, runs, assign_lanes(runs)):
+                events += self._job_events(t, pid, lane, start, end)
+                threads[(pid, lane)] = f'worker {lane}'
+
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}} for (name, pid) in processes.items()]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for ((pid, tid), name) in threads.items()]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms',
+                'otherData': {'run_start': self._start_time, 'num_jobs': len(jobs)}}
+
+    def close(self) -> None:
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.render(), f)
+        os.replace(tmp_path, self._path)
+
+
+def maybe_span(trace: Union[TraceRecorder, None], name: str, cat: str = 'runner', args: Union[Dict[str, Any], None] = None) -> ContextManager:
+    # So that callers need not check whether --trace-file was given
+    return nullcontext() if trace is None else trace.span(name, cat, args)
@@ -0,0 +1 @@
+from .ground_truth_comparison import GROUND_TRUTH_COMPARISON_VERSION, GroundTruthComparison, compare_with_ground_truth
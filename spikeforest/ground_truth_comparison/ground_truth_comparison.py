@@ -0,0 +1,211 @@
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+import numpy as np
+
+# Defaults of spikecomparison.GroundTruthComparison (0.3.2), whose results these reproduce.
+DEFAULT_DELTA_TIME_MS = 0.4
+DEFAULT_MATCH_SCORE = 0.5
+DEFAULT_CHANCE_SCORE = 0.1
+# Bump when the results change (e.g. to invalidate metrics cached from them).
+GROUND_TRUTH_COMPARISON_VERSION = '0.2.0'
+
+class GroundTruthComparison(NamedTuple):
+    gt_unit_ids: List[Any]
+    sorted_unit_ids: List[Any]
+    gt_event_counts: np.ndarray      # spikes of each ground truth unit
+    sorted_event_counts: np.ndarray  # spikes of each sorted unit
+    match_counts: np.ndarray         # matching events, ground truth units x sorted units
+    agreement_scores: np.ndarray     # ground truth units x sorted units
+    best_match_12: List[Any]         # best sorted unit of each ground truth unit (-1 if none scores chance_score)
+    best_match_21: List[Any]         # best ground truth unit of each sorted unit (-1 if none)
+    hungarian_match_12: List[Any]    # one-to-one assignment of sorted units to ground truth units (-1 if none)
+    hungarian_match_21: List[Any]
+
+    def get_performance(self) -> List[Dict[str, Any]]:
+        """Per ground truth unit: the counts and rates of its (one-to-one) matched sorted unit. Rates with
+        a zero denominator (e.g. the precision of an unmatched unit) are None."""
+        sorted_index = {u: j for (j, u) in enumerate(self.sorted_unit_ids)}
+        performance = []
+        for (i, gt_unit) in enumerate(self.gt_unit_ids):
+            match = self.hungarian_match_12[i]
+            j = sorted_index.get(match, None)
+            tp = 0 if j is None else int(self.match_counts[i, j])
+            fn = int(self.gt_event_counts[i]) - tp
+            fp = 0 if j is None else int(self.sorted_event_counts[j]) - tp
+            performance.append({
+                'unit_id': gt_unit, 'matched_unit_id': match,
+                'tp': tp, 'fn': fn, 'fp': fp,
+                'accuracy': _ratio(tp, tp + fn + fp),
+                'recall': _ratio(tp, tp + fn),
+                'precision': _ratio(tp, tp + fp),
+                'miss_rate': _ratio(fn, tp + fn),
+                'false_discovery_rate': _ratio(fp, tp + fp)
+            })
+        return performance
+
+    def to_dict(self) -> Dict[str, Any]:
+        # best_match_12/21 and agreement_scores as spikecomparison's Series.to_list() and DataFrame.to_dict() give them
+        return {
+            'best_match_21': self.best_match_21,
+            'best_match_12': self.best_match_12,
+            'agreement_scores': {
+                u2: {u1: float(self.agreement_scores[i, j]) for (i, u1) in enumerate(self.gt_unit_ids)}
+                for (j, u2) in enumerate(self.sorted_unit_ids)
+            },
+            'performance': self.get_performance()
+        }
+
+def _ratio(a: int, b: int) -> Union[float, None]:
+    return None if b == 0 else a / b
+
+def _unit_id(u: Any) -> Any:
+    return u.item() if isinstance(u, np.generic) else u
+
+
+class UnitTrains(NamedTuple):
+    """The spike trains of several units, concatenated: grouped by unit and increasing within each."""
+    times: np.ndarray
+    units: np.ndarray      # unit (0..num_units-1) of each spike
+    num_units: int
+    first: np.ndarray      # whether each spike is the first of its unit
+    last: np.ndarray
+    previous: np.ndarray   # time of the previous spike of the unit (meaningless for the first)
+    following: np.ndarray  # time of the next spike of the unit (meaningless for the last)
+    order: np.ndarray      # the spikes in time order (indices)
+    sorted_times: np.ndarray
+
+def make_unit_trains(trains: List[np.ndarray]) -> UnitTrains:
+    times = np.concatenate([np.sort(t) for t in trains]).astype(np.int64) if len(trains) > 0 else np.zeros(0, dtype=np.int64)
+    units = np.repeat(np.arange(len(trains)), [len(t) for t in trains])
+    first = np.ones(len(times), dtype=bool)
+    first[1:] = units[1:] != units[:-1]
+    last = np.ones(len(times), dtype=bool)
+    last[:-1] = first[1:]
+    order = np.argsort(times, kind='stable')
+    return UnitTrains(times, units, len(trains), first, last, np.roll(times, 1), np.roll(times, -1), order, times[order])
+
+def _spikes_near(trains: UnitTrains, times1: np.ndarray, delta: int) -> np.ndarray:
+    # Indices (increasing) of the spikes of trains at most delta frames from a spike of times1
+    lo = np.searchsorted(trains.sorted_times, times1 - delta, side='left')
+    hi = np.searchsorted(trains.sorted_times, times1 + delta, side='right')
+    lengths = hi - lo
+    starts = np.repeat(lo - (np.cumsum(lengths) - lengths), lengths)
+    return np.unique(trains.order[np.arange(lengths.sum()) + starts])
+
+def count_matches_by_unit(times1: np.ndarray, trains: UnitTrains, delta: int) -> np.ndarray:
+    """Matching events between one spike train (times1, increasing) and each of several others, all at once.
+
+    For each unit, the count is that of spikecomparison's count_matching_events on the two trains:
+    merging them in time order, the neighbouring spikes of different trains at most delta frames apart,
+    with runs of such neighbours (e.g. A B A) counting once. On equal times, spikes of times1 are taken
+    to come first. Only the spikes near one of times1 can be such neighbours, so only those are looked at.
+    """
+    if len(times1) == 0 or len(trains.times) == 0: return np.zeros(trains.num_units, dtype=np.int64)
+    near = _spikes_near(trains, times1, delta)
+    if len(near) == 0: return np.zeros(trains.num_units, dtype=np.int64)
+    (times2, first, last) = (trains.times[near], trains.first[near], trains.last[near])
+    after = np.searchsorted(times1, times2, side='right')  # first spike of times1 merged after this one
+    before = after - 1
+    # A spike of times1 merged just before this one: its neighbour pair ends here
+    a_before = times1[np.maximum(before, 0)]
+    pair_ending = (before >= 0) & (first | (a_before > trains.previous[near])) & (times2 - a_before <= delta)
+    # A spike of times1 merged just after this one: its neighbour pair starts here
+    a_after = times1[np.minimum(after, len(times1) - 1)]
+    pair_starting = (after < len(times1)) & (last | (a_after <= trains.following[near])) & (a_after - times2 <= delta)
+    per_spike = pair_ending.astype(np.int64) + pair_starting
+    # Adjacent pairs count once: those sharing this spike, and those sharing the times1 spike between
+    # this one and the next of its unit.
+    per_spike -= pair_ending & pair_starting
+    next_of_unit = (near[1:] == near[:-1] + 1) & ~last[:-1]
+    per_spike[:-1] -= pair_starting[:-1] & pair_ending[1:] & next_of_unit & (after[:-1] == before[1:])
+    return np.bincount(trains.units[near], weights=per_spike, minlength=trains.num_units).astype(np.int64)
+
+def make_match_count_matrix(gt_trains: List[np.ndarray], sorted_trains: List[np.ndarray], delta: int) -> np.ndarray:
+    counts = np.zeros((len(gt_trains), len(sorted_trains)), dtype=np.int64)
+    if len(sorted_trains) == 0: return counts
+    trains = make_unit_trains(sorted_trains)
+    for (i, train) in enumerate(gt_trains):
+        counts[i, :] = count_matches_by_unit(np.sort(train).astype(np.int64), trains, delta)
+    return counts
+
+def make_agreement_scores(match_counts: np.ndarray, counts1: np.ndarray, counts2: np.ndarray) -> np.ndarray:
+    # matches / (spikes of either unit, counting matched spikes once)
+    union = counts1[:, None] + counts2[None, :] - match_counts
+    return np.where(union > 0, match_counts / np.maximum(union, 1), 0.0)
+
+def make_best_match(scores: np.ndarray, unit1_ids: List[Any], unit2_ids: List[Any], min_score: float) -> Tuple[List[Any], List[Any]]:
+    def best(rows: np.ndarray, ids: List[Any]) -> List[Any]:
+        if rows.shape[1] == 0: return [-1] * rows.shape[0]
+        ind = np.argmax(rows, axis=1)
+        return [ids[k] if rows[r, k] >= min_score else -1 for (r, k) in enumerate(ind)]
+    return (best(scores, unit2_ids), best(scores.T, unit1_ids))
+
+def _assign(scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    try:
+        # import within function so that scipy stays optional
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        # Without scipy: highest scores first, each unit used once (not optimal when units compete for a match)
+        (rows, cols) = np.unravel_index(np.argsort(-scores, axis=None, kind='stable'), scores.shape)
+        pairs: List[Tuple[int, int]] = []
+        (used1, used2) = (set(), set())
+        for (r, c) in zip(rows, cols):
+            if r in used1 or c in used2: continue
+            pairs.append((r, c))
+            used1.add(r)
+            used2.add(c)
+        return (np.array([r for (r, _) in pairs], dtype=int), np.array([c for (_, c) in pairs], dtype=int))
+    return linear_sum_assignment(-scores)
+
+def make_hungarian_match(scores: np.ndarray, unit1_ids: List[Any], unit2_ids: List[Any], min_score: float) -> Tuple[List[Any], List[Any]]:
+    match_12: List[Any] = [-1] * len(unit1_ids)
+    match_21: List[Any] = [-1] * len(unit2_ids)
+    if scores.size == 0: return (match_12, match_21)
+    # As spikecomparison: scores below min_score do not count towards the assignment
+    thresholded = np.where(scores < min_score, 0.0, scores)
+    (inds1, inds2) = _assign(thresholded)
+    for (i1, i2) in zip(inds1, inds2):
+        if scores[i1, i2] >= min_score:
+            match_12[i1] = unit2_ids[i2]
+            match_21[i2] = unit1_ids[i1]
+    return (match_12, match_21)
+
+
+def compare_with_ground_truth(
+    gt_sorting: Any,
+    sorting: Any,
+    delta_time_ms: float = DEFAULT_DELTA_TIME_MS,
+    match_score: float = DEFAULT_MATCH_SCORE,
+    chance_score: float = DEFAULT_CHANCE_SCORE
+) -> GroundTruthComparison:
+    """Compares a sorting with the ground truth sorting of the same recording, as
+    spikecomparison.GroundTruthComparison does, with the events of all sorted units matched together.
+
+    Args:
+        gt_sorting, sorting: Sorting extractors (get_unit_ids, get_unit_spike_train, get_sampling_frequency).
+        delta_time_ms (float): Spikes at most this far apart match.
+        match_score (float): Lowest agreement score at which two units are matched one-to-one.
+        chance_score (float): Lowest agreement score of a best match (best_match_12/21).
+    """
+    delta = int(delta_time_ms / 1000 * gt_sorting.get_sampling_frequency())
+    gt_unit_ids = [_unit_id(u) for u in gt_sorting.get_unit_ids()]
+    sorted_unit_ids = [_unit_id(u) for u in sorting.get_unit_ids()]
+    gt_trains = [np.asarray(gt_sorting.get_unit_spike_train(unit_id=u)) for u in gt_unit_ids]
+    sorted_trains = [np.asarray(sorting.get_unit_spike_train(unit_id=u)) for u in sorted_unit_ids]
+    gt_counts = np.array([len(t) for t in gt_trains], dtype=np.int64)
+    sorted_counts = np.array([len(t) for t in sorted_trains], dtype=np.int64)
+    match_counts = make_match_count_matrix(gt_trains, sorted_trains, delta)
+    scores = make_agreement_scores(match_counts, gt_counts, sorted_counts)
+    (best_12, best_21) = make_best_match(scores, gt_unit_ids, sorted_unit_ids, chance_score)
+    (hungarian_12, hungarian_21) = make_hungarian_match(scores, gt_unit_ids, sorted_unit_ids, match_score)
+    return GroundTruthComparison(
+        gt_unit_ids         = gt_unit_ids,
+        sorted_unit_ids     = sorted_unit_ids,
+        gt_event_counts     = gt_counts,
+        sorted_event_counts = sorted_counts,
+        match_counts        = match_counts,
+        agreement_scores    = scores,
+        best_match_12       = best_12,
+        best_match_21       = best_21,
+        hungarian_match_12  = hungarian_12,
+        hungarian_match_21  = hungarian_21
+    )
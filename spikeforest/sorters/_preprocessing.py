@@ -0,0 +1,86 @@
+import os
+import shutil
+import hither2 as hi
+import kachery_cloud as kc
+from spikeforest.sorters._staging import local_data_hook
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+# Also keys the preprocessing cache (see preprocessing_cache), so that a new version is materialized anew.
+PREPROCESSING_VERSION = '0.2.0'
+
+class num_workers_hook(hi.RuntimeHook):
+    def precontainer(self, context: hi.PreContainerContext):
+        context.set_env('NUM_WORKERS', '1')
+        context.set_env('MKL_NUM_THREADS', '1')
+        context.set_env('NUMEXPR_NUM_THREADS', '1')
+        context.set_env('OMP_NUM_THREADS', '1')
+
+class output_dir_hook(hi.RuntimeHook):
+    def precontainer(self, context: hi.PreContainerContext):
+        output_path = context.kwargs.get('output_path', '')
+        if output_path == '': return
+        output_dir = os.path.dirname(output_path)
+        os.makedirs(output_dir, exist_ok=True)
+        context.add_bind_mount(hi.BindMount(source=output_dir, target=output_dir, read_only=False))
+
+# Uses the MountainSort4 image, which has the same spiketoolkit version as the sorter wrappers,
+# so that the materialized recording matches what the wrappers would have computed themselves.
+@hi.function(
+    'preprocess_recording_wrapper1', PREPROCESSING_VERSION,
+    image=hi.DockerImageFromScript(name='magland/mountainsort4', dockerfile=f'{thisdir}/mountainsort4/docker/Dockerfile'),
+    modules=['sortingview', 'spikeforest'],
+    kachery_support=True,
+    runtime_hooks=[num_workers_hook(), output_dir_hook(), local_data_hook()]
+)
+def preprocess_recording_wrapper1(
+    recording_object: dict,
+    filter=True,
+    freq_min=300,
+    freq_max=6000,
+    whiten=True,
+    output_path=''
+) -> dict:
+    """Bandpass-filters and/or whitens a recording (exactly as mountainsort4_wrapper1 does), writes
+    the result as float32 MDA to output_path or, if none is given, stores it in kachery.
+
+    Returns:
+        dict: An MDA recording object for the preprocessed data, which the sorter wrappers can
+        load like any other recording object.
+    """
+    import sortingview as sv
+    import spikeextractors as se
+    import spiketoolkit as st
+
+    recording = sv.LabboxEphysRecordingExtractor(recording_object)
+    if filter:
+        recording = st.preprocessing.bandpass_filter(
+            recording=recording,
+            freq_min=freq_min,
+            freq_max=freq_max,
+            chunk_size=int(recording.get_sampling_frequency() * 30),
+            cache_chunks=False
+        )
+    if whiten:
+        recording = st.preprocessing.whiten(
+            recording=recording,
+            chunk_size=int(recording.get_sampling_frequency() * 30),
+            cache_chunks=False,
+            seed=1
+        )
+    with kc.TemporaryDirectory(prefix='tmp_preprocess') as tmpdir:
+        se.MdaRecordingExtractor.write_recording(recording=recording, save_path=tmpdir, dtype='float32')
+        if output_path == '':
+            raw_uri = kc.store_file(f'{tmpdir}/raw.mda', label='raw.mda')
+        else:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            shutil.move(f'{tmpdir}/raw.mda', f'{output_path}.tmp')
+            os.replace(f'{output_path}.tmp', output_path)
+            raw_uri = output_path
+    return {
+        'recording_format': 'mda',
+        'data': {
+            'raw': raw_uri,
+            'geom': [list(map(float, location)) for location in recording.get_channel_locations()],
+            'params': {'samplerate': recording.get_sampling_frequency()}
+        }
+    }
@@ -0,0 +1,146 @@
+from contextlib import ExitStack, contextmanager
+import fcntl
+import hashlib
+import os
+import shutil
+from typing import Any, Iterator, List, Union
+import hither2 as hi
+import kachery_cloud as kc
+
+# Name of the wrapper parameter which receives the staging budget, in GB (0: no staging).
+STAGING_GB_PARAM = 'staging_gb'
+STAGING_DIR_ENV = 'SPIKEFOREST_STAGING_DIR'
+
+def get_staging_dir() -> str:
+    return os.environ.get(STAGING_DIR_ENV, os.path.join(os.environ.get('TMPDIR', '/tmp'), 'spikeforest-staging'))
+
+class staging_dir_hook(hi.RuntimeHook):
+    def precontainer(self, context: hi.PreContainerContext):
+        # The staging directory of the node (not one inside each container), so that containerized jobs on
+        # the node share their staged copies and eviction sees all of them.
+        if context.kwargs.get(STAGING_GB_PARAM, 0) <= 0: return
+        staging_dir = os.path.abspath(get_staging_dir())
+        os.makedirs(staging_dir, exist_ok=True)
+        context.add_bind_mount(hi.BindMount(source=staging_dir, target=staging_dir, read_only=False))
+        context.set_env(STAGING_DIR_ENV, staging_dir)
+
+def _local_raw_paths(recording_object: Any) -> List[str]:
+    if not isinstance(recording_object, dict): return []
+    if 'raw' in recording_object:
+        raw = recording_object['raw']
+        return [raw] if isinstance(raw, str) and os.path.isabs(raw) else []
+    recording_format = recording_object.get('recording_format', None)
+    data = recording_object.get('data', {})
+    if recording_format == 'mda':
+        return _local_raw_paths({'raw': data['raw']})
+    if recording_format == 'subrecording':
+        return _local_raw_paths(data['recording'])
+    return []
+
+class local_data_hook(hi.RuntimeHook):
+    def precontainer(self, context: hi.PreContainerContext):
+        # Recording objects may refer to local files rather than kachery URIs (e.g. preprocessed
+        # recordings in the preprocessing cache's directory), which the container needs to see.
+        for path in _local_raw_paths(context.kwargs.get('recording_object', None)):
+            dirname = os.path.dirname(path)
+            context.add_bind_mount(hi.BindMount(source=dirname, target=dirname, read_only=True))
+
+def _staged_files(staging_dir: str) -> List[os.DirEntry]:
+    return [e for e in os.scandir(staging_dir)
+                if not e.name.startswith('.') and not e.name.endswith('.lock') and not e.name.endswith('.tmp')]
+
+def _evict(staging_dir: str, needed_bytes: int, max_bytes: int) -> bool:
+    # Removes the least recently used copies not in use until needed_bytes more fit in max_bytes.
+    # Hardlinks take no space of their own and are neither counted nor evicted.
+    # Must be called with the directory lock held. Returns whether the bytes fit.
+    copies = []
+    for entry in _staged_files(staging_dir):
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        if st.st_nlink == 1:
+            copies.append((st.st_mtime, entry.path, st.st_size))
+    total = sum(size for (_, _, size) in copies)
+    for (_, path, size) in sorted(copies):
+        if total + needed_bytes <= max_bytes: break
+        with open(f'{path}.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue # in use by a running job
+            os.remove(path)
+            total -= size
+    return total + needed_bytes <= max_bytes
+
+def _copy_into(source_path: str, staged_path: str, max_bytes: int) -> bool:
+    try:
+        os.link(source_path, staged_path)
+        return True
+    except OSError:
+        pass # e.g. on another filesystem, which is the point of staging
+    staging_dir = os.path.dirname(staged_path)
+    size = os.path.getsize(source_path)
+    # Copies are made one at a time per node, so that concurrent jobs cannot overrun the budget together.
+    with open(os.path.join(staging_dir, '.lock'), 'a') as dir_lock:
+        fcntl.flock(dir_lock, fcntl.LOCK_EX)
+        if not _evict(staging_dir, size, max_bytes) or shutil.disk_usage(staging_dir).free < size:
+            return False
+        tmp_path = f'{staged_path}.{os.getpid()}.tmp'
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, staged_path)
+    return True
+
+def stage_file(source_path: str, key: str, max_bytes: int, held: ExitStack) -> Union[str, None]:
+    """Returns the path of a node-local copy (or hardlink) of the file, staging it first if no job on this
+    node has; None if it does not fit in the staging budget. The copy is kept from eviction (by a shared
+    lock) until held is closed."""
+    staging_dir = get_staging_dir()
+    os.makedirs(staging_dir, exist_ok=True)
+    staged_path = os.path.join(staging_dir, key)
+    lock_file = open(f'{staged_path}.lock', 'a')
+    # Another job staging the same file finishes first; this one then uses its copy.
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        if not os.path.exists(staged_path) and not _copy_into(source_path, staged_path, max_bytes):
+            lock_file.close()
+            return None
+        os.utime(staged_path) # the modification time orders the eviction
+    finally:
+        if not lock_file.closed:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+    held.enter_context(lock_file)
+    return staged_path
+
+def _stage_uri(uri: str, max_bytes: int, held: ExitStack) -> str:
+    source_path = uri if os.path.isabs(uri) else kc.load_file(uri)
+    if source_path is None: return uri
+    key = hashlib.sha1(uri.encode()).hexdigest() + os.path.splitext(source_path)[1]
+    staged_path = stage_file(source_path, key, max_bytes, held)
+    if staged_path is None:
+        print(f'Not staging {uri}: it does not fit in the staging budget.')
+        return uri
+    return staged_path
+
+def _stage_object(recording_object: Any, max_bytes: int, held: ExitStack) -> Any:
+    if 'raw' in recording_object:
+        return {**recording_object, 'raw': _stage_uri(recording_object['raw'], max_bytes, held)}
+    recording_format = recording_object.get('recording_format', None)
+    data = recording_object.get('data', {})
+    if recording_format == 'mda':
+        return {**recording_object, 'data': {**data, 'raw': _stage_uri(data['raw'], max_bytes, held)}}
+    if recording_format == 'subrecording':
+        return {**recording_object, 'data': {**data, 'recording': _stage_object(data['recording'], max_bytes, held)}}
+    return recording_object
+
+@contextmanager
+def stage_recording_object(recording_object: Any, staging_gb: float) -> Iterator[Any]:
+    """Gives the recording object with its raw data file replaced by a node-local copy (see stage_file),
+    which is kept from eviction until the with block exits; unchanged if staging_gb is 0 or the recording
+    has no raw data file. Under --use-container, the wrapper needs staging_dir_hook among its runtime hooks
+    for the copy to be on the node rather than in the container."""
+    with ExitStack() as held:
+        if staging_gb <= 0 or not isinstance(recording_object, dict):
+            yield recording_object
+        else:
+            yield _stage_object(recording_object, int(staging_gb * 1e9), held)
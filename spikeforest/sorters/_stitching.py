@@ -0,0 +1,125 @@
+import os
+from typing import Any, Dict, List
+import hither2 as hi
+from spikeforest.sorters._staging import local_data_hook
+from spikeforest.sorters._telemetry import SorterTelemetry, make_sorter_result, unpack_sorter_result
+
+thisdir = os.path.dirname(os.path.realpath(__file__))
+
+def count_matching_events(train1: Any, train2: Any, window: int) -> int:
+    # Number of events of train1 with an event of train2 within +/- window samples (trains sorted).
+    import numpy as np
+    if len(train1) == 0 or len(train2) == 0: return 0
+    indices = np.searchsorted(train2, train1)
+    before = train2[np.clip(indices - 1, 0, len(train2) - 1)]
+    after = train2[np.clip(indices, 0, len(train2) - 1)]
+    nearest = np.minimum(np.abs(train1 - before), np.abs(after - train1))
+    return int(np.sum(nearest <= window))
+
+def spike_train_agreement(train1: Any, train2: Any, window: int) -> float:
+    matches = min(count_matching_events(train1, train2, window), len(train2))
+    total = len(train1) + len(train2) - matches
+    return 0.0 if total == 0 else matches / total
+
+def merge_shard_telemetry(shard_telemetries: List[Any], stitch_telemetry: Dict[str, Any]) -> Dict[str, Any]:
+    # Totals are summed over the shard jobs and the stitch job; phases are kept per shard.
+    parts = [t for t in shard_telemetries if t is not None] + [stitch_telemetry]
+    return {
+        **stitch_telemetry,
+        'cpu_user_sec': sum(t['cpu_user_sec'] for t in parts),
+        'cpu_sys_sec': sum(t['cpu_sys_sec'] for t in parts),
+        'cpu_sec': sum(t['cpu_sec'] for t in parts),
+        'read_bytes': sum(t['read_bytes'] for t in parts),
+        'write_bytes': sum(t['write_bytes'] for t in parts),
+        'peak_rss_bytes': max(t['peak_rss_bytes'] for t in parts),
+        'phases': [{**p, 'shard': i} for (i, t) in enumerate(shard_telemetries) if t is not None for p in t['phases']] +
+                  stitch_telemetry['phases'],
+        'num_shards': len(shard_telemetries)
+    }
+
+def stitch_sortings(recording: Any, sortings: List[Any], shards: list, agreement_threshold: float, window: int,
+                    max_spikes_per_unit: int) -> Any:
+    """Merges the sortings of the shards of a recording (see stitch_shard_sortings_wrapper1). The shards hold
+    channel ids of the recording (as from recording.get_channel_ids()), not channel indices."""
+    import numpy as np
+    import spikeextractors as se
+    import spiketoolkit as st
+
+    recording_channel_ids = set(int(c) for c in recording.get_channel_ids())
+    candidates = []
+    for (sorting, (channel_ids, core_channel_ids)) in zip(sortings, shards):
+        unknown = [c for c in channel_ids if c not in recording_channel_ids]
+        if len(unknown) > 0:
+            raise Exception(f'Shard channels {unknown} are not channel ids of the recording ({sorted(recording_channel_ids)}).')
+        unit_ids = sorting.get_unit_ids()
+        if len(unit_ids) == 0: continue
+        subrecording = se.SubRecordingExtractor(recording, channel_ids=list(channel_ids))
+        # The peak channels are channel ids of the subrecording, which are those of the recording.
+        peak_channels = st.postprocessing.get_unit_max_channels(
+            subrecording, sorting, unit_ids=unit_ids, max_spikes_per_unit=max_spikes_per_unit, seed=0)
+        core = set(core_channel_ids)
+        for (unit_id, peak_channel) in zip(unit_ids, peak_channels):
+            if int(peak_channel) in core:
+                candidates.append((np.sort(np.array(sorting.get_unit_spike_train(unit_id=unit_id))), set(channel_ids)))
+    candidates.sort(key=lambda c: len(c[0]), reverse=True)
+    kept = []
+    for (train, channel_ids) in candidates:
+        # Only units sharing channels can be duplicates.
+        if any(len(channel_ids & other_channels) > 0 and spike_train_agreement(train, other, window) >= agreement_threshold
+                for (other, other_channels) in kept):
+            continue
+        kept.append((train, channel_ids))
+    times = np.concatenate([train for (train, _) in kept]) if len(kept) > 0 else np.array([], dtype=np.int64)
+    labels = np.concatenate([np.full(len(train), i + 1) for (i, (train, _)) in enumerate(kept)]) if len(kept) > 0 \
+        else np.array([], dtype=np.int64)
+    order = np.argsort(times, kind='stable')
+    merged = se.NumpySortingExtractor()
+    merged.set_times_labels(times=times[order], labels=labels[order])
+    merged.set_sampling_frequency(recording.get_sampling_frequency())
+    print(f'Stitched {len(kept)} units from {len(candidates)} candidates in {len(shards)} shards')
+    return merged
+
+@hi.function(
+    'stitch_shard_sortings_wrapper1', '0.1.0',
+    image=hi.DockerImageFromScript(name='magland/mountainsort4', dockerfile=f'{thisdir}/mountainsort4/docker/Dockerfile'),
+    modules=['sortingview', 'spikeforest'],
+    kachery_support=True,
+    runtime_hooks=[local_data_hook()]
+)
+def stitch_shard_sortings_wrapper1(
+    recording_object: dict,
+    shard_results: list,
+    shards: list,
+    agreement_threshold=0.5,
+    match_window_ms=0.4,
+    max_spikes_per_unit=200
+) -> dict:
+    """Merges the sortings of the shards of a recording into one sorting.
+
+    A unit is kept by the shard in whose core channels its peak channel lies, so units found on a
+    shard's guard channels are left to the neighbouring shard. Units which are still found twice
+    (peak channel on a boundary) are deduplicated by spike train agreement, keeping the larger unit.
+
+    Args:
+        recording_object (dict): The recording that was sharded.
+        shard_results (list): The return values of the sorter wrapper, one per shard.
+        shards (list): The shards, as (channel_ids, core_channel_ids) pairs of channel ids.
+    """
+    telemetry = SorterTelemetry()
+    import sortingview as sv
+
+    with telemetry.phase('load'):
+        recording = sv.LabboxEphysRecordingExtractor(recording_object)
+        samplerate = recording.get_sampling_frequency()
+        unpacked = [unpack_sorter_result(r) for r in shard_results]
+        sortings = [sv.LabboxEphysSortingExtractor(sorting_object, samplerate=samplerate) for (sorting_object, _) in unpacked]
+
+    with telemetry.phase('stitch'):
+        window = int(samplerate * match_window_ms / 1000)
+        merged = stitch_sortings(recording, sortings, shards, agreement_threshold, window, max_spikes_per_unit)
+
+    with telemetry.phase('store'):
+        sorting_object = sv.LabboxEphysSortingExtractor.store_sorting(sorting=merged).object()
+    result = make_sorter_result(sorting_object, telemetry)
+    result['telemetry'] = merge_shard_telemetry([t for (_, t) in unpacked], result['telemetry'])
+    return result
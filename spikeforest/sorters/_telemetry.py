@@ -0,0 +1,116 @@
+import resource
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Generator, List, Tuple, Union
+
+
+def _read_proc_io() -> Dict[str, int]:
+    # /proc/self/io also accounts for child processes once they have been waited for,
+    # which covers sorters run through kc.ShellScript / spikesorters.
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                (key, value) = line.split(':')
+                io[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+    return io
+
+def _maxrss_bytes(usage: resource.struct_rusage) -> int:
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+class _Snapshot:
+    def __init__(self) -> None:
+        self.time = time.time()
+        self.self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = _read_proc_io()
+
+    def user_sec(self) -> float:
+        return self.self_usage.ru_utime + self.child_usage.ru_utime
+
+    def sys_sec(self) -> float:
+        return self.self_usage.ru_stime + self.child_usage.ru_stime
+
+    def io_bytes(self, key: str, fallback_blocks: int) -> int:
+        if key in self.io: return self.io[key]
+        return fallback_blocks * 512
+
+    def read_bytes(self) -> int:
+        return self.io_bytes('read_bytes', self.self_usage.ru_inblock + self.child_usage.ru_inblock)
+
+    def write_bytes(self) -> int:
+        return self.io_bytes('write_bytes', self.self_usage.ru_oublock + self.child_usage.ru_oublock)
+
+def _difference(start: _Snapshot, end: _Snapshot) -> Dict[str, Any]:
+    return {
+        'start': start.time,
+        'end': end.time,
+        'wall_sec': end.time - start.time,
+        'cpu_user_sec': end.user_sec() - start.user_sec(),
+        'cpu_sys_sec': end.sys_sec() - start.sys_sec(),
+        'cpu_sec': (end.user_sec() + end.sys_sec()) - (start.user_sec() + start.sys_sec()),
+        'read_bytes': end.read_bytes() - start.read_bytes(),
+        'write_bytes': end.write_bytes() - start.write_bytes(),
+        # bytes passed through read()/write() calls, including those served from the page cache
+        'read_chars': end.io.get('rchar', 0) - start.io.get('rchar', 0),
+        'write_chars': end.io.get('wchar', 0) - start.io.get('wchar', 0)
+    }
+
+
+class SorterTelemetry:
+    """Measures the resources used by a sorter wrapper, overall and per phase.
+
+    CPU times include child processes (sorters launched as subprocesses) once they have exited.
+    Usage:
+        telemetry = SorterTelemetry()
+        with telemetry.phase('load'):
+            ...
+        return make_sorter_result(sorting_object, telemetry)
+    """
+    def __init__(self) -> None:
+        self._start = _Snapshot()
+        self._phases: List[Dict[str, Any]] = []
+        self._extra: Dict[str, Any] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        start = _Snapshot()
+        try:
+            yield
+        finally:
+            self._phases.append({'name': name, **_difference(start, _Snapshot())})
+
+    def phase_elapsed(self, name: str) -> float:
+        return sum(p['wall_sec'] for p in self._phases if p['name'] == name)
+
+    def set(self, key: str, value: Any) -> None:
+        self._extra[key] = value
+
+    def as_dict(self) -> Dict[str, Any]:
+        end = _Snapshot()
+        return {
+            **_difference(self._start, end),
+            'peak_rss_bytes': max(_maxrss_bytes(end.self_usage), _maxrss_bytes(end.child_usage)),
+            'hostname': socket.gethostname(),
+            'phases': list(self._phases),
+            **self._extra
+        }
+
+def make_sorter_result(sorting_object: dict, telemetry: SorterTelemetry) -> dict:
+    return {
+        'sorting_object': sorting_object,
+        'telemetry': telemetry.as_dict()
+    }
+
+def unpack_sorter_result(result: Any) -> Tuple[dict, Union[Dict[str, Any], None]]:
+    """Splits the return value of a sorter wrapper into (sorting object, telemetry).
+    Results from wrapper versions that predate telemetry are plain sorting objects (telemetry None).
+    """
+    if isinstance(result, dict) and 'sorting_object' in result:
+        return (result['sorting_object'], result.get('telemetry', None))
+    return (result, None)
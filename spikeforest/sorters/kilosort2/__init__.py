@@ -1 +1 @@
-from .kilosort2_wrapper1 import kilosort2_wrapper1
\ No newline at end of file
+from .kilosort2_wrapper1 import KILOSORT2_WRAPPER1_VERSION, kilosort2_wrapper1
\ No newline at end of file
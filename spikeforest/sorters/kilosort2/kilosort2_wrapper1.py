@@ -3,17 +3,19 @@ from typing import Dict, List
 import hither2 as hi
 import kachery_cloud as kc
 from spikeforest.sorters._matlab_license_hook import matlab_license_hook
+from spikeforest.sorters._telemetry import SorterTelemetry, make_sorter_result
 
 expected_kilosort2_commit = '1a030bf8ca460899dfc0294005f2f971cf63c9e7'
         
 thisdir = os.path.dirname(os.path.realpath(__file__))
+KILOSORT2_WRAPPER1_VERSION = '0.2.0'
 image = hi.DockerImageFromScript(
     name='magland/kilosort2',
     dockerfile=f'{thisdir}/docker/Dockerfile'
 )
 
 @hi.function(
-    'kilosort2_wrapper1', '0.1.1',
+    'kilosort2_wrapper1', KILOSORT2_WRAPPER1_VERSION,
     image=image,
     modules=['sortingview', 'spikeforest'],
     kachery_support=True,
@@ -23,6 +25,7 @@ image = hi.DockerImageFromScript(
 def kilosort2_wrapper1(
     recording_object: dict,
 ) -> dict:
+    telemetry = SorterTelemetry()
     import sortingview as sv
 
     with kc.TemporaryDirectory(prefix='tmp_kilosort2') as tmpdir:
@@ -78,7 +81,8 @@ def kilosort2_wrapper1(
             raise Exception(f'Git repo not at the expected commit: {expected_kilosort2_commit}')
         ######################################################################################################################################################
 
-        recording = sv.LabboxEphysRecordingExtractor(recording_object)
+        with telemetry.phase('load'):
+            recording = sv.LabboxEphysRecordingExtractor(recording_object)
         
         # Sorting
         print('Sorting...')
@@ -90,8 +94,11 @@ def kilosort2_wrapper1(
 
         sorter.set_params(
         )     
-        timer = sorter.run()
-        print('#SF-SORTER-RUNTIME#{:.3f}#'.format(timer))
-        sorting = sorter.get_result()
+        with telemetry.phase('sort'):
+            sorter.run()
+            sorting = sorter.get_result()
+        print('#SF-SORTER-RUNTIME#{:.3f}#'.format(telemetry.phase_elapsed('sort')))
 
-        return sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+        with telemetry.phase('store'):
+            sorting_object = sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+        return make_sorter_result(sorting_object, telemetry)
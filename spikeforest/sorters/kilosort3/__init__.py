@@ -1 +1 @@
-from .kilosort3_wrapper1 import kilosort3_wrapper1
\ No newline at end of file
+from .kilosort3_wrapper1 import KILOSORT3_WRAPPER1_VERSION, kilosort3_wrapper1
\ No newline at end of file
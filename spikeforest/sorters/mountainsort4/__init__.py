@@ -1 +1 @@
-from .mountainsort4_wrapper1 import mountainsort4_wrapper1
\ No newline at end of file
+from .mountainsort4_wrapper1 import MOUNTAINSORT4_WRAPPER1_VERSION, mountainsort4_wrapper1
\ No newline at end of file
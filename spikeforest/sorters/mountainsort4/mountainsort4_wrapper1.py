@@ -1,25 +1,29 @@
+from contextlib import ExitStack
 import os
-import time
 import hither2 as hi
 import kachery_cloud as kc
+from spikeforest.sorters._staging import local_data_hook, stage_recording_object, staging_dir_hook
+from spikeforest.sorters._telemetry import SorterTelemetry, make_sorter_result
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
+MOUNTAINSORT4_WRAPPER1_VERSION = '0.2.2'
 
 class num_workers_hook(hi.RuntimeHook):
     def precontainer(self, context: hi.PreContainerContext):
-        # context.kwargs can also be used to pull in variable values
-        # setting environment variables to ensure we are using only one thread
-        context.set_env('NUM_WORKERS', '1')
-        context.set_env('MKL_NUM_THREADS', '1')
-        context.set_env('NUMEXPR_NUM_THREADS', '1')
-        context.set_env('OMP_NUM_THREADS', '1')
+        # setting environment variables to ensure we are using only the requested number of threads
+        # (one, unless the thread policy says otherwise; see --thread-policy)
+        num_threads = str(context.kwargs.get('num_threads', 1))
+        context.set_env('NUM_WORKERS', num_threads)
+        context.set_env('MKL_NUM_THREADS', num_threads)
+        context.set_env('NUMEXPR_NUM_THREADS', num_threads)
+        context.set_env('OMP_NUM_THREADS', num_threads)
 
 @hi.function(
-    'mountainsort4_wrapper1', '0.1.0',
+    'mountainsort4_wrapper1', MOUNTAINSORT4_WRAPPER1_VERSION,
     image=hi.DockerImageFromScript(name='magland/mountainsort4', dockerfile=f'{thisdir}/docker/Dockerfile'),
     modules=['sortingview', 'spikeforest'],
     kachery_support=True,
-    runtime_hooks=[num_workers_hook()]
+    runtime_hooks=[num_workers_hook(), staging_dir_hook(), local_data_hook()]
 )
 def mountainsort4_wrapper1(
     recording_object: dict,
@@ -31,50 +35,63 @@ def mountainsort4_wrapper1(
     freq_min=300,
     freq_max=6000,
     whiten=True,
-    filter=True
+    filter=True,
+    num_threads=1,
+    staging_gb=0
 ) -> dict:
+    telemetry = SorterTelemetry()
     # test import
     import mountainsort4 as ms4
 
     import sortingview as sv
     import spiketoolkit as st
 
-    recording = sv.LabboxEphysRecordingExtractor(recording_object)
+    staged = ExitStack()
+    with telemetry.phase('stage'):
+        recording_object = staged.enter_context(stage_recording_object(recording_object, staging_gb))
+    # The staged copy can be evicted once the sorting is done
+    with staged:
+        with telemetry.phase('load'):
+            recording = sv.LabboxEphysRecordingExtractor(recording_object)
     
-    # Sorting
-    print('Sorting...')
-    with kc.TemporaryDirectory(prefix='tmp_mountainsort4') as tmpdir:
-        num_workers = 1
+        # Sorting
+        print('Sorting...')
+        with kc.TemporaryDirectory(prefix='tmp_mountainsort4') as tmpdir:
+            num_workers = num_threads
+            telemetry.set('num_threads', num_workers)
 
-        # preprocessing
-        if filter:
-            recording = st.preprocessing.bandpass_filter(
-                recording=recording,
-                freq_min=freq_min,
-                freq_max=freq_max,
-                chunk_size=int(recording.get_sampling_frequency() * 30),
-                cache_chunks=False
-            )
-        if whiten:
-            recording = st.preprocessing.whiten(
-                recording=recording,
-                chunk_size=int(recording.get_sampling_frequency() * 30),
-                cache_chunks=False,
-                seed=1
-            )
+            # preprocessing
+            # (the filters are lazy, so most of their cost shows up in the sort phase)
+            with telemetry.phase('preprocess'):
+                if filter:
+                    recording = st.preprocessing.bandpass_filter(
+                        recording=recording,
+                        freq_min=freq_min,
+                        freq_max=freq_max,
+                        chunk_size=int(recording.get_sampling_frequency() * 30),
+                        cache_chunks=False
+                    )
+                if whiten:
+                    recording = st.preprocessing.whiten(
+                        recording=recording,
+                        chunk_size=int(recording.get_sampling_frequency() * 30),
+                        cache_chunks=False,
+                        seed=1
+                    )
         
-        timer = time.time()
-        sorting = ms4.mountainsort4(
-            recording=recording,
-            detect_sign=detect_sign,
-            adjacency_radius=adjacency_radius,
-            clip_size=clip_size,
-            detect_threshold=detect_threshold,
-            detect_interval=detect_interval,
-            num_workers=num_workers,
-            verbose=True
-        ) 
-        elapsed = time.time() - timer
-        print('#SF-SORTER-RUNTIME#{:.3f}#'.format(timer))
+            with telemetry.phase('sort'):
+                sorting = ms4.mountainsort4(
+                    recording=recording,
+                    detect_sign=detect_sign,
+                    adjacency_radius=adjacency_radius,
+                    clip_size=clip_size,
+                    detect_threshold=detect_threshold,
+                    detect_interval=detect_interval,
+                    num_workers=num_workers,
+                    verbose=True
+                ) 
+            print('#SF-SORTER-RUNTIME#{:.3f}#'.format(telemetry.phase_elapsed('sort')))
 
-        return sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            with telemetry.phase('store'):
+                sorting_object = sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            return make_sorter_result(sorting_object, telemetry)
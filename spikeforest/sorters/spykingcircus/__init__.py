@@ -1 +1 @@
-from .spykingcircus_wrapper1 import spykingcircus_wrapper1
\ No newline at end of file
+from .spykingcircus_wrapper1 import SPYKINGCIRCUS_WRAPPER1_VERSION, spykingcircus_wrapper1
\ No newline at end of file
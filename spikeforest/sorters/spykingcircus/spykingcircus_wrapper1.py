@@ -1,24 +1,29 @@
+from contextlib import ExitStack
 import os
 import hither2 as hi
 import kachery_cloud as kc
+from spikeforest.sorters._staging import stage_recording_object, staging_dir_hook
+from spikeforest.sorters._telemetry import SorterTelemetry, make_sorter_result
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
+SPYKINGCIRCUS_WRAPPER1_VERSION = '0.2.2'
 
 class num_workers_hook(hi.RuntimeHook):
     def precontainer(self, context: hi.PreContainerContext):
-        # context.kwargs can also be used to pull in variable values
-        # setting environment variables to ensure we are using only one thread
-        context.set_env('NUM_WORKERS', '1')
-        context.set_env('MKL_NUM_THREADS', '1')
-        context.set_env('NUMEXPR_NUM_THREADS', '1')
-        context.set_env('OMP_NUM_THREADS', '1')
+        # setting environment variables to ensure we are using only the requested number of threads
+        # (one, unless the thread policy says otherwise; see --thread-policy)
+        num_threads = str(context.kwargs.get('num_threads', 1))
+        context.set_env('NUM_WORKERS', num_threads)
+        context.set_env('MKL_NUM_THREADS', num_threads)
+        context.set_env('NUMEXPR_NUM_THREADS', num_threads)
+        context.set_env('OMP_NUM_THREADS', num_threads)
 
 @hi.function(
-    'spykingcircus_wrapper1', '0.1.4',
+    'spykingcircus_wrapper1', SPYKINGCIRCUS_WRAPPER1_VERSION,
     image=hi.DockerImageFromScript(name='magland/spyking-circus', dockerfile=f'{thisdir}/docker/Dockerfile'),
     modules=['sortingview', 'spikeforest'],
     kachery_support=True,
-    runtime_hooks=[num_workers_hook()]
+    runtime_hooks=[num_workers_hook(), staging_dir_hook()]
 )
 def spykingcircus_wrapper1(
     recording_object: dict,
@@ -30,37 +35,50 @@ def spykingcircus_wrapper1(
     merge_spikes=True,
     auto_merge=0.75,
     whitening_max_elts=1000,
-    clustering_max_elts=10000
+    clustering_max_elts=10000,
+    num_threads=1,
+    staging_gb=0
 ) -> dict:
+    telemetry = SorterTelemetry()
     import sortingview as sv
     import spikesorters as ss
 
-    recording = sv.LabboxEphysRecordingExtractor(recording_object)
+    staged = ExitStack()
+    with telemetry.phase('stage'):
+        recording_object = staged.enter_context(stage_recording_object(recording_object, staging_gb))
+    # The staged copy can be evicted once the sorting is done
+    with staged:
+        with telemetry.phase('load'):
+            recording = sv.LabboxEphysRecordingExtractor(recording_object)
     
-    # Sorting
-    with kc.TemporaryDirectory(prefix='tmp_spykingcircus') as tmpdir:
-        sorter = ss.SpykingcircusSorter(
-            recording=recording,
-            output_folder=f'{tmpdir}/working',
-            delete_output_folder=True
-        )
+        # Sorting
+        with kc.TemporaryDirectory(prefix='tmp_spykingcircus') as tmpdir:
+            sorter = ss.SpykingcircusSorter(
+                recording=recording,
+                output_folder=f'{tmpdir}/working',
+                delete_output_folder=True
+            )
 
-        num_workers = 1
+            num_workers = num_threads
+            telemetry.set('num_threads', num_workers)
 
-        sorter.set_params(
-            detect_sign=detect_sign,
-            adjacency_radius=adjacency_radius,
-            detect_threshold=detect_threshold,
-            template_width_ms=template_width_ms,
-            filter=filter,
-            merge_spikes=merge_spikes,
-            auto_merge=auto_merge,
-            num_workers=num_workers,
-            whitening_max_elts=whitening_max_elts,
-            clustering_max_elts=clustering_max_elts
-        )     
-        timer = sorter.run()
-        print('#SF-SORTER-RUNTIME#{:.3f}#'.format(timer))
-        sorting = sorter.get_result()
+            sorter.set_params(
+                detect_sign=detect_sign,
+                adjacency_radius=adjacency_radius,
+                detect_threshold=detect_threshold,
+                template_width_ms=template_width_ms,
+                filter=filter,
+                merge_spikes=merge_spikes,
+                auto_merge=auto_merge,
+                num_workers=num_workers,
+                whitening_max_elts=whitening_max_elts,
+                clustering_max_elts=clustering_max_elts
+            )     
+            with telemetry.phase('sort'):
+                sorter.run()
+                sorting = sorter.get_result()
+            print('#SF-SORTER-RUNTIME#{:.3f}#'.format(telemetry.phase_elapsed('sort')))
 
-        return sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            with telemetry.phase('store'):
+                sorting_object = sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            return make_sorter_result(sorting_object, telemetry)
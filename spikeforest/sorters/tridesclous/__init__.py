@@ -1 +1 @@
-from .tridesclous_wrapper1 import tridesclous_wrapper1
\ No newline at end of file
+from .tridesclous_wrapper1 import TRIDESCLOUS_WRAPPER1_VERSION, tridesclous_wrapper1
\ No newline at end of file
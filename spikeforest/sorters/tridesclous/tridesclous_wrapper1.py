@@ -1,18 +1,25 @@
+from contextlib import ExitStack
 import os
 import hither2 as hi
 import kachery_cloud as kc
+from spikeforest.sorters._staging import stage_recording_object, staging_dir_hook
+from spikeforest.sorters._telemetry import SorterTelemetry, make_sorter_result
 
 thisdir = os.path.dirname(os.path.realpath(__file__))
+TRIDESCLOUS_WRAPPER1_VERSION = '0.2.1'
 
 @hi.function(
-    'tridesclous_wrapper1', '0.1.0',
+    'tridesclous_wrapper1', TRIDESCLOUS_WRAPPER1_VERSION,
     image=hi.DockerImageFromScript(name='magland/tridesclous', dockerfile=f'{thisdir}/docker/Dockerfile'),
     modules=['sortingview', 'spikeforest'],
-    kachery_support=True
+    kachery_support=True,
+    runtime_hooks=[staging_dir_hook()]
 )
 def tridesclous_wrapper1(
     recording_object: dict,
+    staging_gb=0
 ) -> dict:
+    telemetry = SorterTelemetry()
     # test importing tridesclous here - easier to troubleshoot if there are errors
     import tridesclous
 
@@ -20,21 +27,30 @@ def tridesclous_wrapper1(
     import spikesorters as ss
     # test importing tridesclous (best to get exceptions here)
 
-    recording = sv.LabboxEphysRecordingExtractor(recording_object)
+    staged = ExitStack()
+    with telemetry.phase('stage'):
+        recording_object = staged.enter_context(stage_recording_object(recording_object, staging_gb))
+    # The staged copy can be evicted once the sorting is done
+    with staged:
+        with telemetry.phase('load'):
+            recording = sv.LabboxEphysRecordingExtractor(recording_object)
     
-    # Sorting
-    print('Sorting...')
-    with kc.TemporaryDirectory(prefix='tmp_tridesclous') as tmpdir:
-        sorter = ss.TridesclousSorter(
-            recording=recording,
-            output_folder=f'{tmpdir}/working',
-            delete_output_folder=True
-        )
+        # Sorting
+        print('Sorting...')
+        with kc.TemporaryDirectory(prefix='tmp_tridesclous') as tmpdir:
+            sorter = ss.TridesclousSorter(
+                recording=recording,
+                output_folder=f'{tmpdir}/working',
+                delete_output_folder=True
+            )
 
-        sorter.set_params(
-        )     
-        timer = sorter.run()
-        print('#SF-SORTER-RUNTIME#{:.3f}#'.format(timer))
-        sorting = sorter.get_result()
+            sorter.set_params(
+            )     
+            with telemetry.phase('sort'):
+                sorter.run()
+                sorting = sorter.get_result()
+            print('#SF-SORTER-RUNTIME#{:.3f}#'.format(telemetry.phase_elapsed('sort')))
 
-        return sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            with telemetry.phase('store'):
+                sorting_object = sv.LabboxEphysSortingExtractor.store_sorting(sorting=sorting).object()
+            return make_sorter_result(sorting_object, telemetry)
@@ -0,0 +1,90 @@
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+
+from spikeforest._common.job_dispatch import ResourceClass, describe_resource_class
+from spikeforest.sorting_utilities.job_ordering import pack_jobs
+
+# SpikeForest raw recordings are float32 MDA files.
+DEFAULT_BYTES_PER_SAMPLE = 4
+
+class JobEstimate(NamedTuple):
+    sorter_label: str
+    recording_uri: str
+    resources: Union[ResourceClass, None]
+    runtime_sec: float
+    cached: bool
+    recording_bytes: int # 0 if unknown
+    wrapper_gpus: int = 0 # GPUs the sorter wrapper uses, whatever resources are declared
+
+class CostEstimate(NamedTuple):
+    num_jobs: int
+    num_cached: int
+    num_recordings: int          # distinct recordings needed by the jobs which will run
+    num_unknown_sizes: int       # ... of which the size is unknown
+    download_bytes: int
+    cpu_hours: float
+    gpu_hours: float
+    makespan_sec: float
+    # pool description -> (number of jobs, number of slots, projected makespan in seconds)
+    pools: Dict[str, Tuple[int, int, float]]
+
+def recording_bytes(num_channels: int, duration_sec: float, sample_rate_hz: float,
+                    bytes_per_sample: int = DEFAULT_BYTES_PER_SAMPLE) -> int:
+    return int(num_channels * round(duration_sec * sample_rate_hz) * bytes_per_sample)
+
+def estimate_costs(jobs: List[JobEstimate], count_slots: Callable[[Union[ResourceClass, None]], int]) -> CostEstimate:
+    """Summarizes the cost of running the given jobs.
+
+    Cached jobs cost nothing. Each distinct recording needed by a job which will run is counted once
+    towards the download size (an upper bound, as some may already be in the local kachery store).
+    Job pools run concurrently, so the projected makespan is that of the slowest pool.
+
+    Args:
+        jobs (List[JobEstimate]): One entry per cell of the sorting matrix.
+        count_slots (Callable[[Union[ResourceClass, None]], int]): Number of concurrent job slots
+            of the pool for a resource class (None being the default pool).
+
+    Returns:
+        CostEstimate: The summary.
+    """
+    to_run = [j for j in jobs if not j.cached]
+    sizes: Dict[str, int] = {}
+    for j in to_run:
+        sizes[j.recording_uri] = max(sizes.get(j.recording_uri, 0), j.recording_bytes)
+    cpu_hours = 0.0
+    gpu_hours = 0.0
+    by_pool: Dict[Union[ResourceClass, None], List[float]] = {}
+    for j in to_run:
+        resources = j.resources or ResourceClass()
+        cpu_hours += j.runtime_sec * resources.cpus / 3600
+        gpu_hours += j.runtime_sec * max(resources.gpus, j.wrapper_gpus) / 3600
+        by_pool.setdefault(j.resources, []).append(j.runtime_sec)
+    pools = {}
+    for (resources, estimates) in by_pool.items():
+        slots = count_slots(resources)
+        (_, loads) = pack_jobs(estimates, slots)
+        name = 'default pool' if resources is None else describe_resource_class(resources)
+        pools[name] = (len(estimates), slots, max(loads, default=0.0))
+    return CostEstimate(
+        num_jobs          = len(jobs),
+        num_cached        = len(jobs) - len(to_run),
+        num_recordings    = len(sizes),
+        num_unknown_sizes = len([s for s in sizes.values() if s == 0]),
+        download_bytes    = sum(sizes.values()),
+        cpu_hours         = cpu_hours,
+        gpu_hours         = gpu_hours,
+        makespan_sec      = max((p[2] for p in pools.values()), default=0.0),
+        pools             = pools
+    )
+
+def format_cost_estimate(estimate: CostEstimate) -> str:
+    lines = [
+        f"Sorting jobs:         {estimate.num_jobs} ({estimate.num_cached} cached, {estimate.num_jobs - estimate.num_cached} to run)",
+        f"Recordings to fetch:  {estimate.num_recordings}, {estimate.download_bytes / 1e9:.2f} GB (at most)" +
+            (f"; size unknown for {estimate.num_unknown_sizes}" if estimate.num_unknown_sizes > 0 else ""),
+        f"Projected CPU hours:  {estimate.cpu_hours:.1f}",
+        f"Projected GPU hours:  {estimate.gpu_hours:.1f}",
+        f"Projected makespan:   {estimate.makespan_sec / 3600:.2f} h"
+    ]
+    for (name, (num_jobs, slots, makespan)) in estimate.pools.items():
+        lines.append(f"    {name}: {num_jobs} jobs on {slots} slots, {makespan / 3600:.2f} h")
+    return '\n'.join(lines)
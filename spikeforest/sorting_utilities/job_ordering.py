@@ -0,0 +1,149 @@
+import heapq
+from statistics import median
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+from spikeforest._common.calling_framework import print_per_verbose
+
+JOB_ORDER_SPEC = 'spec'      # submit in spec-file order (sorter by sorter)
+JOB_ORDER_LPT = 'lpt'        # longest-processing-time-first
+JOB_ORDERS = [JOB_ORDER_SPEC, JOB_ORDER_LPT]
+
+# Used when nothing at all is known about a job; only the relative ordering matters.
+DEFAULT_RUNTIME_SEC = 1.0
+
+# (study name, recording name, normalized sorter name)
+HistoryKey = Tuple[str, str, str]
+
+class RuntimeModel(NamedTuple):
+    # Observed runtimes from previous runs, keyed by exact matrix cell.
+    history: Dict[HistoryKey, float]
+    # Seconds per (channel * second of recording), fitted per sorter from the history.
+    sorter_coefficients: Dict[str, float]
+    # The same fit, pooled over all sorters; used for sorters with no history.
+    pooled_coefficient: Union[float, None]
+    # Median observed runtime per sorter; used when a recording's size is unknown.
+    sorter_medians: Dict[str, float]
+
+def normalize_sorter_name(sorter_name: str) -> str:
+    # The catalog and the spec files do not agree on capitalization (e.g. KiloSort2 vs Kilosort2).
+    return sorter_name.lower()
+
+def recording_size(num_channels: int, duration_sec: float) -> float:
+    return float(num_channels) * float(duration_sec)
+
+def _fit_coefficient(points: List[Tuple[float, float]]) -> Union[float, None]:
+    # least-squares fit of runtime = c * size, through the origin
+    denominator = sum(x * x for (x, _) in points)
+    if denominator == 0: return None
+    return sum(x * t for (x, t) in points) / denominator
+
+def fit_runtime_model(
+    observations: List[Tuple[str, str, str, float]],
+    recording_sizes: Dict[Tuple[str, str], float]
+) -> RuntimeModel:
+    """Builds a RuntimeModel from historical (study, recording, sorter, runtime) observations.
+
+    Args:
+        observations (List[Tuple[str, str, str, float]]): Previous runtimes. Missing or non-positive
+            runtimes (e.g. from errored jobs) are ignored.
+        recording_sizes (Dict[Tuple[str, str], float]): channels * duration for each known
+            (study, recording) pair.
+
+    Returns:
+        RuntimeModel: The fitted model.
+    """
+    history: Dict[HistoryKey, float] = {}
+    points_by_sorter: Dict[str, List[Tuple[float, float]]] = {}
+    runtimes_by_sorter: Dict[str, List[float]] = {}
+    for (study_name, recording_name, sorter_name, runtime) in observations:
+        if runtime is None or runtime <= 0: continue
+        sorter = normalize_sorter_name(sorter_name)
+        history[(study_name, recording_name, sorter)] = runtime
+        runtimes_by_sorter.setdefault(sorter, []).append(runtime)
+        size = recording_sizes.get((study_name, recording_name), 0)
+        if size > 0:
+            points_by_sorter.setdefault(sorter, []).append((size, runtime))
+    coefficients = {}
+    for (sorter, points) in points_by_sorter.items():
+        c = _fit_coefficient(points)
+        if c is not None: coefficients[sorter] = c
+    pooled = _fit_coefficient([p for points in points_by_sorter.values() for p in points])
+    return RuntimeModel(
+        history             = history,
+        sorter_coefficients = coefficients,
+        pooled_coefficient  = pooled,
+        sorter_medians      = {s: median(r) for (s, r) in runtimes_by_sorter.items()}
+    )
+
+def load_runtime_model(sorting_outputs_uri: Union[str, None] = None) -> RuntimeModel:
+    """Fits a RuntimeModel to the runtimes recorded in the SpikeForest sorting-outputs catalog.
+    If the catalogs cannot be loaded, returns an empty model (every job gets a size-based or default estimate).
+    """
+    import spikeforest as sf
+    try:
+        recordings = sf.load_spikeforest_recordings()
+        outputs = sf.load_spikeforest_sorting_outputs() if sorting_outputs_uri is None \
+            else sf.load_spikeforest_sorting_outputs(sorting_outputs_uri)
+        sizes = {(r.study_name, r.recording_name): recording_size(r.num_channels, r.duration_sec) for r in recordings}
+        observations = [(o.study_name, o.recording_name, o.sorter_name, o.cpu_time_sec) for o in outputs]
+    except Exception as e:
+        print(f"WARNING: Unable to load runtime history from the SpikeForest catalog; jobs will be ordered by size only.\n{e}")
+        sizes = {}
+        observations = []
+    model = fit_runtime_model(observations, sizes)
+    print_per_verbose(2, f"Runtime model: {len(model.history)} historical runtimes, fitted sorters: {list(model.sorter_coefficients.keys())}")
+    return model
+
+def estimate_runtime_sec(model: RuntimeModel, sorter_name: str, study_name: str, recording_name: str, size: float) -> float:
+    sorter = normalize_sorter_name(sorter_name)
+    if (study_name, recording_name, sorter) in model.history:
+        return model.history[(study_name, recording_name, sorter)]
+    coefficient = model.sorter_coefficients.get(sorter, model.pooled_coefficient)
+    if size > 0:
+        return size * (coefficient if coefficient is not None else 1.0)
+    return model.sorter_medians.get(sorter, DEFAULT_RUNTIME_SEC)
+
+def pack_jobs(estimates: List[float], num_queues: int) -> Tuple[List[List[int]], List[float]]:
+    """Assigns jobs to queues longest-first, always to the least-loaded queue (LPT list scheduling).
+
+    Args:
+        estimates (List[float]): Estimated runtime of each job.
+        num_queues (int): Number of queues (job slots) to pack into.
+
+    Returns:
+        Tuple[List[List[int]], List[float]]: The job indices assigned to each queue, in order,
+        and the total estimated load of each queue.
+    """
+    num_queues = max(1, num_queues)
+    queues: List[List[int]] = [[] for _ in range(num_queues)]
+    loads = [0.0] * num_queues
+    heap = [(0.0, q) for q in range(num_queues)]
+    for i in sorted(range(len(estimates)), key=lambda i: estimates[i], reverse=True):
+        (load, q) = heapq.heappop(heap)
+        queues[q].append(i)
+        loads[q] = load + estimates[i]
+        heapq.heappush(heap, (loads[q], q))
+    return (queues, loads)
+
+def order_groups_longest_first(estimates: List[float], groups: List[str]) -> List[int]:
+    """LPT over groups of jobs: the groups in decreasing order of their total estimated runtime,
+    each one's jobs longest-first and together (ties in order of first appearance)."""
+    totals: Dict[str, float] = {}
+    first_index: Dict[str, int] = {}
+    for (i, group) in enumerate(groups):
+        totals[group] = totals.get(group, 0.0) + estimates[i]
+        first_index.setdefault(group, i)
+    return sorted(range(len(estimates)), key=lambda i: (-totals[groups[i]], first_index[groups[i]], -estimates[i]))
+
+def order_jobs(estimates: List[float], job_order: str, num_slots: int, groups: Union[List[str], None] = None) -> List[int]:
+    """Returns the indices of the jobs in the order they should be submitted. With groups (e.g. the
+    recording of each job), 'lpt' keeps the jobs of a group together."""
+    if job_order == JOB_ORDER_SPEC:
+        return list(range(len(estimates)))
+    (_, loads) = pack_jobs(estimates, num_slots)
+    print_per_verbose(1, f"Projected makespan for {len(estimates)} jobs on {num_slots} slots: {max(loads, default=0):.0f} sec")
+    if job_order == JOB_ORDER_LPT:
+        if groups is not None:
+            return order_groups_longest_first(estimates, groups)
+        return sorted(range(len(estimates)), key=lambda i: estimates[i], reverse=True)
+    raise Exception(f"Unknown job order {job_order}; expected one of {JOB_ORDERS}.")
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+from spikeforest._common.calling_framework import print_per_verbose
+from spikeforest.sorting_utilities.result_cache import get_recording_hash, parse_sha1_uri
+
+# Metrics of sortings are cached one metric at a time, by the data they are computed from and the version
+# of the metric, so that adding or changing one metric only computes that metric.
+DEFAULT_METRIC_CACHE_PATH = os.getenv('SPIKEFOREST_METRIC_CACHE',
+    os.path.join(os.path.expanduser('~'), '.spikeforest', 'metric-cache.sqlite'))
+
+def get_firings_hash(firings_uri: str) -> str:
+    firings_hash = parse_sha1_uri(firings_uri)
+    return firings_hash if firings_hash is not None else hashlib.sha1(firings_uri.encode()).hexdigest()
+
+def get_data_hash(recording_uri: str, gt_uri: Union[str, None] = None) -> str:
+    """What a metric of a sorting is computed from besides the sorting: the recording data, and for
+    metrics which use it (e.g. the ground truth comparison), the ground truth."""
+    recording_hash = get_recording_hash(recording_uri)
+    if gt_uri is None: return recording_hash
+    return f'{recording_hash}+{get_firings_hash(gt_uri)}'
+
+class MetricCache:
+    def __init__(self, path: str) -> None:
+        dirname = os.path.dirname(path)
+        if dirname != '': os.makedirs(dirname, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS metric_results (
+            data_hash TEXT,
+            firings_hash TEXT,
+            metric TEXT,
+            version TEXT,
+            value TEXT,
+            created REAL,
+            PRIMARY KEY (data_hash, firings_hash, metric, version)
+        )''')
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data_hash: str, firings_hash: str, metric: str, version: str) -> Union[Tuple[Any], None]:
+        """The cached value as a 1-tuple (so that a cached None is told apart from a miss); None on a miss."""
+        row = self._connection.execute(
+            'SELECT value FROM metric_results WHERE data_hash = ? AND firings_hash = ? AND metric = ? AND version = ?',
+            (data_hash, firings_hash, metric, version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (json.loads(row[0]),)
+
+    def put_many(self, data_hash: str, firings_hash: str, values: Dict[str, Any], versions: Dict[str, str]) -> None:
+        now = time.time()
+        self._connection.executemany('INSERT OR REPLACE INTO metric_results VALUES (?, ?, ?, ?, ?, ?)',
+            [(data_hash, firings_hash, metric, versions[metric], json.dumps(value), now) for (metric, value) in values.items()])
+        self._connection.commit()
+
+    def missing(self, data_hash: str, firings_hash: str, versions: Dict[str, str]) -> Tuple[Dict[str, Any], List[str]]:
+        """Splits the metrics (name: version) into those cached (with their values) and those to compute."""
+        cached: Dict[str, Any] = {}
+        to_compute: List[str] = []
+        for (metric, version) in versions.items():
+            value = self.get(data_hash, firings_hash, metric, version)
+            if value is None:
+                to_compute.append(metric)
+            else:
+                cached[metric] = value[0]
+        return (cached, to_compute)
+
+    def close(self) -> None:
+        print_per_verbose(1, f"Metric cache: {self.hits} hit(s), {self.misses} miss(es).")
+        self._connection.close()
@@ -0,0 +1,98 @@
+import json
+import os
+import sys
+from typing import Any, Dict, Generator, Iterable, TextIO, Union
+
+# OutputRecords are streamed to a JSON Lines file (one record per line) as jobs complete.
+# The legacy output format (a single JSON array) is produced from that file by compact_jsonl().
+JSONL_SUFFIX = '.jsonl'
+
+
+class OutputRecordSink:
+    """Writes one JSON object per line as records become available.
+
+    Each record is serialized completely before being written with a single write() call,
+    then flushed and fsynced, so a crashed or killed run leaves only complete lines behind.
+    If no path is given, records are streamed to STDOUT instead.
+    """
+    def __init__(self, path: Union[str, None]) -> None:
+        self._path = path
+        self._count = 0
+        if path is None:
+            self._file = sys.stdout
+        else:
+            # 'x' mode: never append to (or overwrite) the output of a previous run.
+            self._file = open(path, 'x')
+
+    @property
+    def path(self) -> Union[str, None]:
+        return self._path
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record) + '\n'
+        self._file.write(line)
+        self._file.flush()
+        if self._path is not None:
+            try:
+                os.fsync(self._file.fileno())
+            except OSError:
+                pass # e.g. /dev/null
+        self._count += 1
+
+    def close(self) -> None:
+        if self._path is not None:
+            self._file.close()
+
+    def __enter__(self) -> 'OutputRecordSink':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def read_jsonl(path: str) -> Generator[Dict[str, Any], None, None]:
+    with open(path) as file:
+        for line in file:
+            # A truncated final line can only come from an interrupted run; skip it.
+            if not line.endswith('\n'): break
+            if line.strip() == '': continue
+            yield json.loads(line)
+
+def write_json_array(file: TextIO, records: Iterable[Dict[str, Any]], indent: int = 2) -> int:
+    # One record at a time, so that the whole array is never held in memory
+    count = 0
+    file.write('[')
+    for record in records:
+        file.write(',\n' if count > 0 else '\n')
+        file.write(json.dumps(record, indent=indent))
+        count += 1
+    file.write('\n]\n')
+    return count
+
+def compact_jsonl(jsonl_path: str, json_path: str) -> int:
+    """Converts a JSON Lines file of OutputRecords into the legacy format (one JSON array).
+
+    Records are copied one at a time, so memory use does not depend on the number of records.
+    The output is written to a temporary file and moved into place once complete.
+
+    Returns:
+        int: The number of records written.
+    """
+    tmp_path = f'{json_path}.tmp'
+    with open(tmp_path, 'w') as file:
+        count = write_json_array(file, read_jsonl(jsonl_path))
+    os.replace(tmp_path, json_path)
+    return count
+
+def get_jsonl_path(outfile: Union[str, None]) -> Union[str, None]:
+    """Returns the path of the JSON Lines file records should stream to for a given --outfile.
+    If the outfile is itself a .jsonl file (or /dev/null), records are written to it directly
+    and no compaction is needed.
+    """
+    if outfile is None or outfile == '': return None
+    if outfile.endswith(JSONL_SUFFIX) or outfile == '/dev/null': return outfile
+    return outfile + JSONL_SUFFIX
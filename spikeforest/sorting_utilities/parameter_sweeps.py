@@ -0,0 +1,90 @@
+import inspect
+import random
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+SWEEP_MODE_GRID = 'grid'
+SWEEP_MODE_RANDOM = 'random'
+SWEEP_MODES = [SWEEP_MODE_GRID, SWEEP_MODE_RANDOM]
+
+class SweepSpec(NamedTuple):
+    mode: str
+    # Parameter name -> list of values to try
+    params: Dict[str, List[Any]]
+    # For random sweeps: how many parameter combinations to draw (without replacement), and the seed
+    num_samples: int = 0
+    seed: int = 0
+
+def parse_sweep(spec: Union[Dict[str, Any], None], sorter_name: str) -> Union[SweepSpec, None]:
+    """Parses the optional 'sweep' entry of a sorter in the sorter spec file, e.g.
+
+        sweep:
+            mode: grid            # or: random (then also num_samples, and optionally seed)
+            params:
+                detect_threshold: [3, 4, 5]
+                adjacency_radius: [50, 100]
+    """
+    if spec is None: return None
+    mode = spec.get('mode', SWEEP_MODE_GRID)
+    if mode not in SWEEP_MODES:
+        raise Exception(f"Sweep for sorter {sorter_name} has unknown mode {mode}; expected one of {SWEEP_MODES}.")
+    params = spec.get('params', {})
+    for (name, values) in params.items():
+        if not isinstance(values, list) or len(values) == 0:
+            raise Exception(f"Sweep for sorter {sorter_name}: parameter {name} must be given a non-empty list of values.")
+    sweep = SweepSpec(mode=mode, params=params, num_samples=spec.get('num_samples', 0), seed=spec.get('seed', 0))
+    if mode == SWEEP_MODE_RANDOM and sweep.num_samples <= 0:
+        raise Exception(f"Random sweep for sorter {sorter_name} requires a positive num_samples.")
+    return sweep
+
+def _grid_size(params: Dict[str, List[Any]]) -> int:
+    size = 1
+    for values in params.values():
+        size *= len(values)
+    return size
+
+def _grid_point(params: Dict[str, List[Any]], names: List[str], index: int) -> Dict[str, Any]:
+    # Decodes a (mixed-radix) index into the grid, so random sweeps never need to materialize the grid.
+    point = {}
+    for name in reversed(names):
+        values = params[name]
+        point[name] = values[index % len(values)]
+        index //= len(values)
+    return point
+
+def expand_sweep(sweep: Union[SweepSpec, None]) -> List[Dict[str, Any]]:
+    """Returns the parameter combinations of a sweep (a single empty combination if there is no sweep)."""
+    if sweep is None or len(sweep.params) == 0: return [{}]
+    names = sorted(sweep.params.keys())
+    size = _grid_size(sweep.params)
+    if sweep.mode == SWEEP_MODE_RANDOM and sweep.num_samples < size:
+        indices = sorted(random.Random(sweep.seed).sample(range(size), sweep.num_samples))
+    else:
+        indices = list(range(size))
+    return [_grid_point(sweep.params, names, i) for i in indices]
+
+def make_sweep_label(sorter_name: str, varied_params: Dict[str, Any]) -> str:
+    # Depends only on the parameter values, so labels are stable across runs and spec-file edits.
+    if len(varied_params) == 0: return sorter_name
+    settings = ','.join(f'{name}={varied_params[name]}' for name in sorted(varied_params.keys()))
+    return f'{sorter_name}[{settings}]'
+
+def expand_sorter_params(sorter_name: str, base_params: Dict[str, Any], sweep: Union[SweepSpec, None]) -> List[Tuple[str, Dict[str, Any]]]:
+    """Returns (label, full parameter set) for every variant of a sorter."""
+    return [
+        (make_sweep_label(sorter_name, varied), {**base_params, **varied})
+        for varied in expand_sweep(sweep)
+    ]
+
+def check_wrapper_params(sorter_name: str, fn: Callable, param_names: List[str]) -> None:
+    """Raises if the wrapper function does not accept all of the given parameters, so that typos in
+    the spec file fail before any job is queued rather than in every job."""
+    try:
+        signature = inspect.signature(fn)
+    except (TypeError, ValueError):
+        return
+    if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in signature.parameters.values()):
+        return # e.g. a decorator which does not preserve the signature; nothing to check against
+    accepted = [name for name in signature.parameters.keys() if name != 'recording_object']
+    unknown = [name for name in param_names if name not in accepted]
+    if len(unknown) > 0:
+        raise Exception(f"Sorter {sorter_name} does not accept parameter(s) {unknown}; accepted parameters are {accepted}.")
@@ -0,0 +1,201 @@
+from argparse import ArgumentParser, Namespace
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Tuple, Union
+
+from spikeforest._common.calling_framework import print_per_verbose
+from spikeforest.sorting_utilities.result_cache import canonicalize_params, get_recording_hash
+from spikeforest.sorting_utilities.run_sortings import KNOWN_SORTER_VERSIONS, KNOWN_SORTERS, RecordingRecord, SorterRecord, SortingMatrixDict, SortingMatrixEntry, get_result_cache_params
+
+# Which inputs each workspace sorting was made from is kept here, per workspace and sorting label.
+DEFAULT_PLAN_STATE_PATH = os.getenv('SPIKEFOREST_PLAN_STATE',
+    os.path.join(os.path.expanduser('~'), '.spikeforest', 'sorting-plan.sqlite'))
+
+CELL_CURRENT = 'current'      # in the workspace, made from the desired inputs
+CELL_STALE = 'stale'          # in the workspace, made from other inputs: rerun and replace
+CELL_MISSING = 'missing'      # not in the workspace: run
+CELL_UNTRACKED = 'untracked'  # in the workspace, inputs unknown (added before the planner, or by hand)
+
+class CellFingerprint(NamedTuple):
+    wrapper_version: str
+    image_hash: str      # SHA-1 of the wrapper's Dockerfile ('' if not found)
+    params: str          # canonical JSON of the sorting parameters (and sharding)
+    recording_hash: str  # see get_recording_hash
+
+    def digest(self) -> str:
+        return hashlib.sha1(json.dumps(list(self)).encode()).hexdigest()
+
+    def changed_fields(self, other: Union['CellFingerprint', None]) -> List[str]:
+        if other is None: return []
+        return [field for (field, a, b) in zip(self._fields, self, other) if a != b]
+
+class PlannedCell(NamedTuple):
+    study_name: str
+    recording_name: str
+    sorter_label: str
+    sorting_label: str     # label of the sorting in the workspace
+    status: str            # one of the CELL_ constants
+    fingerprint: CellFingerprint
+    changed: List[str]     # for stale cells: which inputs changed (CellFingerprint fields)
+
+class PlannerArgs(NamedTuple):
+    plan_state_path: str
+    rerun_untracked: bool
+    invalidation_file: Union[str, None]
+    plan_only: bool
+
+def add_planner_args(parser: ArgumentParser) -> ArgumentParser:
+    parser.add_argument('--plan-state', action='store', default=DEFAULT_PLAN_STATE_PATH,
+        help="SQLite file recording which inputs (wrapper version, Dockerfile, parameters, recording data) each " +
+        "workspace sorting was made from. Sortings whose inputs have changed since are rerun and replaced. " +
+        "The state is local to this machine while the workspace is shared: sortings added from elsewhere (or " +
+        "with another state file) are untracked here. " +
+        "Default: $SPIKEFOREST_PLAN_STATE or ~/.spikeforest/sorting-plan.sqlite.")
+    parser.add_argument('--rerun-untracked', action='store_true', default=False,
+        help="If set, workspace sortings with no recorded inputs (e.g. added before --plan-state existed) are rerun " +
+        "and replaced too. By default they are kept.")
+    parser.add_argument('--invalidation-file', action='store', default=None,
+        help="If set, the sortings which will be replaced (and whose downstream metrics are therefore out of date) " +
+        "are written to this JSON file.")
+    parser.add_argument('--plan-only', action='store_true', default=False,
+        help="If set, print which sortings are current, stale or missing and quit without running anything.")
+    return parser
+
+def parse_planner_args(parsed: Namespace) -> PlannerArgs:
+    return PlannerArgs(
+        plan_state_path   = parsed.plan_state,
+        rerun_untracked   = parsed.rerun_untracked,
+        invalidation_file = parsed.invalidation_file,
+        plan_only         = parsed.plan_only
+    )
+
+
+_image_hashes: Dict[str, str] = {}
+def get_image_hash(sorter_name: str) -> str:
+    """SHA-1 of the Dockerfile the sorter's container image is built from (next to the wrapper, in docker/)."""
+    if sorter_name not in _image_hashes:
+        try:
+            dockerfile = os.path.join(os.path.dirname(inspect.getfile(KNOWN_SORTERS[sorter_name])), 'docker', 'Dockerfile')
+            with open(dockerfile, 'rb') as f:
+                _image_hashes[sorter_name] = hashlib.sha1(f.read()).hexdigest()
+        except (TypeError, OSError):
+            _image_hashes[sorter_name] = ''
+    return _image_hashes[sorter_name]
+
+def make_fingerprint(sorter: SorterRecord, recording: RecordingRecord) -> CellFingerprint:
+    return CellFingerprint(
+        wrapper_version = KNOWN_SORTER_VERSIONS[sorter.sorter_name],
+        image_hash      = get_image_hash(sorter.sorter_name),
+        params          = canonicalize_params(get_result_cache_params(sorter.sorting_parameters, sorter.sharding)),
+        recording_hash  = get_recording_hash(recording.recording_uri)
+    )
+
+
+class PlanState:
+    """Safe to use from several threads (e.g. the workspace writer's, which records each sorting as it is added)."""
+    def __init__(self, path: str) -> None:
+        dirname = os.path.dirname(path)
+        if dirname != '': os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS cells (
+            workspace TEXT,
+            sorting_label TEXT,
+            fingerprint TEXT,
+            updated REAL,
+            PRIMARY KEY (workspace, sorting_label)
+        )''')
+        self._connection.commit()
+
+    def get(self, workspace_uri: str, sorting_label: str) -> Union[CellFingerprint, None]:
+        with self._lock:
+            row = self._connection.execute('SELECT fingerprint FROM cells WHERE workspace = ? AND sorting_label = ?',
+                                           (workspace_uri, sorting_label)).fetchone()
+        return None if row is None else CellFingerprint(*json.loads(row[0]))
+
+    def put(self, workspace_uri: str, sorting_label: str, fingerprint: CellFingerprint) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)',
+                (workspace_uri, sorting_label, json.dumps(list(fingerprint)), time.time()))
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def plan_cell(fingerprint: CellFingerprint, stored: Union[CellFingerprint, None], in_workspace: bool) -> Tuple[str, List[str]]:
+    if not in_workspace: return (CELL_MISSING, [])
+    if stored is None: return (CELL_UNTRACKED, [])
+    changed = fingerprint.changed_fields(stored)
+    return (CELL_STALE, changed) if len(changed) > 0 else (CELL_CURRENT, [])
+
+def plan_sorting_matrix(
+    matrix: SortingMatrixDict,
+    workspace_uri: str,
+    workspace_labels: List[str],
+    state: PlanState,
+    get_sorting_label: Any
+) -> List[PlannedCell]:
+    """Compares each cell of the matrix with the workspace and with the inputs recorded for it.
+
+    Args:
+        workspace_labels (List[str]): Labels of the sortings in the workspace.
+        get_sorting_label (Callable[[RecordingRecord, str], str]): Workspace label of the sorting
+            of a recording by a sorter (label).
+    """
+    existing = set(workspace_labels)
+    cells = []
+    for (sorter_label, (sorter, recordings)) in matrix.items():
+        for recording in recordings:
+            sorting_label = get_sorting_label(recording, sorter_label)
+            fingerprint = make_fingerprint(sorter, recording)
+            (status, changed) = plan_cell(fingerprint, state.get(workspace_uri, sorting_label), sorting_label in existing)
+            cells.append(PlannedCell(recording.study_name, recording.recording_name, sorter_label, sorting_label, status, fingerprint, changed))
+    return cells
+
+def cells_to_run(cells: List[PlannedCell], rerun_untracked: bool) -> List[PlannedCell]:
+    statuses = [CELL_STALE, CELL_MISSING] + ([CELL_UNTRACKED] if rerun_untracked else [])
+    return [c for c in cells if c.status in statuses]
+
+def filter_sorting_matrix(matrix: SortingMatrixDict, cells: List[PlannedCell]) -> SortingMatrixDict:
+    """The part of the matrix made of the given cells."""
+    wanted = set((c.sorter_label, c.study_name, c.recording_name) for c in cells)
+    new_matrix: SortingMatrixDict = {}
+    for (sorter_label, (sorter, recordings)) in matrix.items():
+        kept = [r for r in recordings if (sorter_label, r.study_name, r.recording_name) in wanted]
+        if len(kept) > 0:
+            new_matrix[sorter_label] = SortingMatrixEntry(sorter_record=sorter, requested_recordings=kept)
+    return new_matrix
+
+def format_plan(cells: List[PlannedCell], rerun_untracked: bool) -> str:
+    lines = []
+    for sorter_label in sorted(set(c.sorter_label for c in cells)):
+        column = [c for c in cells if c.sorter_label == sorter_label]
+        counts = {status: len([c for c in column if c.status == status]) for status in [CELL_CURRENT, CELL_STALE, CELL_MISSING, CELL_UNTRACKED]}
+        changed = sorted(set(f for c in column for f in c.changed))
+        reason = f" ({', '.join(changed)} changed)" if len(changed) > 0 else ''
+        lines.append(f"{sorter_label}: {counts[CELL_CURRENT]} current, {counts[CELL_STALE]} stale{reason}, " +
+                     f"{counts[CELL_MISSING]} missing, {counts[CELL_UNTRACKED]} untracked")
+    num_to_run = len(cells_to_run(cells, rerun_untracked))
+    lines.append(f"{num_to_run} of {len(cells)} sortings to run.")
+    return '\n'.join(lines)
+
+def write_invalidation_list(path: str, cells: List[PlannedCell]) -> None:
+    # Sortings about to be replaced; metrics computed from them (e.g. by fetch_metrics) are out of date.
+    invalidated = [{
+        'studyName': c.study_name,
+        'recordingName': c.recording_name,
+        'sorterLabel': c.sorter_label,
+        'sortingLabel': c.sorting_label,
+        'status': c.status,
+        'changed': c.changed
+    } for c in cells if c.status in [CELL_STALE, CELL_UNTRACKED]]
+    with open(path, 'w') as f:
+        json.dump(invalidated, f, indent=4)
+    print_per_verbose(1, f"Wrote {len(invalidated)} invalidated sorting(s) to {path}.")
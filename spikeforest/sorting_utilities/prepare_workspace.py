@@ -1,6 +1,11 @@
 from argparse import ArgumentParser, Namespace
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import json
-from typing import Any, Dict, Generator, List, NamedTuple, Set, Tuple, Union
+import os
+import struct
+import threading
+from typing import Any, Callable, Deque, Dict, Generator, Iterable, List, NamedTuple, Set, Tuple, Union
 
 import sortingview as sv
 import kachery_cloud as kc
@@ -19,6 +24,10 @@ class RecordingEntry(NamedTuple):
     recording_label:  str
     truth_label:      str
     sorting_label:    str
+    # Sizes recorded in the sortings file by run_sortings, where available
+    num_channels:     Union[int, None] = None
+    num_true_units:   Union[int, None] = None
+    num_units:        Union[int, None] = None
 
 class FullRecordingEntry(NamedTuple):
     recording_label: str
@@ -32,9 +41,10 @@ class FullRecordingEntry(NamedTuple):
     sorting_exists: bool
 
 class Params(NamedTuple):
-    workspace: str
-    sortings:  Any
-    dry_run:   bool
+    workspace:         str
+    sortings:          Any
+    dry_run:           bool
+    hydration_workers: int
 
 def init() -> Params:
     description = "Convert a sortings.json file into a populated Labbox workspace."
@@ -52,6 +62,9 @@ def init_workspace_args(parser: ArgumentParser) -> ArgumentParser:
            + "should be set.")
     parser.add_argument('--dry-run', action='store_true', default=False,
         help="If set, script will only parse the input files and display the workspace commands it would have run.")
+    parser.add_argument('--hydration-workers', action='store', type=int, default=8,
+        help="How many entries to load (recording and sorting downloads) at once. Entries are still added to the " +
+        "workspace in the order of the sortings file. Default 8.")
     return parser
 
 def add_workspace_selection_args(parser: ArgumentParser) -> ArgumentParser:
@@ -92,19 +105,46 @@ def parse_workspace_params(parsed: Namespace) -> Params:
             sortings = json.load(fp)
     else:
         sortings = kc.load_json(parsed.sortings_file_kachery_uri)
-    return Params(workspace_uri, sortings, parsed.dry_run)
+    return Params(workspace_uri, sortings, parsed.dry_run, max(parsed.hydration_workers, 1))
 
-def get_known_recording_id(workspace: Union[sv.Workspace, None], recording_label: str) -> str:
-    if workspace is None: return None
-    for (_, v) in workspace._recordings.items():
-        if v['recordingLabel'] == recording_label:
-            return v['recordingId']
-    return None
+class WorkspaceIndex:
+    """A workspace with its recording and sorting labels indexed, so that looking a label up does not scan
+    the whole workspace. Built once; recordings and sortings added or deleted through the index keep it
+    current. A None workspace (e.g. in a dry run) is indexed as an empty one.
+    """
+    def __init__(self, workspace: Union[sv.Workspace, None]) -> None:
+        self.workspace = workspace
+        self._recording_ids: Dict[str, str] = {}
+        self._sorting_ids: Dict[str, List[str]] = {}
+        if workspace is None: return
+        for v in workspace._recordings.values():
+            self._recording_ids[v['recordingLabel']] = v['recordingId']
+        for (sorting_id, v) in workspace._sortings.items():
+            self._sorting_ids.setdefault(v['sortingLabel'], []).append(sorting_id)
+
+    def recording_id(self, recording_label: str) -> Union[str, None]:
+        return self._recording_ids.get(recording_label, None)
+
+    def has_sorting(self, sorting_label: str) -> bool:
+        return sorting_label in self._sorting_ids
+
+    def sorting_labels(self) -> List[str]:
+        return list(self._sorting_ids.keys())
+
+    def add_recording(self, recording: sv.LabboxEphysRecordingExtractor, label: str) -> str:
+        R_id = self.workspace.add_recording(recording=recording, label=label)
+        self._recording_ids[label] = R_id
+        return R_id
+
+    def add_sorting(self, sorting: sv.LabboxEphysSortingExtractor, recording_id: str, label: str) -> str:
+        s_id = self.workspace.add_sorting(sorting=sorting, recording_id=recording_id, label=label)
+        self._sorting_ids.setdefault(label, []).append(s_id)
+        return s_id
 
-def sortings_are_in_workspace(workspace: Union[sv.Workspace, None], gt: str, comp: str) -> Tuple[bool, bool]:
-    if workspace is None: return (False, False)
-    sortings = [workspace._sortings[key]['sortingLabel'] for key in workspace._sortings.keys()]
-    return (gt in sortings, comp in sortings)
+    def remove_sortings_with_label(self, label: str) -> None:
+        for sorting_id in self._sorting_ids.pop(label, []):
+            print_per_verbose(2, f"Removing sorting {sorting_id} ({label}) from the workspace")
+            self.workspace.delete_sorting(sorting_id)
 
 def get_labels(study_name: str, recording_name: str, gt_token: str, sorter_name: str) -> Tuple[str, str, str]:
     recording_label    = f'{study_name}/{recording_name}'
@@ -112,44 +152,185 @@ def get_labels(study_name: str, recording_name: str, gt_token: str, sorter_name:
     sorting_label      = f'{sorter_name}/{recording_label}'
     return (recording_label, ground_truth_label, sorting_label)
 
-def populate_extractors(entry: RecordingEntry) -> Tuple[sv.LabboxEphysRecordingExtractor, sv.LabboxEphysSortingExtractor, sv.LabboxEphysSortingExtractor]:
-    recording = sv.LabboxEphysRecordingExtractor(entry.recording_uri, download=True)
+class ExtractorCache:
+    """Loads each recording and ground truth extractor once, however many entries (sorters) share it.
+    Safe to use from several threads: a thread asking for an extractor another is loading waits for it."""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._key_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._extractors: Dict[Tuple[str, str], Any] = {}
+
+    def _load_once(self, key: Tuple[str, str], load: Callable[[], Any]) -> Any:
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._extractors:
+                self._extractors[key] = load()
+            return self._extractors[key]
+
+    def recording(self, uri: str) -> sv.LabboxEphysRecordingExtractor:
+        return self._load_once(('recording', uri), lambda: sv.LabboxEphysRecordingExtractor(uri, download=True))
+
+    def ground_truth(self, uri: str, sample_rate: float) -> sv.LabboxEphysSortingExtractor:
+        return self._load_once(('ground_truth', uri), lambda: sv.LabboxEphysSortingExtractor(uri, samplerate=sample_rate))
+
+def populate_extractors(entry: RecordingEntry, cache: Union[ExtractorCache, None] = None) -> Tuple[sv.LabboxEphysRecordingExtractor, sv.LabboxEphysSortingExtractor, sv.LabboxEphysSortingExtractor]:
+    cache = cache or ExtractorCache()
+    recording = cache.recording(entry.recording_uri)
     sample_rate = recording.get_sampling_frequency()
-    sorting_true = sv.LabboxEphysSortingExtractor(entry.sorting_true_uri, samplerate=sample_rate)
+    sorting_true = cache.ground_truth(entry.sorting_true_uri, sample_rate)
     sorting = sv.LabboxEphysSortingExtractor(entry.sorting_object, samplerate=sample_rate)
     return (recording, sorting_true, sorting)
 
-def add_entry_to_workspace(re: FullRecordingEntry, workspace: sv.Workspace) -> None:
+def hydrate_entries(entries: Iterable[RecordingEntry], num_workers: int) -> Generator[Tuple[RecordingEntry, Tuple[Any, Any, Any]], None, None]:
+    """Yields each entry with its extractors (see populate_extractors), in the order of the entries, while up
+    to num_workers entries are loaded concurrently. At most 2 * num_workers loaded entries wait to be taken."""
+    cache = ExtractorCache()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending: Deque[Tuple[RecordingEntry, Future]] = deque()
+        for entry in entries:
+            pending.append((entry, executor.submit(populate_extractors, entry, cache)))
+            if len(pending) >= 2 * num_workers:
+                (done, future) = pending.popleft()
+                yield (done, future.result())
+        while len(pending) > 0:
+            (done, future) = pending.popleft()
+            yield (done, future.result())
+
+def add_entry_to_workspace(re: FullRecordingEntry, index: WorkspaceIndex) -> None:
     print_per_verbose(3, f"Hit live-load step. Current re values: r-id {re.R_id}, gt-exists: {re.gt_exists} sorting-exists: {re.sorting_exists}")
     R_id = re.R_id
     if R_id is None:
-        R_id = workspace.add_recording(recording=re.recording, label=re.recording_label)
+        R_id = index.add_recording(recording=re.recording, label=re.recording_label)
     if not re.gt_exists:
-        GT_id = workspace.add_sorting(sorting=re.sorting_true, recording_id=R_id, label=re.ground_truth_label)
+        GT_id = index.add_sorting(sorting=re.sorting_true, recording_id=R_id, label=re.ground_truth_label)
     if not re.sorting_exists:
-        s_id = workspace.add_sorting(sorting=re.sorting, recording_id=R_id, label=re.sorting_label)
+        s_id = index.add_sorting(sorting=re.sorting, recording_id=R_id, label=re.sorting_label)
     # TODO: Do something useful with the result codes here?
 
-def add_entry_dry_run(re: FullRecordingEntry) -> None:
-    print_per_verbose(3, f"Hit dry-run step. Current re values: r-id {re.R_id}, gt-exists: {re.gt_exists} sorting-exists: {re.sorting_exists}")
-    if re.R_id is not None:
+# Enough for any MDA header (at most 12 bytes plus 6 dimensions of 8 bytes)
+MDA_HEADER_BYTES = 200
+MDA_DTYPES = {-2: 'uint8', -3: 'float32', -4: 'int16', -5: 'int32', -6: 'uint16', -7: 'float64', -8: 'uint32'}
+
+def parse_mda_header(header: bytes) -> Tuple[str, List[int], int]:
+    """Returns the data type, the dimensions and the size in bytes of an MDA header: the data type code,
+    the bytes per entry, the number of dimensions (negative for 64-bit dimensions), then the dimensions."""
+    (dtype_code, _, num_dims) = struct.unpack('<iii', header[:12])
+    (dim_format, dim_bytes) = ('<q', 8) if num_dims < 0 else ('<i', 4)
+    dims = [struct.unpack(dim_format, header[12 + i * dim_bytes:12 + (i + 1) * dim_bytes])[0] for i in range(abs(num_dims))]
+    return (MDA_DTYPES[dtype_code], dims, 12 + abs(num_dims) * dim_bytes)
+
+def fetch_file_head(uri: str, num_bytes: int) -> Union[bytes, None]:
+    """The first num_bytes of a file, from the local kachery store if it is there, else by a range request
+    for only those bytes; None if they cannot be had."""
+    import requests
+    is_url = uri.startswith('http://') or uri.startswith('https://')
+    # (kachery_cloud downloads a URL whatever local_only says)
+    local_path = None if is_url else kc.load_file(uri, local_only=True)
+    if local_path is not None:
+        with open(local_path, 'rb') as f:
+            return f.read(num_bytes)
+    url = uri
+    if uri.startswith('sha1://'):
+        # kachery_cloud only downloads whole files, so ask its gateway where the file is (as load_file does)
+        from kachery_cloud._kachery_gateway_request import _kachery_gateway_request
+        response = _kachery_gateway_request({'type': 'findFile', 'hashAlg': 'sha1', 'hash': uri.split('?')[0].split('/')[2],
+                                             'zone': os.environ.get('KACHERY_ZONE', 'default')})
+        if not response['found']: return None
+        url = response['url']
+    elif not is_url:
+        return None
+    with requests.get(url, headers={'Range': f'bytes=0-{num_bytes - 1}'}, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        # A server ignoring the range sends the whole file; read only the start of it
+        return r.raw.read(num_bytes)
+
+def get_num_channels(recording_object: Any) -> Union[int, None]:
+    """Channel count of a recording object without downloading its raw data: from its channel locations
+    or channel ids, else from the header of the raw data file (read locally or fetched by itself)."""
+    if not isinstance(recording_object, dict): return None
+    data = recording_object if 'raw' in recording_object else recording_object.get('data', {})
+    if recording_object.get('recording_format', None) == 'subrecording':
+        if data.get('channel_ids', None) is not None: return len(data['channel_ids'])
+        return get_num_channels(data.get('recording', None))
+    if data.get('geom', None) is not None: return len(data['geom'])
+    if not isinstance(data.get('raw', None), str): return None
+    try:
+        header = fetch_file_head(data['raw'], MDA_HEADER_BYTES)
+    except Exception as e:
+        print_per_verbose(1, f"Unable to read the header of {data['raw']}: {e}")
+        return None
+    # A recording's first dimension is its channels
+    return None if header is None else parse_mda_header(header)[1][0]
+
+def count_firings_units(firings_uri: str) -> Union[int, None]:
+    # An MDA firings array has a row per spike event (channel, time, unit label), stored column by column
+    import numpy as np
+    path = kc.load_file(firings_uri)
+    if path is None: return None
+    with open(path, 'rb') as f:
+        (dtype, dims, header_bytes) = parse_mda_header(f.read(MDA_HEADER_BYTES))
+    firings = np.fromfile(path, dtype=dtype, offset=header_bytes).reshape(dims, order='F')
+    return len(np.unique(firings[2, :])) if dims[1] > 0 else 0
+
+def get_firings_uri(sorting_object: Any) -> Union[str, None]:
+    if not isinstance(sorting_object, dict): return None
+    if 'firings' in sorting_object: return sorting_object['firings']
+    if sorting_object.get('sorting_format', None) == 'mda': return sorting_object.get('data', {}).get('firings', None)
+    return None
+
+def summarize_entries(entries: Iterable[RecordingEntry]) -> Generator[RecordingEntry, None, None]:
+    """Yields each entry with its channel and unit counts filled in. Counts missing from the sortings file
+    are taken from the (small) recording object and the header of its raw data, and from the firings of
+    the sortings, each loaded once. Never downloads raw data."""
+    num_channels: Dict[str, Union[int, None]] = {}
+    num_units: Dict[str, Union[int, None]] = {}
+    def count_units(firings_uri: Union[str, None]) -> Union[int, None]:
+        if firings_uri is None: return None
+        if firings_uri not in num_units:
+            try:
+                num_units[firings_uri] = count_firings_units(firings_uri)
+            except Exception as e:
+                print_per_verbose(1, f"Unable to count the units of {firings_uri}: {e}")
+                num_units[firings_uri] = None
+        return num_units[firings_uri]
+    for entry in entries:
+        if entry.num_channels is not None:
+            num_channels[entry.recording_uri] = entry.num_channels
+        elif entry.recording_uri not in num_channels:
+            num_channels[entry.recording_uri] = get_num_channels(kc.load_json(entry.recording_uri))
+        yield entry._replace(
+            num_channels   = num_channels[entry.recording_uri],
+            num_true_units = entry.num_true_units if entry.num_true_units is not None \
+                                else count_units(get_firings_uri(kc.load_json(entry.sorting_true_uri))),
+            num_units      = entry.num_units if entry.num_units is not None else count_units(get_firings_uri(entry.sorting_object))
+        )
+
+def _fmt_count(count: Union[int, None]) -> str:
+    return '?' if count is None else str(count)
+
+def add_entry_dry_run(re: RecordingEntry, index: WorkspaceIndex) -> None:
+    R_id = index.recording_id(re.recording_label)
+    (gt_exists, sorting_exists) = (index.has_sorting(re.truth_label), index.has_sorting(re.sorting_label))
+    print_per_verbose(3, f"Hit dry-run step. Current re values: r-id {R_id}, gt-exists: {gt_exists} sorting-exists: {sorting_exists}")
+    if R_id is not None:
         print(f"Not adding {re.recording_label} as it is already in the workspace.")
     else:
-        print(f"Would add {re.recording.get_num_channels()}-channel recording with label {re.recording_label}")
-    if re.gt_exists:
-        print(f"Not adding {re.ground_truth_label} as it is already in the workspace.")
+        print(f"Would add {_fmt_count(re.num_channels)}-channel recording with label {re.recording_label}")
+    if gt_exists:
+        print(f"Not adding {re.truth_label} as it is already in the workspace.")
     else:
-        print(f"Would add GT at {len(re.sorting_true.get_unit_ids())} units with label {re.ground_truth_label}")
-    if re.sorting_exists:
+        print(f"Would add GT at {_fmt_count(re.num_true_units)} units with label {re.truth_label}")
+    if sorting_exists:
         print(f"Not adding {re.sorting_label} as it is already in the workspace.")
     else:
-        print(f"Would add sorting of {len(re.sorting.get_unit_ids())} unit(s) with label {re.sorting_label}")
+        print(f"Would add sorting of {_fmt_count(re.num_units)} unit(s) with label {re.sorting_label}")
 
 def parse_sortings(sortings: List[Any]) -> Generator[RecordingEntry, None, None]:
     for s in sortings:
         if 'sortingOutput' not in s: continue # when the underlying job errored
         name = s['recordingName']
-        (recording_label, gt_label, sorting_label) = get_labels(s['studyName'], name, TRUE_SORT_LABEL, s['sorterName'])
+        (recording_label, gt_label, sorting_label) = get_labels(s['studyName'], name, TRUE_SORT_LABEL, s.get('sorterLabel', s['sorterName']))
         yield RecordingEntry(
             study_set_label  = s['studyName'],
             recording_name   = name,
@@ -158,28 +339,34 @@ def parse_sortings(sortings: List[Any]) -> Generator[RecordingEntry, None, None]
             sorting_object   = s['sortingOutput'],
             recording_label  = recording_label,
             truth_label      = gt_label,
-            sorting_label    = sorting_label
+            sorting_label    = sorting_label,
+            num_channels     = s.get('numChannels', None),
+            num_true_units   = s.get('numTrueUnits', None),
+            num_units        = s.get('numUnits', None)
         )
 
 def main():
-    (workspace_uri, sortings_json, dry_run) = init()
-    workspace = None if workspace_uri is None else sv.load_workspace(workspace_uri)
+    (workspace_uri, sortings_json, dry_run, hydration_workers) = init()
+    index = WorkspaceIndex(None if workspace_uri is None else sv.load_workspace(workspace_uri))
     if workspace_uri is None and dry_run:
         workspace_uri = "(Dry run, no actual workspace written to)"
     loaded = 0
-    for r in parse_sortings(sortings_json):
-        (recording, sorting_true, sorting) = populate_extractors(r)
-        R_id = get_known_recording_id(workspace, r.recording_label)
-        (gt_exists, sorting_exists) = sortings_are_in_workspace(workspace, r.truth_label, r.sorting_label)
+    if dry_run:
+        # Only sizes are reported: load no recording data.
+        for r in summarize_entries(parse_sortings(sortings_json)):
+            add_entry_dry_run(re=r, index=index)
+            loaded += 1
+        print(f"Parsed {loaded} recording sets for workspace {workspace_uri}")
+        return
+    for (r, (recording, sorting_true, sorting)) in hydrate_entries(parse_sortings(sortings_json), hydration_workers):
+        R_id = index.recording_id(r.recording_label)
+        (gt_exists, sorting_exists) = (index.has_sorting(r.truth_label), index.has_sorting(r.sorting_label))
         entry = FullRecordingEntry(
             r.recording_label, r.truth_label, r.sorting_label,
             R_id, recording, sorting_true, sorting,
             gt_exists, sorting_exists
         )
-        if dry_run:
-            add_entry_dry_run(re=entry)
-        else:
-            add_entry_to_workspace(re=entry, workspace=workspace)
+        add_entry_to_workspace(re=entry, index=index)
         loaded += 1
     print(f"Parsed {loaded} recording sets for workspace {workspace_uri}")
 
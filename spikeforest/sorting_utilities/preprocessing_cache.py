@@ -0,0 +1,208 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Set, Tuple, Union
+
+from spikeforest._common.calling_framework import print_per_verbose
+from spikeforest.sorters._preprocessing import PREPROCESSING_VERSION, preprocess_recording_wrapper1
+from spikeforest.sorting_utilities.result_cache import canonicalize_params, get_recording_hash
+
+DEFAULT_PREPROCESSING_CACHE_PATH = os.getenv('SPIKEFOREST_PREPROCESSING_CACHE',
+    os.path.join(os.path.expanduser('~'), '.spikeforest', 'preprocessing-cache.sqlite'))
+DEFAULT_PREPROCESSING_CACHE_GB = 50.0
+
+
+class PreprocessingOffload(NamedTuple):
+    # Names of the sorter parameters which determine the preprocessing, mapped to the
+    # corresponding parameters of preprocess_recording_wrapper1
+    param_map: Dict[str, str]
+    # Sorter parameters to pass once the recording has been preprocessed
+    overrides: Dict[str, Any]
+
+# Sorters whose preprocessing can be done once, by preprocess_recording_wrapper1, and shared between
+# jobs. Only sorters which do exactly the same preprocessing belong here: e.g. SpykingCircus filters
+# with its own (different) filter, and the other sorters filter on the GPU or in MATLAB.
+PREPROCESSING_OFFLOADS: Dict[str, PreprocessingOffload] = {
+    'MountainSort4': PreprocessingOffload(
+        param_map={'filter': 'filter', 'freq_min': 'freq_min', 'freq_max': 'freq_max', 'whiten': 'whiten'},
+        overrides={'filter': False, 'whiten': False}
+    ),
+}
+
+def get_wrapper_defaults(fn: Callable) -> Dict[str, Any]:
+    try:
+        signature = inspect.signature(fn)
+    except (TypeError, ValueError):
+        return {}
+    return {name: p.default for (name, p) in signature.parameters.items() if p.default is not inspect.Parameter.empty}
+
+def get_preprocessing_params(sorter_name: str, sorter_fn: Callable, sorting_parameters: Dict[str, Any]) -> Union[Dict[str, Any], None]:
+    """Returns the preprocess_recording_wrapper1 parameters equivalent to the preprocessing the sorter
+    would do with these parameters, or None if there is nothing to share."""
+    if sorter_name not in PREPROCESSING_OFFLOADS: return None
+    offload = PREPROCESSING_OFFLOADS[sorter_name]
+    params = {**get_wrapper_defaults(sorter_fn), **sorting_parameters}
+    preprocessing = {target: params[source] for (source, target) in offload.param_map.items() if source in params}
+    if not preprocessing.get('filter', False) and not preprocessing.get('whiten', False): return None
+    return preprocessing
+
+def make_preprocessing_key(recording_hash: str, preprocessing_params: Dict[str, Any]) -> str:
+    key_source = json.dumps([recording_hash, PREPROCESSING_VERSION, canonicalize_params(preprocessing_params)])
+    return hashlib.sha1(key_source.encode()).hexdigest()
+
+def _raw_path(recording_object: dict) -> str:
+    return recording_object['data']['raw']
+
+
+class PreprocessingCache:
+    """Index of materialized preprocessed recordings, keyed by raw recording hash and preprocessing
+    parameters. The preprocessing jobs write the data into data_dir, which the cache owns; once the
+    files there exceed max_bytes in total, the least recently used entries not in use are dropped,
+    files and all, and materialized again when next needed.
+
+    Jobs read the files in place, so under slurm (or with a remote job handler) data_dir must be on
+    a filesystem the jobs can see.
+    """
+    def __init__(self, path: str, max_bytes: int, data_dir: Union[str, None] = None) -> None:
+        dirname = os.path.dirname(path)
+        if dirname != '': os.makedirs(dirname, exist_ok=True)
+        self._max_bytes = max_bytes
+        self.data_dir = os.path.abspath(data_dir if data_dir is not None else f'{os.path.splitext(path)[0]}-data')
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS preprocessed_recordings (
+            key TEXT PRIMARY KEY,
+            recording_hash TEXT,
+            params TEXT,
+            recording_object TEXT,
+            size_bytes INTEGER,
+            last_used REAL
+        )''')
+        self._connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def make_output_path(self, key: str) -> str:
+        # A new name for each materialization, so that the job cache never hands back an evicted file
+        return os.path.join(self.data_dir, f'{key}-{time.time_ns()}.mda')
+
+    def _owns(self, recording_object: dict) -> bool:
+        return os.path.dirname(_raw_path(recording_object)) == self.data_dir
+
+    def _delete(self, key: str, recording_object: dict) -> None:
+        if self._owns(recording_object) and os.path.exists(_raw_path(recording_object)):
+            os.remove(_raw_path(recording_object))
+        self._connection.execute('DELETE FROM preprocessed_recordings WHERE key = ?', (key,))
+
+    def get(self, key: str) -> Union[dict, None]:
+        row = self._connection.execute('SELECT recording_object FROM preprocessed_recordings WHERE key = ?', (key,)).fetchone()
+        recording_object = None if row is None else json.loads(row[0])
+        if recording_object is not None and self._owns(recording_object) and not os.path.exists(_raw_path(recording_object)):
+            # Removed behind our back
+            self._delete(key, recording_object)
+            self._connection.commit()
+            recording_object = None
+        if recording_object is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._connection.execute('UPDATE preprocessed_recordings SET last_used = ? WHERE key = ?', (time.time(), key))
+        self._connection.commit()
+        return recording_object
+
+    def put(self, key: str, recording_hash: str, params: Dict[str, Any], recording_object: dict) -> None:
+        size_bytes = os.path.getsize(_raw_path(recording_object)) if self._owns(recording_object) else 0
+        self._connection.execute('INSERT OR REPLACE INTO preprocessed_recordings VALUES (?, ?, ?, ?, ?, ?)',
+            (key, recording_hash, canonicalize_params(params), json.dumps(recording_object), size_bytes, time.time()))
+        self._connection.commit()
+
+    def evict(self, in_use: Set[str] = set()) -> List[str]:
+        """Drops the least recently used entries, other than those in in_use, until the files of
+        the rest fit in max_bytes. Returns the keys of the dropped entries."""
+        rows = self._connection.execute(
+            'SELECT key, recording_object, size_bytes FROM preprocessed_recordings ORDER BY last_used ASC').fetchall()
+        total = sum(size_bytes for (_, _, size_bytes) in rows)
+        evicted = []
+        for (key, recording_object, size_bytes) in rows:
+            if total <= self._max_bytes: break
+            if key in in_use: continue
+            print_per_verbose(2, f"Evicting preprocessed recording {key} ({size_bytes} bytes)")
+            self._delete(key, json.loads(recording_object))
+            total -= size_bytes
+            evicted.append(key)
+        self._connection.commit()
+        return evicted
+
+    def close(self) -> None:
+        print_per_verbose(1, f"Preprocessing cache: {self.hits} hit(s), {self.misses} miss(es).")
+        self._connection.close()
+
+
+class PreprocessingStage:
+    """Supplies the (shared) preprocessed recording for sorting jobs which opted in.
+
+    Within a run, all jobs needing the same preprocessing of the same recording depend on a single
+    preprocessing job; across runs, finished preprocessing is found in the PreprocessingCache. An
+    entry is in use (and kept from eviction) while its preprocessing job or a sorting job using it
+    (see add_user) has not finished.
+    """
+    def __init__(self, cache: PreprocessingCache, submit: Callable[[Any, Dict[str, Any]], Any]) -> None:
+        self._cache = cache
+        self._submit = submit
+        self._jobs: Dict[str, Any] = {}
+        # key -> (recording hash, preprocessing params, job), for jobs not yet added to the cache
+        self._pending: Dict[str, Any] = {}
+        self._users: Dict[str, List[Any]] = {}
+
+    def get_recording(self, recording_uri: str, recording_object: dict, preprocessing_params: Dict[str, Any]) -> Tuple[str, Any]:
+        """Returns the key of the preprocessing, and the preprocessed recording object or a job which
+        will produce it."""
+        recording_hash = get_recording_hash(recording_uri)
+        key = make_preprocessing_key(recording_hash, preprocessing_params)
+        if key in self._jobs:
+            return (key, self._jobs[key])
+        cached = self._cache.get(key)
+        if cached is not None:
+            return (key, cached)
+        print_per_verbose(2, f"Queueing preprocessing of {recording_uri} with {preprocessing_params}")
+        job = self._submit(preprocess_recording_wrapper1, {
+            'recording_object': recording_object,
+            **preprocessing_params,
+            'output_path': self._cache.make_output_path(key)
+        })
+        self._jobs[key] = job
+        self._pending[key] = (recording_hash, preprocessing_params, job)
+        return (key, job)
+
+    def add_user(self, key: str, job: Any) -> None:
+        self._users.setdefault(key, []).append(job)
+
+    def _in_use(self) -> Set[str]:
+        in_use = set(self._pending.keys())
+        for (key, jobs) in self._users.items():
+            self._users[key] = [job for job in jobs if job.status not in ('finished', 'error')]
+            if len(self._users[key]) > 0: in_use.add(key)
+        return in_use
+
+    def poll(self) -> None:
+        added = False
+        for (key, (recording_hash, preprocessing_params, job)) in list(self._pending.items()):
+            if job.status == 'finished':
+                self._cache.put(key, recording_hash, preprocessing_params, job.result.return_value)
+                added = True
+            elif job.status != 'error':
+                continue
+            del self._pending[key]
+        if added:
+            for key in self._cache.evict(self._in_use()):
+                # Materialized anew if a later job (e.g. a retry) needs it
+                self._jobs.pop(key, None)
+
+    def close(self) -> None:
+        self.poll()
+        # Jobs may still be running if the run was interrupted
+        self._cache.evict(self._in_use())
+        self._cache.close()
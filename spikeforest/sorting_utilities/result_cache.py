@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Union
+
+import kachery_cloud as kc
+
+from spikeforest._common.calling_framework import print_per_verbose
+
+# Sorting results are cached by what determines them: the raw recording data, the sorter wrapper
+# (name and version) and the sorting parameters. Unlike hither's job cache, the key does not depend
+# on hither internals or container tags, so it survives upgrades of either.
+DEFAULT_RESULT_CACHE_PATH = os.getenv('SPIKEFOREST_RESULT_CACHE',
+    os.path.join(os.path.expanduser('~'), '.spikeforest', 'sorting-result-cache.sqlite'))
+
+# Entry fields (a subset of OutputRecord) that are kept in the cache.
+CACHED_RECORD_FIELDS = ['sortingOutput', 'consoleOutUri', 'cpuTimeSec', 'wallTimeSec', 'sorterWallTimeSec',
+                        'telemetry', 'startTime', 'endTime', 'numThreads', 'numUnits']
+
+CacheEntry = Dict[str, Any]
+
+def canonicalize_params(params: Union[Dict[str, Any], None]) -> str:
+    return json.dumps(params or {}, sort_keys=True, separators=(',', ':'))
+
+def parse_sha1_uri(uri: str) -> Union[str, None]:
+    # e.g. sha1://0d1ae184564d358ace078c645026583fbb3d6fba/raw.mda?label=...
+    if not uri.startswith('sha1://'): return None
+    return uri[len('sha1://'):].split('/')[0].split('?')[0]
+
+_recording_hashes: Dict[str, str] = {}
+def get_recording_hash(recording_uri: str) -> str:
+    """Returns the SHA-1 of a recording's raw data file, reading only the (small) recording object.
+    Falls back to hashing the recording object itself if its raw data is not addressed by SHA-1.
+    """
+    if recording_uri not in _recording_hashes:
+        recording_object = kc.load_json(recording_uri)
+        assert recording_object is not None, f'Unable to load recording object {recording_uri}'
+        data = recording_object.get('data', recording_object)
+        raw_hash = parse_sha1_uri(data['raw']) if isinstance(data.get('raw', None), str) else None
+        if raw_hash is None:
+            raw_hash = hashlib.sha1(canonicalize_params(recording_object).encode()).hexdigest()
+        _recording_hashes[recording_uri] = raw_hash
+    return _recording_hashes[recording_uri]
+
+def make_cache_key(recording_hash: str, sorter_name: str, wrapper_version: str, params: Union[Dict[str, Any], None]) -> str:
+    key_source = json.dumps([recording_hash, sorter_name, wrapper_version, canonicalize_params(params)])
+    return hashlib.sha1(key_source.encode()).hexdigest()
+
+
+class SqliteResultIndex:
+    def __init__(self, path: str) -> None:
+        dirname = os.path.dirname(path)
+        if dirname != '': os.makedirs(dirname, exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS sorting_results (
+            key TEXT PRIMARY KEY,
+            recording_hash TEXT,
+            sorter_name TEXT,
+            wrapper_version TEXT,
+            params TEXT,
+            entry TEXT,
+            created REAL
+        )''')
+        self._connection.commit()
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        row = self._connection.execute('SELECT entry FROM sorting_results WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key: str, entry: CacheEntry, recording_hash: str, sorter_name: str, wrapper_version: str, params: str) -> None:
+        self._connection.execute('INSERT OR REPLACE INTO sorting_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, recording_hash, sorter_name, wrapper_version, params, json.dumps(entry), time.time()))
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class DirectoryResultStore:
+    """Keeps one JSON file per cache entry, so that several runs (possibly on different machines)
+    can share results through a shared directory. Files are written atomically.
+    """
+    def __init__(self, path: str) -> None:
+        self._path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self._path, key[:2], f'{key}.json')
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        try:
+            with open(self._entry_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+
+class SortingResultCache:
+    def __init__(self, index_path: str, shared_dir: Union[str, None] = None) -> None:
+        self._index = SqliteResultIndex(index_path)
+        self._shared = None if shared_dir is None else DirectoryResultStore(shared_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Union[CacheEntry, None]:
+        entry = self._index.get(key)
+        if entry is None and self._shared is not None:
+            entry = self._shared.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: CacheEntry, recording_hash: str, sorter_name: str, wrapper_version: str, params: Any) -> None:
+        self._index.put(key, entry, recording_hash, sorter_name, wrapper_version, canonicalize_params(params))
+        if self._shared is not None:
+            self._shared.put(key, entry)
+
+    def close(self) -> None:
+        print_per_verbose(1, f"Sorting result cache: {self.hits} hit(s), {self.misses} miss(es).")
+        self._index.close()
@@ -2,12 +2,36 @@
 
 from argparse import ArgumentParser, Namespace
 from datetime import datetime
+import inspect
 import json
 import os
+import shutil
+import sys
+import tempfile
 from typing import Any, Dict, Generator, List, NamedTuple, Tuple, TypedDict, Union
 import yaml
 
-from spikeforest._common.calling_framework import StandardArgs, add_standard_args, call_cleanup, extract_hither_config, _fmt_time, parse_shared_configuration, print_per_verbose
+from spikeforest._common.calling_framework import HitherConfiguration, StandardArgs, add_standard_args, call_cleanup, extract_hither_config, _fmt_time, iterate_completed_jobs, make_retry_policy, parse_shared_configuration, print_per_verbose, start_pipeline_metrics, start_trace
+from spikeforest._common.pipeline_metrics import PipelineMetrics
+from spikeforest._common.retry_policy import FailureCause, RetryScheduler, get_failure_causes
+from spikeforest._common.thread_budget import NUM_THREADS_PARAM
+from spikeforest._common.trace import TraceRecorder, maybe_span
+from spikeforest.sorters._staging import STAGING_GB_PARAM
+from spikeforest.sorters._telemetry import unpack_sorter_result
+from spikeforest.sorters._stitching import stitch_shard_sortings_wrapper1
+from spikeforest.sorters.kilosort2 import KILOSORT2_WRAPPER1_VERSION
+from spikeforest.sorters.kilosort3 import KILOSORT3_WRAPPER1_VERSION
+from spikeforest.sorters.mountainsort4 import MOUNTAINSORT4_WRAPPER1_VERSION
+from spikeforest.sorters.spykingcircus import SPYKINGCIRCUS_WRAPPER1_VERSION
+from spikeforest.sorters.tridesclous import TRIDESCLOUS_WRAPPER1_VERSION
+from spikeforest._common.job_dispatch import JobDispatcher, ResourceClass, count_pool_slots, parse_resource_class
+from spikeforest.sorting_utilities.output_records import JSONL_SUFFIX, OutputRecordSink, compact_jsonl, get_jsonl_path, read_jsonl, write_json_array
+from spikeforest.sorting_utilities.result_cache import CACHED_RECORD_FIELDS, DEFAULT_RESULT_CACHE_PATH, CacheEntry, SortingResultCache, get_recording_hash, make_cache_key
+from spikeforest.sorting_utilities.parameter_sweeps import SweepSpec, check_wrapper_params, expand_sorter_params, parse_sweep
+from spikeforest.sorting_utilities.preprocessing_cache import DEFAULT_PREPROCESSING_CACHE_GB, DEFAULT_PREPROCESSING_CACHE_PATH, PREPROCESSING_OFFLOADS, PreprocessingCache, PreprocessingStage, get_preprocessing_params
+from spikeforest.sorting_utilities.sharding import Shard, ShardingSpec, get_channel_locations, make_shard_recording_object, make_shards, parse_sharding
+from spikeforest.sorting_utilities.cost_estimate import JobEstimate, estimate_costs, format_cost_estimate, recording_bytes
+from spikeforest.sorting_utilities.job_ordering import JOB_ORDER_LPT, JOB_ORDER_SPEC, JOB_ORDERS, RuntimeModel, estimate_runtime_sec, load_runtime_model, order_jobs, recording_size
 import spikeextractors as se
 import spikeforest as sf
 import hither2 as hi
@@ -24,6 +48,21 @@ KNOWN_SORTERS = {
     'Kilosort2':     sf.kilosort2_wrapper1,
     'Kilosort3':     sf.kilosort3_wrapper1,
 }
+# Versions of the wrapper functions above (as in their @hi.function decorators), used to key the
+# sorting result cache.
+KNOWN_SORTER_VERSIONS = {
+    'SpykingCircus': SPYKINGCIRCUS_WRAPPER1_VERSION,
+    'MountainSort4': MOUNTAINSORT4_WRAPPER1_VERSION,
+    'Tridesclous':   TRIDESCLOUS_WRAPPER1_VERSION,
+    'Kilosort2':     KILOSORT2_WRAPPER1_VERSION,
+    'Kilosort3':     KILOSORT3_WRAPPER1_VERSION,
+}
+# GPUs used by each job of the wrappers above which run on the GPU (those with nvidia_support in their
+# @hi.function decorators), for cost estimates of sorters with no (or CPU-only) resources in the spec.
+KNOWN_SORTER_GPUS = {
+    'Kilosort2': 1,
+    'Kilosort3': 1,
+}
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
@@ -31,12 +70,26 @@ DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 class ArgsDict(TypedDict):
     study_source_file: str
     sorter_spec_file: str
+    job_order: str
+    runtime_history_uri: Union[str, None]
+    result_cache_path: Union[str, None]
+    result_cache_dir: Union[str, None]
+    preprocessing_cache_path: str
+    preprocessing_cache_gb: float
+    preprocessing_cache_dir: Union[str, None]
+    stdout_jsonl: bool
+    estimate: bool
 
 class RecordingRecord(NamedTuple):
     study_name: str
     recording_name: str
     recording_uri: str
     ground_truth_uri: str
+    # Size information from the study set file, where available (0 if unknown)
+    num_channels: int = 0
+    duration_sec: float = 0.0
+    sample_rate_hz: float = 0.0
+    num_true_units: int = 0
 
 class StudyRecord(NamedTuple):
     study_name: str
@@ -46,7 +99,21 @@ StudySetsDict = Dict[str, List[StudyRecord]]
 
 class SorterRecord(NamedTuple):
     sorter_name: str
-    sorting_parameters: Any # at present, this is in practice always an empty object
+    sorting_parameters: Dict[str, Any] # passed to the wrapper function
+    resources: Union[ResourceClass, None] = None # None: run on the default job handler
+    sweep: Union[SweepSpec, None] = None # expanded by populate_sorting_matrix
+    # Distinguishes the variants of a parameter sweep (e.g. 'MountainSort4[detect_threshold=4]');
+    # empty for sorters without a sweep. Use the label property.
+    sorter_label: str = ''
+    # If set, the recording is preprocessed by a separate job, shared by all jobs which need the same
+    # preprocessing of the same recording (see preprocessing_cache.py).
+    share_preprocessing: bool = False
+    # If set, large recordings are split into shards, sorted separately and stitched (see sharding.py).
+    sharding: Union[ShardingSpec, None] = None
+
+    @property
+    def label(self) -> str:
+        return self.sorter_label or self.sorter_name
 
 class SortingJob(NamedTuple):
     recording_name: str
@@ -56,6 +123,12 @@ class SortingJob(NamedTuple):
     sorter_name: str
     params: Any
     sorting_job: hi.Job
+    sorter_label: str
+    sharding: Union[ShardingSpec, None] = None
+    attempt: int = 1                 # 1 for the first attempt; retries (see make_retry_scheduler) count up
+    failure_causes: List[str] = []   # causes of the failed earlier attempts
+    num_channels: int = 0            # from the study set (0 if unknown)
+    num_true_units: int = 0
 
 class SorterStudyMatrixEntry(NamedTuple):
     sorter_record: SorterRecord
@@ -66,23 +139,41 @@ class SortingMatrixEntry(NamedTuple):
     sorter_record: SorterRecord
     requested_recordings: List[RecordingRecord]
 
-# Key is a sorter-name; value is a Tuple of SorterRecord, List[RecordingRecord]
+# Key is a sorter label; value is a Tuple of SorterRecord, List[RecordingRecord]
 SortingMatrixDict = Dict[str, SortingMatrixEntry]
 
+# One cell of the sorting matrix
+class SortingRequest(NamedTuple):
+    sorter: SorterRecord
+    recording: RecordingRecord
+    estimate_sec: float = 0.0 # estimated runtime, if order_sorting_requests needed one (0 if unknown)
+
 # TypedDict is JSON-serializable, while NamedTuple isn't
 class OutputRecord(TypedDict):
     recordingName: str
     studyName: str
     sorterName: str
+    sorterLabel: str       # equal to sorterName, except for the variants of a parameter sweep
     sortingParameters: Any
     consoleOutUri: str
-    cpuTimeSec: float
+    cpuTimeSec: float      # CPU time (user + sys, including child processes) of the sort phase
+    wallTimeSec: float     # wall-clock time of the whole job, including container startup and data staging
+    sorterWallTimeSec: float # wall-clock time of the sort phase
+    telemetry: Union[Dict[str, Any], None] # full telemetry from the sorter wrapper, including per-phase breakdown
     errored: bool
     startTime: str
     endTime: str
     sortingOutput: Union[str, None]
     recordingUri: str
     groundTruthUri: str
+    cacheHit: bool
+    numThreads: Union[int, None] # threads the sorter ran with (see --thread-policy); None if not reported
+    attemptCount: int      # times the job was run (0 for cached results)
+    attemptCauses: List[str] # causes of the failed attempts, e.g. 'transient:download-timeout', 'deterministic:sorter-error'
+    # Sizes, so that the records can be summarized without downloading the data (None if unknown)
+    numChannels: Union[int, None]
+    numTrueUnits: Union[int, None]
+    numUnits: Union[int, None] # units found by the sorter
 
 
 def init_configuration() -> Tuple[ArgsDict, StandardArgs]:
@@ -111,12 +202,54 @@ def init_sorting_args(parser: ArgumentParser) -> ArgumentParser:
         "option will override any value specified in the sorter spec file.")
     parser.add_argument('--sorter-spec-file', '-l', action='store',
         help="Path or kachery URI for the YAML file which contains the sorters to run, with parameters.")
+    parser.add_argument('--job-order', action='store', choices=JOB_ORDERS, default=JOB_ORDER_LPT,
+        help="Order in which sorting jobs are submitted. 'spec' submits them sorter by sorter, as listed in the " +
+        "spec file (but grouped by recording); 'lpt' submits the recordings with the longest total estimated runtime " +
+        "first, keeping the jobs of each recording together. Runtimes are estimated " +
+        "from the historical runtimes in the SpikeForest sorting-outputs catalog. Default 'lpt'.")
+    parser.add_argument('--runtime-history-uri', action='store', default=None,
+        help="Kachery URI of a sorting-outputs catalog to use for runtime estimates, instead of the default one.")
+    parser.add_argument('--result-cache', action='store', default=DEFAULT_RESULT_CACHE_PATH,
+        help="Path of the SQLite index of cached sorting results, keyed by raw recording hash, sorter, wrapper " +
+        "version and parameters. Sortings found there are not re-run. Default: $SPIKEFOREST_RESULT_CACHE or " +
+        "~/.spikeforest/sorting-result-cache.sqlite.")
+    parser.add_argument('--result-cache-dir', action='store', default=None,
+        help="If set, cached sorting results are also read from and written to this (e.g. shared) directory.")
+    parser.add_argument('--no-result-cache', action='store_true', default=False,
+        help="If set, the sorting result cache is neither consulted nor updated.")
+    parser.add_argument('--preprocessing-cache', action='store', default=DEFAULT_PREPROCESSING_CACHE_PATH,
+        help="Path of the SQLite index of preprocessed recordings shared between sorting jobs (for sorters " +
+        "with 'preprocessing: shared' in the spec file). Default: $SPIKEFOREST_PREPROCESSING_CACHE or " +
+        "~/.spikeforest/preprocessing-cache.sqlite.")
+    parser.add_argument('--preprocessing-cache-gb', action='store', type=float, default=DEFAULT_PREPROCESSING_CACHE_GB,
+        help="Size limit of the preprocessed recordings kept in --preprocessing-cache-dir; once it is exceeded, " +
+        "the least recently used ones not needed by a queued or running job are deleted. " +
+        f"Default {DEFAULT_PREPROCESSING_CACHE_GB}.")
+    parser.add_argument('--preprocessing-cache-dir', action='store', default=None,
+        help="Directory the preprocessing jobs write the preprocessed recordings to, and the sorting jobs read " +
+        "them from (so, under slurm, on a shared filesystem). Default: the --preprocessing-cache path " +
+        "without its extension, followed by -data.")
+    parser.add_argument('--stdout-jsonl', action='store_true', default=False,
+        help="If set and no --outfile is given, the output records are written to STDOUT as JSON Lines (one record " +
+        "per line) as their jobs complete, instead of as one JSON array once all jobs are done.")
+    parser.add_argument('--estimate', action='store_true', default=False,
+        help="Dry run: expand the sorting matrix and report the data to download, cache hits, projected " +
+        "CPU/GPU hours and makespan for the given worker or slurm configuration, then quit without sorting.")
     return parser
 
 def parse_argsdict(parsed: Namespace) -> ArgsDict:
     args: ArgsDict = {
         'study_source_file': '',
-        'sorter_spec_file': ''
+        'sorter_spec_file': '',
+        'job_order': parsed.job_order,
+        'runtime_history_uri': parsed.runtime_history_uri,
+        'result_cache_path': None if parsed.no_result_cache else parsed.result_cache,
+        'result_cache_dir': None if parsed.no_result_cache else parsed.result_cache_dir,
+        'preprocessing_cache_path': parsed.preprocessing_cache,
+        'preprocessing_cache_gb': parsed.preprocessing_cache_gb,
+        'preprocessing_cache_dir': parsed.preprocessing_cache_dir,
+        'stdout_jsonl': parsed.stdout_jsonl,
+        'estimate': parsed.estimate
     }
     args['sorter_spec_file'] = parsed.sorter_spec_file
     if args['sorter_spec_file'] is None or not os.path.exists(args['sorter_spec_file']):
@@ -131,6 +264,29 @@ def parse_argsdict(parsed: Namespace) -> ArgsDict:
         raise FileNotFoundError(f"Requested study source file {args['study_source_file']} does not exist.")
     return args
 
+# The sorter spec file is a YAML file of the form:
+# studysets: <path or uri of the study sets JSON file>
+# studyset_names: [PAIRED_BOYDEN, SYNTH_MAGLAND, ...]
+# spike_sorters:
+#   - name: Kilosort2              --> must be a key of KNOWN_SORTERS
+#     params: {}                   --> passed to the wrapper function
+#     studysets: [PAIRED_BOYDEN]
+#     sweep:                       --> optional; runs each combination as a separate sorter variant
+#       mode: grid                 --> grid (every combination) or random (then also num_samples and seed)
+#       params:
+#         detect_threshold: [3, 4, 5]
+#     preprocessing: shared        --> optional; filter/whiten once per recording in a separate job (MountainSort4 only)
+#     sharding:                    --> optional; sort groups of channels as separate jobs, then stitch the results
+#       mode: spatial              --> spatial (bins along the probe) or groups (then also groups: [[0, 1, ...], ...])
+#       max_channels: 16           --> spatial only: core channels per shard
+#       guard_um: 50               --> channels this close to a shard's core are also given to it
+#       min_channels: 32           --> recordings with fewer channels are sorted whole
+#     resources:                   --> optional; jobs of sorters with the same resources share a job handler pool
+#       cpus: 4
+#       gpus: 1
+#       memory_gb: 32
+#       max_concurrent: 2          --> pool concurrency (slurm: simultaneous allocations)
+#       partition: gpu             --> slurm only; defaults to --slurm-partition
 def parse_sorters(spec_filename: str, known_study_sets: List[str]) -> SorterStudyMatrixDict:
     with open(spec_filename) as file:
         spec_yaml = yaml.safe_load(file)
@@ -141,9 +297,21 @@ def parse_sorters(spec_filename: str, known_study_sets: List[str]) -> SorterStud
         raise Exception(f"Spec file references study sets not recorded in study set file:\n\t{bad}")
     sorting_matrix: SorterStudyMatrixDict = {}
     for sorter in spec_yaml['spike_sorters']:
-        s: SorterRecord = SorterRecord(sorter_name=sorter['name'], sorting_parameters=sorter['params'])
+        s: SorterRecord = SorterRecord(
+            sorter_name=sorter['name'],
+            sorting_parameters=sorter.get('params', None) or {},
+            resources=parse_resource_class(sorter.get('resources', None)),
+            sweep=parse_sweep(sorter.get('sweep', None), sorter['name']),
+            share_preprocessing=sorter.get('preprocessing', None) == 'shared',
+            sharding=parse_sharding(sorter.get('sharding', None), sorter['name'])
+        )
         if s.sorter_name not in list(KNOWN_SORTERS.keys()):
             raise Exception(f"Spec file {spec_filename} requested unrecognized sorter {s.sorter_name}.")
+        if s.share_preprocessing and s.sorter_name not in PREPROCESSING_OFFLOADS:
+            raise Exception(f"Spec file {spec_filename} requested shared preprocessing for {s.sorter_name}, " +
+                f"which is only supported for {list(PREPROCESSING_OFFLOADS.keys())}.")
+        swept_params = [] if s.sweep is None else list(s.sweep.params.keys())
+        check_wrapper_params(s.sorter_name, KNOWN_SORTERS[s.sorter_name], list(s.sorting_parameters.keys()) + swept_params)
         requested_study_sets: List[str] = sorter['studysets']
         if not all(elem in declared_study_sets for elem in requested_study_sets):
             err = f"Sorter record {s.sorter_name} requests an unknown study. " + \
@@ -161,12 +329,15 @@ def populate_sorting_matrix(study_matrix: SorterStudyMatrixDict, study_sets: Stu
     detailed_matrix: SortingMatrixDict = {}
     for sorter_name in study_matrix.keys():
         (sorter, study_set_names) = study_matrix[sorter_name]
-        detailed_matrix[sorter_name] = SorterStudyMatrixEntry(
-            sorter_record = sorter,
-            requested_studies=[x for name in study_set_names
-                                    for study in study_sets[name]
-                                        for x in study.recordings]
-        )
+        recordings = [x for name in study_set_names
+                        for study in study_sets[name]
+                            for x in study.recordings]
+        # Each variant of a parameter sweep becomes a separate column of the matrix.
+        for (label, params) in expand_sorter_params(sorter.sorter_name, sorter.sorting_parameters, sorter.sweep):
+            detailed_matrix[label] = SortingMatrixEntry(
+                sorter_record = sorter._replace(sorting_parameters=params, sorter_label=label),
+                requested_recordings=list(recordings)
+            )
     return detailed_matrix
 
 def load_study_records(study_set_file: str) -> StudySetsDict:
@@ -206,7 +377,11 @@ def make_study_records_from_studyset(study_set: Any) -> List[StudyRecord]:
                                 study_name       = study['name'],
                                 recording_name   = r['name'],
                                 recording_uri    = r['recordingUri'],
-                                ground_truth_uri = r['sortingTrueUri']
+                                ground_truth_uri = r['sortingTrueUri'],
+                                num_channels     = r.get('numChannels', 0),
+                                duration_sec     = r.get('durationSec', 0.0),
+                                sample_rate_hz   = r.get('sampleRateHz', 0.0),
+                                num_true_units   = r.get('numTrueUnits', 0)
                             )
                             for r in study['recordings']]
             )
@@ -241,44 +416,232 @@ def make_study_records_from_studyset(study_set: Any) -> List[StudyRecord]:
 #     "recordingUri": "sha1://05536d7a37efb3f5f2ca42c987964f199305f480/20160415_patch2.json",
 #     "sortingTrueUri": "sha1://71eea1fbe545bacf12884711baab387dce7160e1/20160415_patch2.firings_true.json"
 # }
-def queue_sort(sorter: SorterRecord, recording: RecordingRecord) -> hi.Job:
+def load_recording_object(recording: RecordingRecord) -> dict:
+    base_recording = sv.LabboxEphysRecordingExtractor(recording.recording_uri, download=True)
+    return base_recording.object()
+
+def accepts_param(fn: Any, name: str) -> bool:
+    try:
+        return name in inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return False
+
+def queue_sort(
+    sorter: SorterRecord,
+    recording: RecordingRecord,
+    dispatcher: Union[JobDispatcher, None] = None,
+    recording_object: Union[dict, None] = None,
+    estimate_sec: float = 0.0
+) -> hi.Job:
     if sorter.sorter_name not in KNOWN_SORTERS.keys():
         raise Exception(f'Sorter {sorter.sorter_name} was requested but is not recognized.')
     sort_fn = KNOWN_SORTERS[sorter.sorter_name]
 
-    base_recording = sv.LabboxEphysRecordingExtractor(recording.recording_uri, download=True)
     params = {
-        'recording_object': base_recording.object()
+        'recording_object': recording_object if recording_object is not None else load_recording_object(recording),
+        **sorter.sorting_parameters
     }
+    # Set by the dispatcher (thread policy, staging budget); not sorting parameters, nor part of the result cache key.
+    if accepts_param(sort_fn, NUM_THREADS_PARAM):
+        params[NUM_THREADS_PARAM] = 1
+    if accepts_param(sort_fn, STAGING_GB_PARAM):
+        params[STAGING_GB_PARAM] = 0
+    if dispatcher is not None:
+        return dispatcher.submit(sort_fn, params, sorter.resources, estimate_sec)
     return hi.Job(sort_fn, params)
 
-def sorting_loop(sorting_matrix: SortingMatrixDict) -> Generator[SortingJob, None, None]:
-    for sorter_name in sorting_matrix.keys():
-        print_per_verbose(3, f"Queueing sort for sorter {sorter_name}")
-        (sorter, recordings) = sorting_matrix[sorter_name]
-        for recording in recordings:
-            yield SortingJob(
-                recording_name   = recording.recording_name,
-                recording_uri    = recording.recording_uri,
-                ground_truth_uri = recording.ground_truth_uri,
-                study_name       = recording.study_name,
-                sorter_name      = sorter.sorter_name,
-                params           = sorter.sorting_parameters,
-                sorting_job      = queue_sort(sorter, recording)
-            )
+def expand_sorting_matrix(sorting_matrix: SortingMatrixDict) -> List[SortingRequest]:
+    requests = [SortingRequest(sorter=sorter, recording=recording)
+                    for (sorter, recordings) in sorting_matrix.values()
+                        for recording in recordings]
+    # Keep the jobs which share a recording together (in order of first appearance), so that they
+    # reuse its staged inputs instead of each one fetching them at a different time.
+    first_index: Dict[str, int] = {}
+    for (i, r) in enumerate(requests):
+        first_index.setdefault(r.recording.recording_uri, i)
+    return sorted(requests, key=lambda r: first_index[r.recording.recording_uri])
+
+def order_sorting_requests(
+    requests: List[SortingRequest],
+    args: ArgsDict,
+    std_args: StandardArgs,
+    model: Union[RuntimeModel, None] = None
+) -> List[SortingRequest]:
+    # Runtime estimates are needed to order the jobs, and by the adaptive slurm allocation policy.
+    if args['job_order'] == JOB_ORDER_SPEC and not std_args['slurm_adaptive']: return requests
+    if model is None:
+        model = load_runtime_model(args['runtime_history_uri'])
+    estimates = [
+        estimate_runtime_sec(model, r.sorter.sorter_name, r.recording.study_name, r.recording.recording_name,
+                             recording_size(r.recording.num_channels, r.recording.duration_sec))
+        for r in requests
+    ]
+    requests = [r._replace(estimate_sec=estimate) for (r, estimate) in zip(requests, estimates)]
+    if args['job_order'] == JOB_ORDER_SPEC: return requests
+    groups = [r.recording.recording_uri for r in requests]
+    return [requests[i] for i in order_jobs(estimates, args['job_order'], count_pool_slots(std_args, None), groups)]
+
+def estimate_sorting_cost(requests: List[SortingRequest], args: ArgsDict, std_args: StandardArgs) -> str:
+    model = load_runtime_model(args['runtime_history_uri'])
+    cache = open_result_cache(args)
+    try:
+        (_, cached) = split_cached_requests(requests, cache)
+    finally:
+        if cache is not None: cache.close()
+    cached_requests = set(id(request) for (request, _) in cached)
+    jobs = [
+        JobEstimate(
+            sorter_label    = r.sorter.label,
+            recording_uri   = r.recording.recording_uri,
+            resources       = r.sorter.resources,
+            runtime_sec     = estimate_runtime_sec(model, r.sorter.sorter_name, r.recording.study_name, r.recording.recording_name,
+                                                   recording_size(r.recording.num_channels, r.recording.duration_sec)),
+            cached          = id(r) in cached_requests,
+            recording_bytes = recording_bytes(r.recording.num_channels, r.recording.duration_sec, r.recording.sample_rate_hz),
+            wrapper_gpus    = KNOWN_SORTER_GPUS.get(r.sorter.sorter_name, 0)
+        )
+        for r in requests
+    ]
+    return format_cost_estimate(estimate_costs(jobs, lambda resources: count_pool_slots(std_args, resources)))
+
+def apply_shared_preprocessing(
+    sorter: SorterRecord,
+    recording: RecordingRecord,
+    recording_object: dict,
+    preprocessing: PreprocessingStage
+) -> Tuple[SorterRecord, Any, Union[str, None]]:
+    """Returns the sorter (with its own preprocessing switched off), the preprocessed recording
+    (or the job which will produce it) to sort instead of the raw recording, and its key in the
+    preprocessing cache (None if nothing is preprocessed)."""
+    params = get_preprocessing_params(sorter.sorter_name, KNOWN_SORTERS[sorter.sorter_name], sorter.sorting_parameters)
+    if params is None:
+        return (sorter, recording_object, None)
+    (key, preprocessed) = preprocessing.get_recording(recording.recording_uri, recording_object, params)
+    # The recorded sorting parameters (and the result cache key) stay those of the spec file.
+    offloaded = sorter._replace(sorting_parameters={**sorter.sorting_parameters, **PREPROCESSING_OFFLOADS[sorter.sorter_name].overrides})
+    return (offloaded, preprocessed, key)
+
+def queue_sharded_sort(
+    sorter: SorterRecord,
+    recording: RecordingRecord,
+    dispatcher: Union[JobDispatcher, None],
+    recording_object: Any,
+    shards: List[Shard],
+    estimate_sec: float = 0.0
+) -> hi.Job:
+    print_per_verbose(2, f"Sorting {recording.study_name}/{recording.recording_name} with {sorter.label} in {len(shards)} shards")
+    shard_jobs = [queue_sort(sorter, recording, dispatcher, make_shard_recording_object(recording_object, shard), estimate_sec / len(shards))
+                    for shard in shards]
+    params = {
+        'recording_object': recording_object,
+        'shard_results': shard_jobs,
+        'shards': [(shard.channel_ids, shard.core_channel_ids) for shard in shards],
+        'agreement_threshold': sorter.sharding.agreement_threshold
+    }
+    if dispatcher is not None:
+        return dispatcher.submit(stitch_shard_sortings_wrapper1, params)
+    return hi.Job(stitch_shard_sortings_wrapper1, params)
+
+def sorting_loop(
+    requests: List[SortingRequest],
+    dispatcher: Union[JobDispatcher, None] = None,
+    preprocessing: Union[PreprocessingStage, None] = None,
+    metrics: Union[PipelineMetrics, None] = None,
+    trace: Union[TraceRecorder, None] = None
+) -> Generator[SortingJob, None, None]:
+    # Several jobs (e.g. the variants of a parameter sweep) may share a recording; download it once.
+    recording_objects: Dict[str, dict] = {}
+    for request in requests:
+        (sorter, recording) = (request.sorter, request.recording)
+        print_per_verbose(3, f"Queueing sort for sorter {sorter.label} on {recording.study_name}/{recording.recording_name}")
+        if recording.recording_uri not in recording_objects:
+            with maybe_span(trace, 'download recording object', args={'recording': f'{recording.study_name}/{recording.recording_name}'}):
+                recording_objects[recording.recording_uri] = load_recording_object(recording)
+            if metrics is not None:
+                metrics.record_input_estimate(recording_bytes(recording.num_channels, recording.duration_sec, recording.sample_rate_hz))
+        raw_object = recording_objects[recording.recording_uri]
+        (job_sorter, job_recording, preprocessing_key) = (sorter, raw_object, None)
+        if sorter.share_preprocessing and preprocessing is not None:
+            (job_sorter, job_recording, preprocessing_key) = apply_shared_preprocessing(sorter, recording, raw_object, preprocessing)
+        shards = []
+        if sorter.sharding is not None:
+            locations = get_channel_locations(raw_object)
+            if locations is None:
+                print(f"WARNING: No channel locations for {recording.study_name}/{recording.recording_name}; sorting it whole.")
+            else:
+                shards = make_shards(locations, sorter.sharding)
+        if len(shards) > 0:
+            sorting_job = queue_sharded_sort(job_sorter, recording, dispatcher, job_recording, shards, request.estimate_sec)
+        else:
+            sorting_job = queue_sort(job_sorter, recording, dispatcher, job_recording, request.estimate_sec)
+        if preprocessing_key is not None:
+            preprocessing.add_user(preprocessing_key, sorting_job)
+        if metrics is not None:
+            metrics.track(sorter.sorter_name, sorting_job, recording.duration_sec)
+        if trace is not None:
+            trace.label_job(sorting_job, f'{sorter.label} {recording.study_name}/{recording.recording_name}')
+        yield SortingJob(
+            recording_name   = recording.recording_name,
+            recording_uri    = recording.recording_uri,
+            ground_truth_uri = recording.ground_truth_uri,
+            study_name       = recording.study_name,
+            sorter_name      = sorter.sorter_name,
+            params           = sorter.sorting_parameters,
+            sorting_job      = sorting_job,
+            sorter_label     = sorter.label,
+            sharding         = sorter.sharding,
+            num_channels     = recording.num_channels,
+            num_true_units   = recording.num_true_units
+        )
+
+def make_retry_scheduler(
+    std_args: StandardArgs,
+    hither_config: HitherConfiguration,
+    requests: List[SortingRequest],
+    sortings: List[SortingJob],
+    dispatcher: JobDispatcher,
+    preprocessing: Union[PreprocessingStage, None] = None,
+    metrics: Union[PipelineMetrics, None] = None,
+    trace: Union[TraceRecorder, None] = None
+) -> RetryScheduler:
+    """Makes the RetryScheduler which queues the sorting of a request again (through sorting_loop)
+    when its job fails transiently. sortings must be the jobs sorting_loop made for requests."""
+    request_of = {id(sorting): request for (sorting, request) in zip(sortings, requests)}
+    def resubmit(sorting: SortingJob, cause: FailureCause) -> SortingJob:
+        request = request_of.pop(id(sorting))
+        print_per_verbose(1, f"Retrying {sorting.sorter_label} on {sorting.study_name}/{sorting.recording_name} " +
+                             f"(attempt {sorting.attempt + 1}) after a transient failure: {cause.reason}")
+        with hi.Config(**hither_config):
+            retried = next(sorting_loop([request], dispatcher, preprocessing, metrics, trace))
+        retried = retried._replace(attempt=sorting.attempt + 1, failure_causes=sorting.failure_causes + [str(cause)])
+        request_of[id(retried)] = request
+        return retried
+    return RetryScheduler(make_retry_policy(std_args), lambda sorting: sorting.attempt, resubmit)
 
 def make_output_record(job: SortingJob) -> OutputRecord:
     errored = job.sorting_job.status == "error"
+    telemetry = None
+    num_units = None
     if (errored):
         stored_sorting = None
     else:
-        sorting = sv.LabboxEphysSortingExtractor(job.sorting_job.result.return_value)
+        (sorting_object, telemetry) = unpack_sorter_result(job.sorting_job.result.return_value)
+        sorting = sv.LabboxEphysSortingExtractor(sorting_object)
         stored_sorting = sv.LabboxEphysSortingExtractor.store_sorting(sorting)
+        num_units = len(sorting.get_unit_ids())
     console = kc.store_json(job.sorting_job._console_lines)
     try:
         elapsed = job.sorting_job.timestamp_completed - job.sorting_job.timestamp_started
     except:
         elapsed = 0.0
+    sort_phases = [] if telemetry is None else [p for p in telemetry['phases'] if p['name'] == 'sort']
+    if len(sort_phases) > 0:
+        cpu_time = sum(p['cpu_sec'] for p in sort_phases)
+        sorter_wall_time = sum(p['wall_sec'] for p in sort_phases)
+    else:
+        # No telemetry (errored job, or an older wrapper version): fall back to the job's elapsed time.
+        cpu_time = elapsed
+        sorter_wall_time = elapsed
 
     # Can't do this--sorting_job is not json-serializable.
     # TODO: Implement a __str__ method for hi2.Job
@@ -288,43 +651,170 @@ def make_output_record(job: SortingJob) -> OutputRecord:
         'recordingName': job.recording_name,
         'studyName': job.study_name,
         'sorterName': job.sorter_name,
+        'sorterLabel': job.sorter_label,
         'sortingParameters': job.params,
         'consoleOutUri': console,
-        'cpuTimeSec': elapsed,
+        'cpuTimeSec': cpu_time,
+        'wallTimeSec': elapsed,
+        'sorterWallTimeSec': sorter_wall_time,
+        'telemetry': telemetry,
         'errored': errored,
         'startTime': _fmt_time(job.sorting_job.timestamp_started),
         'endTime': _fmt_time(job.sorting_job.timestamp_completed),
         'sortingOutput': stored_sorting,
         'recordingUri': job.recording_uri,
-        'groundTruthUri': job.ground_truth_uri
+        'groundTruthUri': job.ground_truth_uri,
+        'cacheHit': False,
+        'numThreads': None if telemetry is None else telemetry.get('num_threads', None),
+        'attemptCount': job.attempt,
+        'attemptCauses': get_failure_causes(job.failure_causes, job.sorting_job),
+        'numChannels': job.num_channels or None,
+        'numTrueUnits': job.num_true_units or None,
+        'numUnits': num_units
+    }
+    return record
+
+def open_preprocessing_stage(args: ArgsDict, requests: List[SortingRequest], dispatcher: JobDispatcher) -> Union[PreprocessingStage, None]:
+    if not any(r.sorter.share_preprocessing for r in requests): return None
+    cache = PreprocessingCache(args['preprocessing_cache_path'], int(args['preprocessing_cache_gb'] * 1e9), args['preprocessing_cache_dir'])
+    return PreprocessingStage(cache, dispatcher.submit)
+
+def open_result_cache(args: ArgsDict) -> Union[SortingResultCache, None]:
+    if args['result_cache_path'] is None: return None
+    return SortingResultCache(args['result_cache_path'], args['result_cache_dir'])
+
+def get_result_cache_params(params: Any, sharding: Union[ShardingSpec, None]) -> Any:
+    # A sharded sorting is not the same result as sorting the recording whole.
+    if sharding is None: return params
+    return {**params, 'sharding': sharding._asdict()}
+
+def get_result_cache_key(sorter_name: str, recording_uri: str, params: Any) -> str:
+    return make_cache_key(get_recording_hash(recording_uri), sorter_name, KNOWN_SORTER_VERSIONS[sorter_name], params)
+
+def split_cached_requests(
+    requests: List[SortingRequest],
+    cache: Union[SortingResultCache, None],
+    metrics: Union[PipelineMetrics, None] = None
+) -> Tuple[List[SortingRequest], List[Tuple[SortingRequest, CacheEntry]]]:
+    """Separates the requests which need to be run from those with a cached result.
+
+    Returns:
+        Tuple[List[SortingRequest], List[Tuple[SortingRequest, CacheEntry]]]: Requests to run,
+        and requests with their cached results.
+    """
+    if cache is None: return (requests, [])
+    to_run: List[SortingRequest] = []
+    cached: List[Tuple[SortingRequest, CacheEntry]] = []
+    for request in requests:
+        key = get_result_cache_key(request.sorter.sorter_name, request.recording.recording_uri,
+                                   get_result_cache_params(request.sorter.sorting_parameters, request.sorter.sharding))
+        entry = cache.get(key)
+        if entry is None:
+            to_run.append(request)
+        else:
+            print_per_verbose(2, f"Using cached result for {request.sorter.label} on {request.recording.study_name}/{request.recording.recording_name}")
+            cached.append((request, entry))
+            if metrics is not None: metrics.record_cached(request.sorter.sorter_name)
+    if metrics is not None: metrics.record_cache_lookups(len(cached), len(to_run))
+    return (to_run, cached)
+
+def make_cached_output_record(request: SortingRequest, entry: CacheEntry) -> OutputRecord:
+    record: OutputRecord = {
+        'recordingName': request.recording.recording_name,
+        'studyName': request.recording.study_name,
+        'sorterName': request.sorter.sorter_name,
+        'sorterLabel': request.sorter.label,
+        'sortingParameters': request.sorter.sorting_parameters,
+        **{field: entry.get(field, None) for field in CACHED_RECORD_FIELDS},
+        'errored': False,
+        'recordingUri': request.recording.recording_uri,
+        'groundTruthUri': request.recording.ground_truth_uri,
+        'cacheHit': True,
+        'attemptCount': 0,
+        'attemptCauses': [],
+        'numChannels': request.recording.num_channels or None,
+        'numTrueUnits': request.recording.num_true_units or None
     }
     return record
 
+def cache_result(cache: Union[SortingResultCache, None], job: SortingJob, record: OutputRecord) -> None:
+    """Caches the result of a completed job, from its output record (see make_output_record)."""
+    if cache is None or record['errored']: return
+    params = get_result_cache_params(job.params, job.sharding)
+    entry: CacheEntry = {field: record[field] for field in CACHED_RECORD_FIELDS}
+    cache.put(
+        get_result_cache_key(job.sorter_name, job.recording_uri, params), entry,
+        get_recording_hash(job.recording_uri), job.sorter_name, KNOWN_SORTER_VERSIONS[job.sorter_name], params
+    )
+
 def make_json_output_record(record: OutputRecord) -> str:
     return json.dumps(record, indent=4)
 
-def output_records(results: List[str], std_args: StandardArgs) -> None:
-    if std_args['outfile'] is not None and std_args['outfile'] != '':
-        with open(std_args['outfile'], "a") as file:
-            json.dump(results, file, indent=2)
-    else:
-        print(json.dumps(results, indent=4))
+def open_output_sink(args: ArgsDict, std_args: StandardArgs) -> OutputRecordSink:
+    jsonl_path = get_jsonl_path(std_args['outfile'])
+    if jsonl_path is not None and jsonl_path != std_args['outfile'] and os.path.exists(jsonl_path):
+        raise Exception(f'Error: Requested to write to an existing output file {jsonl_path}. Aborting to avoid overwriting file.')
+    if jsonl_path is None and not args['stdout_jsonl']:
+        # The JSON array for STDOUT is built at the end; stream the records to a scratch file until then.
+        jsonl_path = os.path.join(tempfile.mkdtemp(prefix='spikeforest-records-'), 'records' + JSONL_SUFFIX)
+    return OutputRecordSink(jsonl_path)
+
+def output_records(sink: OutputRecordSink, std_args: StandardArgs) -> None:
+    # Records have already been streamed to the sink as their jobs completed; if a legacy
+    # (single JSON array) outfile or STDOUT was requested, build it from the JSON Lines file now.
+    sink.close()
+    if sink.path is None or sink.path == std_args['outfile']: return
+    if std_args['outfile'] is None or std_args['outfile'] == '':
+        write_json_array(sys.stdout, read_jsonl(sink.path), indent=4)
+        shutil.rmtree(os.path.dirname(sink.path))
+        return
+    count = compact_jsonl(sink.path, std_args['outfile'])
+    print_per_verbose(1, f"Wrote {count} records to {std_args['outfile']} (streamed copy in {sink.path}).")
 
 def main():
     (args, std_args) = init_configuration()
     study_sets = load_study_records(args['study_source_file'])
     study_matrix = parse_sorters(args['sorter_spec_file'], list(study_sets.keys()))
     sorting_matrix = populate_sorting_matrix(study_matrix, study_sets)
-
+    requests = expand_sorting_matrix(sorting_matrix)
+    if args['estimate']:
+        print(estimate_sorting_cost(requests, args, std_args))
+        return
+    trace = start_trace(std_args)
+    with maybe_span(trace, 'order requests'):
+        requests = order_sorting_requests(requests, args, std_args)
+
+    sink = open_output_sink(args, std_args)
+    metrics = start_pipeline_metrics(std_args)
+    cache = open_result_cache(args)
+    with maybe_span(trace, 'result cache lookup'):
+        (requests, cached) = split_cached_requests(requests, cache, metrics)
+    for (request, entry) in cached:
+        sink.write(make_cached_output_record(request, entry))
     hither_config = extract_hither_config(std_args)
+    dispatcher = JobDispatcher(std_args, hither_config['job_handler'], hither_config=hither_config, trace=trace)
+    preprocessing = open_preprocessing_stage(args, requests, dispatcher)
+    def poll() -> None:
+        dispatcher.poll()
+        if preprocessing is not None: preprocessing.poll()
     try:
-        with hi.Config(**hither_config):
-            sortings = list(sorting_loop(sorting_matrix))
-        hi.wait(None)
+        with hi.Config(**hither_config), maybe_span(trace, 'queue jobs'):
+            sortings = list(sorting_loop(requests, dispatcher, preprocessing, metrics, trace))
+        retries = make_retry_scheduler(std_args, hither_config, requests, sortings, dispatcher, preprocessing, metrics, trace)
+        # Build, store and emit each record as soon as its job is done, rather than after the whole matrix.
+        for job in iterate_completed_jobs(sortings, lambda j: j.sorting_job, poll=poll, retries=retries):
+            with maybe_span(trace, 'store output record', args={'sorting': f'{job.sorter_label} {job.study_name}/{job.recording_name}'}):
+                record = make_output_record(job)
+            sink.write(record)
+            cache_result(cache, job, record)
     finally:
-        call_cleanup(hither_config)
-    results: List[OutputRecord] = [make_output_record(job) for job in sortings]
-    output_records(results, std_args)
+        if cache is not None: cache.close()
+        if preprocessing is not None: preprocessing.close()
+        call_cleanup(hither_config, dispatcher)
+        if metrics is not None: metrics.close()
+        if trace is not None: trace.close()
+        sink.close()
+    output_records(sink, std_args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+import math
+from typing import Any, Dict, List, NamedTuple, Union
+
+SHARD_MODE_GROUPS = 'groups'
+SHARD_MODE_SPATIAL = 'spatial'
+SHARD_MODES = [SHARD_MODE_GROUPS, SHARD_MODE_SPATIAL]
+
+class ShardingSpec(NamedTuple):
+    mode: str
+    # For 'groups': the channel ids of each group (e.g. shank)
+    groups: List[List[int]] = []
+    # For 'spatial': the (approximate) number of core channels per shard
+    max_channels: int = 16
+    # Channels within this distance of a shard's core channels are added to it as guard channels.
+    guard_um: float = 50.0
+    # Recordings with fewer channels are sorted whole.
+    min_channels: int = 0
+    # Units from different shards whose spike trains agree at least this much are considered duplicates.
+    agreement_threshold: float = 0.5
+
+class Shard(NamedTuple):
+    channel_ids: List[int]       # core and guard channels, sorted
+    core_channel_ids: List[int]  # units whose peak channel is one of these belong to this shard
+
+def parse_sharding(spec: Union[Dict[str, Any], None], sorter_name: str) -> Union[ShardingSpec, None]:
+    """Parses the optional 'sharding' entry of a sorter in the sorter spec file, e.g.
+
+        sharding:
+            mode: spatial          # or: groups (then also groups: [[0, 1, ...], [32, 33, ...]])
+            max_channels: 16
+            guard_um: 50
+            min_channels: 32
+    """
+    if spec is None: return None
+    unknown = [k for k in spec.keys() if k not in ShardingSpec._fields]
+    if len(unknown) > 0:
+        raise Exception(f"Sharding for sorter {sorter_name}: unrecognized field(s) {unknown}; known fields are {list(ShardingSpec._fields)}.")
+    sharding = ShardingSpec(**{'mode': SHARD_MODE_SPATIAL, **spec})
+    if sharding.mode not in SHARD_MODES:
+        raise Exception(f"Sharding for sorter {sorter_name} has unknown mode {sharding.mode}; expected one of {SHARD_MODES}.")
+    if sharding.mode == SHARD_MODE_GROUPS and len(sharding.groups) == 0:
+        raise Exception(f"Sharding for sorter {sorter_name}: mode '{SHARD_MODE_GROUPS}' requires the channel groups.")
+    if sharding.mode == SHARD_MODE_SPATIAL and sharding.max_channels <= 0:
+        raise Exception(f"Sharding for sorter {sorter_name}: max_channels must be positive.")
+    return sharding
+
+def get_channel_locations(recording_object: dict) -> Union[List[List[float]], None]:
+    # Channel locations of an MDA recording object (either format of load_recording_extractor); None otherwise.
+    # Its channel ids are 0, 1, ... in the order of the locations.
+    data = recording_object if 'raw' in recording_object else recording_object.get('data', {})
+    if recording_object.get('recording_format', 'mda') != 'mda' or 'geom' not in data:
+        return None
+    geom = data['geom']
+    return [[float(c) for c in location] for location in geom]
+
+def _distance(a: List[float], b: List[float]) -> float:
+    return math.sqrt(sum((x - y) ** 2 for (x, y) in zip(a, b)))
+
+def _add_guard_channels(locations: List[List[float]], core: List[int], guard_um: float, channel_ids: List[int]) -> Shard:
+    # core holds channel indices (into locations); the shard, channel ids
+    core_set = set(core)
+    guard = [c for c in range(len(locations)) if c not in core_set and
+                any(_distance(locations[c], locations[k]) <= guard_um for k in core)]
+    return Shard(channel_ids=sorted(channel_ids[c] for c in core + guard), core_channel_ids=sorted(channel_ids[c] for c in core))
+
+def _spatial_bins(locations: List[List[float]], max_channels: int) -> List[List[int]]:
+    # Contiguous bins along the probe's longest dimension, of (nearly) equal channel counts.
+    num_dims = len(locations[0])
+    extents = [max(l[d] for l in locations) - min(l[d] for l in locations) for d in range(num_dims)]
+    axis = extents.index(max(extents))
+    order = sorted(range(len(locations)), key=lambda c: (locations[c][axis], locations[c]))
+    num_bins = math.ceil(len(order) / max_channels)
+    return [order[(i * len(order)) // num_bins:((i + 1) * len(order)) // num_bins] for i in range(num_bins)]
+
+def make_shards(locations: List[List[float]], sharding: ShardingSpec, channel_ids: Union[List[int], None] = None) -> List[Shard]:
+    """Splits the channels of a recording into shards. Returns an empty list if the recording
+    should not be sharded (too few channels, or it would make a single shard).
+
+    Args:
+        locations (List[List[float]]): The location of each channel of the recording.
+        sharding (ShardingSpec): How to shard; its groups are lists of channel ids.
+        channel_ids (List[int], optional): The id of the channel at each location, as from
+            recording.get_channel_ids(). Defaults to 0, 1, ... (as for MDA recordings).
+    """
+    if channel_ids is None:
+        channel_ids = list(range(len(locations)))
+    if len(channel_ids) != len(locations):
+        raise Exception(f"Got {len(channel_ids)} channel ids for {len(locations)} channel locations.")
+    if len(locations) < max(sharding.min_channels, 2):
+        return []
+    if sharding.mode == SHARD_MODE_GROUPS:
+        index_of = {c: i for (i, c) in enumerate(channel_ids)}
+        cores = [[index_of[c] for c in group if c in index_of] for group in sharding.groups]
+        cores = [core for core in cores if len(core) > 0]
+    else:
+        cores = _spatial_bins(locations, sharding.max_channels)
+    if len(cores) < 2:
+        return []
+    return [_add_guard_channels(locations, core, sharding.guard_um, list(channel_ids)) for core in cores]
+
+def make_shard_recording_object(recording_object: Any, shard: Shard) -> dict:
+    # recording_object may also be a job (e.g. shared preprocessing), replaced by its result when this runs.
+    return {
+        'recording_format': 'subrecording',
+        'data': {
+            'recording': recording_object,
+            'channel_ids': shard.channel_ids,
+            'start_frame': None,
+            'end_frame': None
+        }
+    }
@@ -1,23 +1,23 @@
 from argparse import ArgumentParser
-from typing import Any, Dict, List, Tuple, NamedTuple
+from typing import List, Tuple, NamedTuple
 
 import hither2 as hi
 import sortingview as sv
 
-from spikeforest._common.calling_framework import GROUND_TRUTH_URI_KEY, StandardArgs, add_standard_args, call_cleanup, parse_shared_configuration
-from spikeforest.sorting_utilities.run_sortings import SortingMatrixEntry, init_sorting_args, parse_argsdict, load_study_records, parse_sorters, extract_hither_config, populate_sorting_matrix, sorting_loop, SortingJob, SortingMatrixDict
-from spikeforest.sorting_utilities.prepare_workspace import FullRecordingEntry, add_entry_to_workspace, add_workspace_selection_args, establish_workspace, get_known_recording_id, get_labels, TRUE_SORT_LABEL, sortings_are_in_workspace
+from spikeforest._common.job_dispatch import JobDispatcher
+from spikeforest._common.trace import maybe_span
+from spikeforest._common.calling_framework import GROUND_TRUTH_URI_KEY, StandardArgs, add_standard_args, call_cleanup, iterate_completed_jobs, parse_shared_configuration, print_per_verbose, start_pipeline_metrics, start_trace
+from spikeforest.sorting_utilities.run_sortings import ArgsDict, cache_result, estimate_sorting_cost, expand_sorting_matrix, make_output_record, make_retry_scheduler, open_preprocessing_stage, open_result_cache, split_cached_requests, init_sorting_args, order_sorting_requests, parse_argsdict, load_study_records, parse_sorters, extract_hither_config, populate_sorting_matrix, sorting_loop, SortingJob, SortingMatrixDict
+from spikeforest.sorting_utilities.prepare_workspace import add_workspace_selection_args, establish_workspace, get_labels, TRUE_SORT_LABEL, WorkspaceIndex
+from spikeforest.sorting_utilities.planner import CELL_STALE, CELL_UNTRACKED, PlannedCell, PlannerArgs, PlanState, add_planner_args, cells_to_run, filter_sorting_matrix, format_plan, parse_planner_args, plan_sorting_matrix, write_invalidation_list
+from spikeforest.sorting_utilities.workspace_writer import WorkspacePost, WorkspaceWriter
 
 class Params(NamedTuple):
     study_source_file: str
     sorter_spec_file:  str
     workspace_uri:     str
-
-class HydratedObjects(NamedTuple):
-    workspace: sv.Workspace
-    recording: sv.LabboxEphysRecordingExtractor
-    gt_sort:   sv.LabboxEphysSortingExtractor
-    sorting:   sv.LabboxEphysSortingExtractor
+    sorting_args:      ArgsDict
+    planner_args:      PlannerArgs
 
 def init_configuration() -> Tuple[Params, StandardArgs]:
     description = "Runs all known sorters against configured SpikeForest recordings, and loads the " + \
@@ -25,6 +25,7 @@ def init_configuration() -> Tuple[Params, StandardArgs]:
     parser = ArgumentParser(description=description)
     parser = add_workspace_selection_args(parser)
     parser = init_sorting_args(parser)
+    parser = add_planner_args(parser)
     parser = add_standard_args(parser)
     parsed = parser.parse_args()
     sortings_args = parse_argsdict(parsed)
@@ -33,97 +34,111 @@ def init_configuration() -> Tuple[Params, StandardArgs]:
     params = Params(
         study_source_file = sortings_args["study_source_file"],
         sorter_spec_file  = sortings_args["sorter_spec_file"],
-        workspace_uri     = workspace_uri
+        workspace_uri     = workspace_uri,
+        sorting_args      = sortings_args,
+        planner_args      = parse_planner_args(parsed)
     )
     print(f"Using workspace uri {params.workspace_uri}")
     return (params, std_args)
 
-def remove_preexisting_records(matrix: SortingMatrixDict, w_uri: str) -> SortingMatrixDict:
-    workspace = sv.load_workspace(w_uri)
-    new_matrix: SortingMatrixDict = {}
-    for sorter_name in matrix.keys():
-        (sorter, recording_list) = matrix[sorter_name]
-        for recording in recording_list:
-            (_, gt_label, s_label) = get_labels(recording.study_name, recording.recording_name, TRUE_SORT_LABEL, sorter_name)
-            (_, sorting_exists) = sortings_are_in_workspace(workspace, gt_label, s_label)
-            if (sorting_exists): continue
-            if sorter_name not in new_matrix:
-                new_matrix[sorter_name] = SortingMatrixEntry(sorter_record=sorter, requested_recordings=[])
-            new_matrix[sorter_name].requested_recordings.append(recording)
-    return new_matrix
-
-def populate_extractors(workspace_uri: str, rec_uri: str, gt_uri: str, sorting_result: Any) -> HydratedObjects:
-    workspace = sv.load_workspace(workspace_uri)
-    recording = sv.LabboxEphysRecordingExtractor(rec_uri, download=True)
-    sample_rate = recording.get_sampling_frequency()
-    gt_sort = sv.LabboxEphysSortingExtractor(gt_uri, samplerate=sample_rate)
-    sorting = sv.LabboxEphysSortingExtractor(sorting_result, samplerate=sample_rate)
-    return HydratedObjects(
-        workspace = workspace,
-        recording = recording,
-        gt_sort   = gt_sort,
-        sorting   = sorting
-    )
-
-@hi.function(
-    'hi_post_result_to_workspace', '0.1.0',
-    modules=['sortingview', 'spikeforest'],
-    kachery_support=True
-)
-def hi_post_result_to_workspace(
-    sorting_entry: SortingJob,
-    workspace_uri: str
-) -> None:
-    # Python does not round-trip namedtuples effectively :(
-    entry = SortingJob(
-        recording_name=sorting_entry[0],
-        recording_uri=sorting_entry[1],
-        ground_truth_uri=sorting_entry[2],
-        study_name=sorting_entry[3],
-        sorter_name=sorting_entry[4],
-        params=sorting_entry[5],
-        sorting_job=sorting_entry[6]
-    )
-    items = populate_extractors(workspace_uri,
-                                entry.recording_uri,
-                                entry.ground_truth_uri,
-                                # within a hither Job, other Jobs are replaced with Job.result.return_value
-                                entry.sorting_job)
-    (r_label, gt_label, s_label) = get_labels(entry.study_name,
-                                              entry.recording_name,
-                                              TRUE_SORT_LABEL,
-                                              entry.sorter_name)
-    R_id = get_known_recording_id(items.workspace, r_label)
-    (gt_exists, sorting_exists) = sortings_are_in_workspace(items.workspace, gt_label, s_label)
-    entry = FullRecordingEntry(
-        r_label, gt_label, s_label, R_id,
-        items.recording, items.gt_sort, items.sorting,
-        gt_exists, sorting_exists
-    )
-    add_entry_to_workspace(re=entry, workspace=items.workspace)
+def plan_sortings(matrix: SortingMatrixDict, w_uri: str, planner_args: PlannerArgs, state: PlanState) -> Tuple[SortingMatrixDict, List[PlannedCell]]:
+    """Returns the part of the matrix to run: the sortings missing from the workspace, and those made from
+    other inputs (sorter wrapper version, container Dockerfile, parameters, recording data) than the desired ones."""
+    index = WorkspaceIndex(sv.load_workspace(w_uri))
+    cells = plan_sorting_matrix(matrix, w_uri, index.sorting_labels(), state,
+        lambda recording, sorter_label: get_labels(recording.study_name, recording.recording_name, TRUE_SORT_LABEL, sorter_label)[2])
+    print(format_plan(cells, planner_args.rerun_untracked))
+    to_run = cells_to_run(cells, planner_args.rerun_untracked)
+    return (filter_sorting_matrix(matrix, to_run), to_run)
 
 def main():
     (params, std_args) = init_configuration()
     study_sets = load_study_records(params.study_source_file)
     study_matrix = parse_sorters(params.sorter_spec_file, list(study_sets.keys()))
     sorting_matrix = populate_sorting_matrix(study_matrix, study_sets)
-    sorting_matrix = remove_preexisting_records(sorting_matrix, params.workspace_uri)
+    trace = start_trace(std_args)
+    state = PlanState(params.planner_args.plan_state_path)
+    with maybe_span(trace, 'plan'):
+        (sorting_matrix, planned_cells) = plan_sortings(sorting_matrix, params.workspace_uri, params.planner_args, state)
+    if params.planner_args.invalidation_file is not None:
+        write_invalidation_list(params.planner_args.invalidation_file, planned_cells)
+    requests = expand_sorting_matrix(sorting_matrix)
+    if params.sorting_args['estimate'] or params.planner_args.plan_only:
+        if params.sorting_args['estimate']: print(estimate_sorting_cost(requests, params.sorting_args, std_args))
+        state.close()
+        if trace is not None: trace.close()
+        return
+    cell_of = {(c.sorter_label, c.study_name, c.recording_name): c for c in planned_cells}
+    with maybe_span(trace, 'order requests'):
+        requests = order_sorting_requests(requests, params.sorting_args, std_args)
+    metrics = start_pipeline_metrics(std_args)
+    cache = open_result_cache(params.sorting_args)
+    with maybe_span(trace, 'result cache lookup'):
+        (requests, cached) = split_cached_requests(requests, cache, metrics)
     hither_config = extract_hither_config(std_args)
-    jobs: hi.Job = []
+    dispatcher = JobDispatcher(std_args, hither_config['job_handler'], hither_config=hither_config, trace=trace)
+    preprocessing = open_preprocessing_stage(params.sorting_args, requests, dispatcher)
+    cell_of_label = {c.sorting_label: c for c in planned_cells}
+
+    def record_inputs(item: WorkspacePost) -> None:
+        # As soon as the sorting is in the workspace, so that an interrupted run leaves it tracked
+        cell = cell_of_label[item.sorting_label]
+        state.put(params.workspace_uri, cell.sorting_label, cell.fingerprint)
+
+    writer = WorkspaceWriter(params.workspace_uri, on_added=record_inputs)
+
+    def poll() -> None:
+        dispatcher.poll()
+        if preprocessing is not None: preprocessing.poll()
+
+    def post_to_workspace(sorting: SortingJob) -> None:
+        cell = cell_of[(sorting.sorter_label, sorting.study_name, sorting.recording_name)]
+        (r_label, gt_label, s_label) = get_labels(sorting.study_name, sorting.recording_name, TRUE_SORT_LABEL, sorting.sorter_label)
+        writer.post(WorkspacePost(
+            recording_label    = r_label,
+            ground_truth_label = gt_label,
+            sorting_label      = s_label,
+            recording_uri      = sorting.recording_uri,
+            ground_truth_uri   = sorting.ground_truth_uri,
+            sorting_object     = sorting.sorting_job,
+            # Stale sortings are replaced; untracked ones only if they are being rerun (--rerun-untracked)
+            replace            = cell.status in [CELL_STALE, CELL_UNTRACKED]
+        ))
 
     try:
-        with hi.Config(**hither_config):
-            sortings = list(sorting_loop(sorting_matrix))
-            with hi.Config(job_handler=None, job_cache=None):
-                for sorting in sortings:
-                    p = {
-                        'sorting_entry': sorting,
-                        'workspace_uri': params.workspace_uri
-                    }
-                    jobs.append(hi.Job(hi_post_result_to_workspace, p))
-        hi.wait(None)
+        for (request, entry) in cached:
+            post_to_workspace(SortingJob(
+                recording_name=request.recording.recording_name,
+                recording_uri=request.recording.recording_uri,
+                ground_truth_uri=request.recording.ground_truth_uri,
+                study_name=request.recording.study_name,
+                sorter_name=request.sorter.sorter_name,
+                params=request.sorter.sorting_parameters,
+                sorting_job=entry['sortingOutput'],
+                sorter_label=request.sorter.label
+            ))
+        with hi.Config(**hither_config), maybe_span(trace, 'queue jobs'):
+            sortings = list(sorting_loop(requests, dispatcher, preprocessing, metrics, trace))
+        retries = make_retry_scheduler(std_args, hither_config, requests, sortings, dispatcher, preprocessing, metrics, trace)
+        for sorting in iterate_completed_jobs(sortings, lambda s: s.sorting_job, poll=poll, retries=retries):
+            if sorting.sorting_job.status == 'error':
+                print(f"WARNING: {sorting.sorter_label} errored on {sorting.study_name}/{sorting.recording_name} " +
+                      f"(attempts: {sorting.attempt}); nothing to post.")
+                continue
+            # The same record (stored sorting, console output, timings) that run_sortings caches
+            record = make_output_record(sorting)
+            cache_result(cache, sorting, record)
+            post_to_workspace(sorting._replace(sorting_job=record['sortingOutput']))
+        with maybe_span(trace, 'wait for workspace writer'):
+            posted = writer.close()
+        print_per_verbose(1, f"Posted {len(posted)} sorting(s) to the workspace.")
     finally:
-        call_cleanup(hither_config)
+        state.close()
+        call_cleanup(hither_config, dispatcher)
+        if cache is not None: cache.close()
+        if preprocessing is not None: preprocessing.close()
+        if metrics is not None: metrics.close()
+        if trace is not None: trace.close()
 
 
 if __name__ == "__main__":
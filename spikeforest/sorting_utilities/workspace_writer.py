@@ -0,0 +1,111 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Union
+
+import sortingview as sv
+from spikeforest._common.calling_framework import print_per_verbose
+from spikeforest.sorting_utilities.prepare_workspace import WorkspaceIndex
+
+class WorkspacePost(NamedTuple):
+    recording_label:    str
+    ground_truth_label: str
+    sorting_label:      str
+    recording_uri:      str
+    ground_truth_uri:   str
+    sorting_object:     Any
+    replace:            bool  # if a sorting with this label is already in the workspace, replace it
+
+class WorkspaceWriter:
+    """The only writer to a workspace during a run. Results are queued with post and added by a
+    background thread, which keeps the workspace loaded, looks labels up in a WorkspaceIndex, and
+    adds each recording (and its ground truth) only once, however many sortings of it are posted.
+    Recordings are opened for their metadata only: the raw data is not downloaded.
+
+    Args:
+        workspace_uri (str): The workspace to add to.
+        batch_size (int): At most this many queued posts are taken at a time; within a batch, the
+            recordings are added first, then the sortings.
+        on_added (Callable[[WorkspacePost], None]): If given, called (on the writer thread) with
+            each post as soon as its sorting has been added.
+    """
+    def __init__(self, workspace_uri: str, batch_size: int = 50, on_added: Union[Callable[[WorkspacePost], None], None] = None) -> None:
+        workspace = sv.load_workspace(workspace_uri)
+        if workspace is None:
+            raise Exception(f"Error: Could not load workspace {workspace_uri}.")
+        self._index = WorkspaceIndex(workspace)
+        self._batch_size = batch_size
+        self._on_added = on_added
+        self._recordings: Dict[str, sv.LabboxEphysRecordingExtractor] = {}
+        self._posted: List[WorkspacePost] = []
+        self._error: Union[Exception, None] = None
+        self._queue: 'queue.Queue[Union[WorkspacePost, None]]' = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def post(self, item: WorkspacePost) -> None:
+        if self._error is not None: raise self._error
+        self._queue.put(item)
+
+    def close(self) -> List[WorkspacePost]:
+        """Waits for all queued posts to be written; returns those whose sorting was added to the workspace
+        (not those skipped because a sorting with the label was already there)."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None: raise self._error
+        return list(self._posted)
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in batch
+            try:
+                self._write_batch([item for item in batch if item is not None])
+            except Exception as e:
+                self._error = e
+                return
+
+    def _get_recording(self, uri: str) -> sv.LabboxEphysRecordingExtractor:
+        if uri not in self._recordings:
+            self._recordings[uri] = sv.LabboxEphysRecordingExtractor(uri, download=False)
+        return self._recordings[uri]
+
+    def _write_batch(self, batch: List[WorkspacePost]) -> None:
+        if len(batch) == 0: return
+        print_per_verbose(2, f"Adding {len(batch)} sorting(s) to the workspace")
+        failed = set()
+        for (i, item) in enumerate(batch):
+            if self._index.recording_id(item.recording_label) is not None: continue
+            try:
+                self._index.add_recording(recording=self._get_recording(item.recording_uri), label=item.recording_label)
+            except Exception as e:
+                print(f"WARNING: could not add {item.recording_label} to the workspace: {e}")
+                failed.add(i)
+        for (i, item) in enumerate(batch):
+            if i in failed: continue
+            try:
+                if not self._write_sorting(item): continue
+            except Exception as e:
+                print(f"WARNING: could not add {item.sorting_label} to the workspace: {e}")
+                continue
+            self._posted.append(item)
+            if self._on_added is not None: self._on_added(item)
+
+    def _write_sorting(self, item: WorkspacePost) -> bool:
+        """Adds the sorting of item (and its ground truth) to the workspace; returns whether the sorting was added."""
+        recording_id = self._index.recording_id(item.recording_label)
+        sample_rate = self._get_recording(item.recording_uri).get_sampling_frequency()
+        if not self._index.has_sorting(item.ground_truth_label):
+            sorting_true = sv.LabboxEphysSortingExtractor(item.ground_truth_uri, samplerate=sample_rate)
+            self._index.add_sorting(sorting=sorting_true, recording_id=recording_id, label=item.ground_truth_label)
+        if item.replace:
+            self._index.remove_sortings_with_label(item.sorting_label)
+        if self._index.has_sorting(item.sorting_label): return False
+        sorting = sv.LabboxEphysSortingExtractor(item.sorting_object, samplerate=sample_rate)
+        self._index.add_sorting(sorting=sorting, recording_id=recording_id, label=item.sorting_label)
+        return True